@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+###
+# Copyright (c) 2016, Nicolas Coevoet
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""Microbenchmarks of the string primitives used by the detectors.
+
+    python3 benchmark.py [--save baseline.json] [--compare baseline.json] [--tolerance 0.2]
+    python3 benchmark.py --windows 8,16,32,64,128,256,512
+
+Each primitive runs over generated corpora ( short chat, long pastes,
+unicode spam, repeated chars floods ), ops/s and bytes allocated per call
+( tracemalloc peak ) are reported. With --compare, results are checked
+against a previously saved baseline and the exit status is 1 when a
+primitive is slower or allocates more than the tolerance allows.
+
+With --windows, the python and numpy scans of massRepeat windows and
+their minhash index are compared, to find the window sizes from which
+numpy then the index are faster.
+
+With --traffic, texts of PRIVMSG and NOTICE of raw IRC logs ( as given
+to replay.py ) are scored by ftfy directly then through the plugin's ascii
+fast path and weirdness cache, in order, as badunicode would see them.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+
+from replay import setup, loadPlugin
+
+words = ('hello', 'hi', 'anyone', 'knows', 'how', 'to', 'fix', 'this', 'error', 'when', 'i', 'run', 'make',
+    'install', 'thanks', 'the', 'kernel', 'package', 'is', 'broken', 'again', 'lol', 'yes', 'no', 'maybe',
+    'channel', 'server', 'please', 'help', 'me', 'with', 'python', 'config', 'file', 'works', 'now', 'ok')
+
+code = ('def ', 'return ', 'self.', 'if ', 'else:', 'for ', ' in ', 'range(', ')', '(', '[', ']', '{', '}',
+    ' = ', ' == ', 'None', 'True', 'import ', 'print(', '"', "'", ', ', '    ', '0', '1', '42', 'x', 'y')
+
+glyphs = ('Ḕ', 'Î', 'Ù', 'Ṋ', 'ℰ', 'Ừ', 'ś', 'ï', 'ℯ', 'ļ', 'ẋ', 'ᾒ', 'ἶ', 'ệ', 'ℓ', 'Ŋ', 'ξ', 'ṵ', '§',
+    '̀', '́', '̶', '҉', '​', '‮', 'ｆ', 'ｒ', 'ｅ', '█', '▓', '░', '♥', '☭')
+
+def shortChat(rand):
+    return ' '.join(rand.choice(words) for i in range(rand.randint(3,12)))
+
+def longPaste(rand):
+    s = ''
+    while len(s) < rand.randint(300,450):
+        s = s + rand.choice(code)
+    return s
+
+def unicodeSpam(rand):
+    s = ''
+    for i in range(rand.randint(20,120)):
+        if rand.random() < 0.6:
+            s = s + rand.choice(glyphs)
+        else:
+            s = s + rand.choice('abcdefghijklmnopqrstuvwxyz ')
+    return s
+
+def flood(rand):
+    unit = rand.choice(('a', 'lol ', 'spam', '!!', 'ha', 'BUY NOW ', '█'))
+    s = unit * rand.randint(10,400 // len(unit))
+    if rand.random() < 0.5:
+        s = shortChat(rand) + ' ' + s
+    return s[:450]
+
+corpora = (('short', shortChat), ('paste', longPaste), ('unicode', unicodeSpam), ('flood', flood))
+
+def corpus(generator,size,seed):
+    rand = random.Random(seed)
+    return [generator(rand) for i in range(size)]
+
+def primitives(plugin):
+    # name, function called on (message, next message)
+    patterns = plugin.PatternSet()
+    rand = random.Random(7)
+    for uid in range(1,201):
+        if uid % 10 == 0:
+            pattern = plugin.Pattern(uid,r'/%s\s+%s\d*/' % (rand.choice(words),rand.choice(words)),True,1,60)
+        else:
+            pattern = plugin.Pattern(uid,'%s %s %s' % (rand.choice(words),rand.choice(words),rand.choice(words)),False,1,60)
+        patterns.add(pattern)
+    literal = plugin.Pattern(1000,'knows how to',False,1,60)
+    regexp = plugin.Pattern(1001,r'/(fix|broken)\s+\w+/',True,1,60)
+    # logged messages keep their fingerprint, only the new one is computed
+    logged = {}
+    def similarity(a,b):
+        if not b in logged:
+            logged[b] = plugin.fingerprint(b)
+        return plugin.compareFingerprint(a,plugin.fingerprint(a),b,logged[b])
+    def weirdness(a,b):
+        return plugin.MessageContext(a,'*@127.0.0.1',patterns).weirdness()
+    return (
+        ('compareString', lambda a,b: plugin.compareString(a,b)),
+        ('compareFingerprint', similarity),
+        ('largestString', lambda a,b: plugin.largestString(a,b)),
+        ('repetitions', lambda a,b: list(plugin.repetitions(a))),
+        ('Pattern.match literal', lambda a,b: literal.match(a)),
+        ('Pattern.match regexp', lambda a,b: regexp.match(a)),
+        ('PatternSet.match 200', lambda a,b: patterns.match(a)),
+        ('sequence_weirdness', lambda a,b: plugin.sequence_weirdness(a.lower())),
+        ('isChannelUnicode', weirdness),
+        ('MessageContext.features', lambda a,b: plugin.TextFeatures(a,a.lower())),
+    )
+
+def measure(f,messages,duration):
+    pairs = list(zip(messages,messages[1:] + messages[:1]))
+    # ops/s, as many passes over the corpus as duration allows
+    calls = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < duration:
+        for (a,b) in pairs:
+            f(a,b)
+        calls = calls + len(pairs)
+        elapsed = time.perf_counter() - start
+    ops = calls / elapsed
+    # bytes allocated at peak by a single call, averaged
+    tracemalloc.start()
+    total = 0
+    for (a,b) in pairs:
+        tracemalloc.reset_peak()
+        (current,peak) = tracemalloc.get_traced_memory()
+        f(a,b)
+        total = total + tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+    return (ops,total / float(len(pairs)))
+
+def compare(results,baseline,tolerance):
+    regressions = []
+    for (key,(ops,mem)) in sorted(results.items()):
+        if not key in baseline:
+            continue
+        (bops,bmem) = baseline[key]
+        if ops < bops * (1 - tolerance):
+            regressions.append('%s: %.0f ops/s, baseline %.0f ops/s (%+.1f%%)' % (key,ops,bops,(ops/bops - 1)*100))
+        if mem > bmem * (1 + tolerance) and mem - bmem > 256:
+            regressions.append('%s: %.0f bytes/call, baseline %.0f bytes/call' % (key,mem,bmem))
+    return regressions
+
+def windows(plugin,sizes,duration):
+    """time MessageWindow.similar for each window size, by python and numpy scans and through the minhash index"""
+    rand = random.Random(11)
+    messages = [shortChat(rand) for i in range(max(sizes) + 200)]
+    modes = [('python',None,None),('numpy',0,None),('index',0,0)]
+    if plugin.numpy is None:
+        sys.stdout.write('numpy is not installed, windows are scanned in python\n')
+        modes.pop(1)
+    (vectorMinimum,indexMinimum) = (plugin.MessageWindow.vectorMinimum,plugin.MessageWindow.indexMinimum)
+    sys.stdout.write('%-8s %s\n' % ('window',' '.join(['%14s' % ('%s ops/s' % name) for (name,v,i) in modes])))
+    try:
+        for size in sizes:
+            window = plugin.MessageWindow(3600)
+            for m in messages[:size]:
+                window.enqueue((m,plugin.fingerprint(m)))
+            texts = messages[size:size+200]
+            fingerprints = dict((m,plugin.fingerprint(m)) for m in texts)
+            result = []
+            for (name,vector,index) in modes:
+                plugin.MessageWindow.vectorMinimum = size + 1 if vector is None else vector
+                plugin.MessageWindow.indexMinimum = size + 1 if index is None else index
+                # builds or drops the index
+                window.similar('',0,1.0)
+                # a trigger nothing reaches, the whole window or all the candidates are compared
+                (ops,mem) = measure(lambda a,b: window.similar(a,fingerprints[a],1.0),texts,duration)
+                result.append(ops)
+            sys.stdout.write('%-8s %s\n' % (size,' '.join(['%14.0f' % ops for ops in result])))
+    finally:
+        (plugin.MessageWindow.vectorMinimum,plugin.MessageWindow.indexMinimum) = (vectorMinimum,indexMinimum)
+    sys.stdout.write('MessageWindow.vectorMinimum is %s, MessageWindow.indexMinimum is %s\n' % (vectorMinimum,indexMinimum))
+
+def traffic(plugin,filenames):
+    """messages/s of badunicode scoring over recorded traffic, with and without the fast path and cache"""
+    from replay import parse
+    texts = []
+    for filename in filenames:
+        with open(filename,errors='replace') as f:
+            for line in f:
+                parsed = parse(line)
+                if parsed is None:
+                    continue
+                msg = parsed[1]
+                if msg.command in ('PRIVMSG','NOTICE') and len(msg.args) == 2:
+                    texts.append(msg.args[1].lower())
+    if not texts:
+        sys.stdout.write('no PRIVMSG or NOTICE found\n')
+        return
+    ascii = len([text for text in texts if text.isascii() and text.isprintable()])
+    sys.stdout.write('%s messages, %s distinct, %.1f%% printable ascii\n' % (len(texts),len(set(texts)),ascii * 100.0 / len(texts)))
+    plugin._cachedWeirdness.cache_clear()
+    for (name,f) in (('ftfy',plugin.sequence_weirdness),('fast path and cache',plugin.weirdness)):
+        start = time.perf_counter()
+        for text in texts:
+            f(text)
+        elapsed = time.perf_counter() - start
+        sys.stdout.write('%-20s %12.0f messages/s\n' % (name,len(texts) / elapsed))
+    cache = plugin._cachedWeirdness.cache_info()
+    sys.stdout.write('cache: %s hits, %s misses\n' % (cache.hits,cache.misses))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='benchmark the string primitives used by detectors')
+    parser.add_argument('--size',type=int,default=200,help='messages per corpus')
+    parser.add_argument('--duration',type=float,default=0.5,help='seconds spent per primitive and corpus')
+    parser.add_argument('--only',default='',help='run primitives whose name contains this')
+    parser.add_argument('--windows',help='only compare scans of windows of these sizes, ie 8,16,32,64')
+    parser.add_argument('--traffic',nargs='+',help='only score badunicode over these files of raw IRC lines')
+    parser.add_argument('--save',help='store results as a baseline in this file')
+    parser.add_argument('--compare',help='compare results with the baseline stored in this file')
+    parser.add_argument('--tolerance',type=float,default=0.2,help='allowed slowdown or extra memory, 0.2 for 20%%')
+    args = parser.parse_args(argv)
+    directory = tempfile.mkdtemp(prefix='sigyn-benchmark-')
+    setup(None,directory)
+    plugin = loadPlugin().plugin
+    if args.windows:
+        windows(plugin,[int(size) for size in args.windows.split(',')],args.duration)
+        return 0
+    if args.traffic:
+        traffic(plugin,args.traffic)
+        return 0
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            stored = json.load(f)
+        if stored['size'] != args.size:
+            parser.error('%s was made with --size %s' % (args.compare,stored['size']))
+        baseline = stored['results']
+    results = {}
+    sys.stdout.write('%-24s %-8s %14s %14s %10s\n' % ('primitive','corpus','ops/s','bytes/call','baseline'))
+    for (name,f) in primitives(plugin):
+        if not args.only in name:
+            continue
+        for (seed,(kind,generator)) in enumerate(corpora):
+            messages = corpus(generator,args.size,seed)
+            key = '%s %s' % (name,kind)
+            (ops,mem) = measure(f,messages,args.duration)
+            results[key] = (ops,mem)
+            delta = ''
+            if key in baseline:
+                delta = '%+.1f%%' % ((ops/baseline[key][0] - 1)*100)
+            sys.stdout.write('%-24s %-8s %14.0f %14.0f %10s\n' % (name,kind,ops,mem,delta))
+            sys.stdout.flush()
+    if args.save:
+        with open(args.save,'w') as f:
+            json.dump({'size': args.size, 'results': results},f,indent=1,sort_keys=True)
+    if args.compare:
+        regressions = compare(results,baseline,args.tolerance)
+        if len(regressions):
+            sys.stdout.write('%s regressions:\n%s\n' % (len(regressions),'\n'.join(regressions)))
+            return 1
+        sys.stdout.write('no regression against %s\n' % args.compare)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
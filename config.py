@@ -84,6 +84,21 @@ conf.registerGlobalValue(Sigyn, 'klineMessage',
 conf.registerChannelValue(Sigyn, 'killMessage',
      registry.String("Spam is off topic on freenode.", """kill reason"""))
      
+conf.registerGlobalValue(Sigyn, 'patternCountInterval',
+     registry.PositiveInteger(60,"""interval in seconds between writes of patterns calls counters into database, applied when changed"""))
+
+conf.registerGlobalValue(Sigyn, 'patternHitsDays',
+     registry.PositiveInteger(365,"""days hourly calls of patterns are kept in database, longest window of toppattern and deadpattern"""))
+
+conf.registerGlobalValue(Sigyn, 'windowIndexMinimum',
+     registry.Integer(-1,"""number of messages of a mass repeat window from which only candidates of a minhash index are compared, it may miss some similar messages; 0 to disable, -1 to use it from 256 messages when numpy is not installed only"""))
+
+conf.registerGlobalValue(Sigyn, 'regexpBudget',
+     registry.Float(0.05,"""maximum cpu time in seconds of a regexp pattern on a single message, measured once it returned, patterns over it on 3 messages within an hour are disabled, 0 to disable"""))
+
+conf.registerGlobalValue(Sigyn, 'capabilityCacheSize',
+     registry.PositiveInteger(4096,"""maximum number of hostmasks whose channel capabilities are kept between messages"""))
+
 conf.registerGlobalValue(Sigyn, 'operatorNick',
      registry.String("", """oper's nick, must be filled""", private=True))
 conf.registerGlobalValue(Sigyn, 'operatorPassword',
@@ -34,6 +34,8 @@
 import os
 import re
 import sys
+import types
+import tracemalloc
 import time
 import requests
 from urllib.parse import urlencode
@@ -44,6 +46,8 @@ import dns.resolver
 import json
 import ipaddress
 import random
+import array
+import functools
 import supybot.log as log
 import supybot.conf as conf
 import supybot.utils as utils
@@ -59,17 +63,126 @@ import supybot.schedule as schedule
 import supybot.registry as registry
 from ftfy.badness import sequence_weirdness
 from ftfy.badness import text_cost
+try:
+    import re._parser as sre_parse
+except ImportError:
+    import sre_parse
+try:
+    import numpy
+except ImportError:
+    numpy = None
 try:
     from supybot.i18n import PluginInternationalization
     _ = PluginInternationalization('Sigyn')
 except:
     _ = lambda x:x
 
+# repetitions() must give the results of this regexp, it is still used where it is cheap
+_repetition = re.compile(r"(.+?)\1+")
+# lines shorter than this are left to the regexp
+_repetitionThreshold = 128
+# positions without any repetition the regexp may try, each try costs the length of the line
+_repetitionBudget = 64
+
+def _commonPrefix (s,i,j):
+    """return the length of the common prefix of s[i:] and s[j:]"""
+    # gallops then bisects, slices are compared in C
+    n = len(s) - max(i,j)
+    if n <= 0 or s[i] != s[j]:
+        return 0
+    k = 1
+    while k*2 <= n and s[i:i+k*2] == s[j:j+k*2]:
+        k = k*2
+    low = k
+    high = min(k*2,n)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if s[i:i+middle] == s[j:j+middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+def maximalRuns (s):
+    """return the set of (start, end, period) of the maximal repetitions in s"""
+    # every run has a lyndon root, which is the longest lyndon word starting at its position
+    # for one of the two orders of the alphabet ( runs theorem, Bannai et al. )
+    n = len(s)
+    r = s[::-1]
+    runs = set()
+    last = {}
+    reverse = dict((ord(c),0x10FFFF - ord(c)) for c in set(s))
+    for t in (s,s.translate(reverse)):
+        # nexts[i] is the end of the longest lyndon word starting at i: the next smaller suffix
+        nexts = array.array('i',[n]) * n
+        for i in range(n-2,-1,-1):
+            j = i + 1
+            c = t[i]
+            while j < n and (t[j] > c or t[j] == c and t[j:] > t[i:]):
+                j = nexts[j]
+            nexts[i] = j
+        i = -1
+        for j in nexts:
+            i = i + 1
+            if j == n or s[i] != s[j] and (i == 0 or s[i-1] != s[j-1]):
+                continue
+            period = j - i
+            # roots inside the last run found with that period extend to that run
+            if period in last and last[period][0] <= i and j <= last[period][1]:
+                continue
+            forward = _commonPrefix(s,i,j)
+            backward = 0
+            if i > 0:
+                backward = _commonPrefix(r,n-i,n-j)
+            if forward + backward >= period:
+                last[period] = (i-backward,j+forward)
+                runs.add((i-backward,j+forward,period))
+    return runs
+
+def _runRepetitions (line):
+    # the shortest square starting at each position belongs to a run with the same period
+    n = len(line)
+    shortest = array.array('i',[0]) * n
+    ends = array.array('i',[0]) * n
+    for (start,end,period) in maximalRuns(line):
+        for i in range(start,end-2*period+1):
+            if not shortest[i] or period < shortest[i]:
+                shortest[i] = period
+                ends[i] = end
+    i = 0
+    while i < n:
+        period = shortest[i]
+        if period:
+            count = (ends[i] - i) // period
+            yield (line[i:i+period], float(count))
+            i = i + period*count
+        else:
+            i = i + 1
+
 def repetitions(s):
     # returns a list of (pattern,count), used to detect a repeated pattern inside a single string.
-    r = re.compile(r"(.+?)\1+")
-    for match in r.finditer(s):
-        yield (match.group(1), len(match.group(0))/len(match.group(1)))
+    # the regexp is quadratic on long lines without repetitions, they are handed to the linear runs
+    # once the regexp wasted its budget, '.' does not match '\n' so lines are independent
+    for line in s.split('\n'):
+        n = len(line)
+        if n < _repetitionThreshold:
+            for match in _repetition.finditer(line):
+                yield (match.group(1), len(match.group(0))/len(match.group(1)))
+            continue
+        i = 0
+        misses = 0
+        while i < n:
+            match = _repetition.match(line,i)
+            if match:
+                yield (match.group(1), len(match.group(0))/len(match.group(1)))
+                i = match.end()
+                continue
+            i = i + 1
+            misses = misses + 1
+            if misses > _repetitionBudget:
+                for repetition in _runRepetitions(line[i:]):
+                    yield repetition
+                break
 
 def isCloaked (prefix,sig):
     if sig.registryValue('useWhoWas'):
@@ -94,23 +207,338 @@ def compareString (a,b):
     jacc = n / float(len(sa) + len(sb) - n)
     return jacc
 
+try:
+    _popcount = int.bit_count
+except AttributeError:
+    def _popcount (n):
+        return bin(n).count('1')
+
+def fingerprint (s):
+    """return the characters of s for compareFingerprint, a bitmap when s is ascii"""
+    if s.isascii():
+        value = 0
+        for c in set(s):
+            value = value | (1 << ord(c))
+    else:
+        value = frozenset(s)
+    return value
+
+def compareFingerprint (a,fa,b,fb):
+    """compareString of a and b, given their fingerprints"""
+    if a == b:
+        return 1
+    if isinstance(fa,int) and isinstance(fb,int):
+        n = _popcount(fa & fb)
+        total = _popcount(fa | fb)
+    else:
+        if isinstance(fa,int):
+            fa = set(a)
+        if isinstance(fb,int):
+            fb = set(b)
+        n = len(fa & fb)
+        total = len(fa) + len(fb) - n
+    if total == 0:
+        return 0
+    return n / float(total)
+
+_minHashPrime = (1 << 31) - 1
+
+def _minHashTables (n,seed):
+    # (a, b) of the n hash functions (a * ord(c) + b) % prime, and the hashes of ascii characters
+    rand = random.Random(seed)
+    coefficients = tuple([(rand.randrange(1,_minHashPrime),rand.randrange(_minHashPrime)) for i in range(n)])
+    ascii = tuple([tuple([(a * c + b) % _minHashPrime for (a,b) in coefficients]) for c in range(128)])
+    return (coefficients,ascii)
+
+# 6 bands of 5 hashes: texts with 0.9 of similarity share a band 99.5% of the time, 0.8 91%, 0.6 39%
+_minHashBands = 6
+_minHashRows = 5
+(_minHashCoefficients,_minHashAscii) = _minHashTables(_minHashBands * _minHashRows,1337)
+
+def minHash (s):
+    """return the minhash signature of the characters of s, None when s is empty"""
+    hashes = []
+    for c in set(s):
+        c = ord(c)
+        if c < 128:
+            hashes.append(_minHashAscii[c])
+        else:
+            hashes.append(tuple([(a * c + b) % _minHashPrime for (a,b) in _minHashCoefficients]))
+    if not len(hashes):
+        return None
+    return tuple(map(min,zip(*hashes)))
+
+def minHashBands (s):
+    """return the keys of the bands of the minhash signature of s"""
+    signature = minHash(s)
+    if signature is None:
+        return []
+    keys = []
+    for band in range(_minHashBands):
+        keys.append((band,) + signature[band*_minHashRows:(band+1)*_minHashRows])
+    return keys
+
+def suffixAutomaton (s):
+    """return (transitions, suffix links, lengths) of the states of the suffix automaton of s"""
+    nexts = [{}]
+    links = [-1]
+    lengths = [0]
+    last = 0
+    for c in s:
+        current = len(nexts)
+        nexts.append({})
+        links.append(0)
+        lengths.append(lengths[last] + 1)
+        p = last
+        while p != -1 and not c in nexts[p]:
+            nexts[p][c] = current
+            p = links[p]
+        if p != -1:
+            q = nexts[p][c]
+            if lengths[p] + 1 == lengths[q]:
+                links[current] = q
+            else:
+                clone = len(nexts)
+                nexts.append(dict(nexts[q]))
+                links.append(links[q])
+                lengths.append(lengths[p] + 1)
+                while p != -1 and nexts[p].get(c) == q:
+                    nexts[p][c] = clone
+                    p = links[p]
+                links[q] = clone
+                links[current] = clone
+        last = current
+    return (nexts,links,lengths)
+
+# detectors compare many logged messages with the same text, the automaton of the last one is kept
+_largestCache = [None,None]
+
 def largestString (s1,s2):
     """return largest pattern available in 2 strings"""
-    # From https://en.wikibooks.org/wiki/Algorithm_Implementation/Strings/Longest_common_substring#Python2
-    # License: CC BY-SA
-    m = [[0] * (1 + len(s2)) for i in range(1 + len(s1))]
-    longest, x_longest = 0, 0
-    for x in range(1, 1 + len(s1)):
-        for y in range(1, 1 + len(s2)):
-            if s1[x - 1] == s2[y - 1]:
-                m[x][y] = m[x - 1][y - 1] + 1
-                if m[x][y] > longest:
-                    longest = m[x][y]
-                    x_longest = x
-            else:
-                m[x][y] = 0
+    # walks s1 through the suffix automaton of s2, keeps the first end in s1 of the longest match
+    # like the former dynamic programming table did
+    (cached,automaton) = _largestCache
+    if cached is None or cached != s2:
+        automaton = suffixAutomaton(s2)
+        _largestCache[:] = [s2,automaton]
+    (nexts,links,lengths) = automaton
+    state = 0
+    length = 0
+    longest = 0
+    x_longest = 0
+    for (x,c) in enumerate(s1):
+        while state and not c in nexts[state]:
+            state = links[state]
+            length = lengths[state]
+        if c in nexts[state]:
+            state = nexts[state][c]
+            length = length + 1
+        else:
+            length = 0
+        if length > longest:
+            longest = length
+            x_longest = x + 1
     return s1[x_longest - longest: x_longest]
 
+# ascii letters which also match non ascii characters when ignoring case ( kelvin sign, long s, dotless i )
+_unsafeFolds = 'IKSiks'
+_repeats = tuple(op for op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse,'POSSESSIVE_REPEAT',None)) if op is not None)
+
+def _requiredLiterals (items,icase):
+    # returns alternatives, one of them is present in any matched text, or None if nothing is mandatory
+    # literals are lowered and kept ascii only, so they can be looked up in a lowered text
+    best = None
+    run = ''
+    candidates = []
+    for (op,av) in items:
+        if op is sre_parse.LITERAL and av < 128 and not (icase and chr(av) in _unsafeFolds):
+            run = run + chr(av).lower()
+            continue
+        if len(run):
+            candidates.append([run])
+            run = ''
+        if op is sre_parse.SUBPATTERN:
+            (group,addFlags,delFlags,sub) = av
+            candidates.append(_requiredLiterals(sub,(icase or addFlags & re.IGNORECASE) and not delFlags & re.IGNORECASE))
+        elif op in _repeats and av[0] > 0:
+            candidates.append(_requiredLiterals(av[2],icase))
+        elif op is sre_parse.ASSERT:
+            candidates.append(_requiredLiterals(av[1],icase))
+        elif op is getattr(sre_parse,'ATOMIC_GROUP',None):
+            candidates.append(_requiredLiterals(av,icase))
+        elif op is sre_parse.BRANCH:
+            alternatives = []
+            for branch in av[1]:
+                found = _requiredLiterals(branch,icase)
+                if not found:
+                    alternatives = None
+                    break
+                alternatives.extend(found)
+            candidates.append(alternatives)
+    if len(run):
+        candidates.append([run])
+    for candidate in candidates:
+        # the shortest alternative is the one which will wake up the regexp the most
+        if candidate and (best is None or min(map(len,candidate)) > min(map(len,best))):
+            best = candidate
+    return best
+
+def requiredLiterals (regexp):
+    """return lowered fragments of a compiled regexp, one of them must be in the lowered text for the regexp to match, or None"""
+    try:
+        tree = sre_parse.parse(regexp.pattern,regexp.flags)
+    except:
+        return None
+    return _requiredLiterals(tree,tree.state.flags & re.IGNORECASE)
+
+_categories = dict((getattr(sre_parse,name),re.compile(r)) for (name,r) in (('CATEGORY_DIGIT',r'\d'),('CATEGORY_NOT_DIGIT',r'\D'),('CATEGORY_SPACE',r'\s'),('CATEGORY_NOT_SPACE',r'\S'),('CATEGORY_WORD',r'\w'),('CATEGORY_NOT_WORD',r'\W')))
+
+def _charMatches (op,av,c):
+    # false only when a single char item can't match c
+    if op is sre_parse.LITERAL:
+        return av == ord(c)
+    if op is sre_parse.NOT_LITERAL:
+        return av != ord(c)
+    if op is sre_parse.ANY:
+        return c != '\n'
+    if op is sre_parse.IN:
+        negate = False
+        found = False
+        for (o,a) in av:
+            if o is sre_parse.NEGATE:
+                negate = True
+            elif o is sre_parse.LITERAL:
+                found = found or a == ord(c)
+            elif o is sre_parse.RANGE:
+                found = found or a[0] <= ord(c) <= a[1]
+            elif o is sre_parse.CATEGORY and a in _categories:
+                found = found or _categories[a].match(c) is not None
+            else:
+                found = True
+        return found != negate
+    return True
+
+def _canContain (items,c):
+    for (op,av) in items:
+        if op is sre_parse.SUBPATTERN:
+            found = _canContain(av[3],c)
+        elif op in _repeats:
+            found = _canContain(av[2],c)
+        elif op is sre_parse.BRANCH:
+            found = False
+            for branch in av[1]:
+                if _canContain(branch,c):
+                    found = True
+                    break
+        elif op in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            found = False
+        else:
+            found = _charMatches(op,av,c)
+        if found:
+            return True
+    return False
+
+def _escapes (items,separators):
+    # true if one of the separators can't be consumed by items
+    for c in separators:
+        if not _canContain(items,c):
+            return True
+    return False
+
+def _separators (items):
+    # chars present in any text matched by items
+    chars = set()
+    for (op,av) in items:
+        if op is sre_parse.LITERAL:
+            chars.add(chr(av))
+        elif op is sre_parse.SUBPATTERN:
+            chars.update(_separators(av[3]))
+        elif op in _repeats and av[0] > 0:
+            chars.update(_separators(av[2]))
+    return chars
+
+def _overlaps (branches):
+    # true if two alternatives may start with the same char
+    firsts = []
+    for branch in branches:
+        if not len(branch):
+            return True
+        firsts.append(branch[0])
+    for (index,(op,av)) in enumerate(firsts):
+        for (o,a) in firsts[index+1:]:
+            if op is sre_parse.LITERAL and _charMatches(o,a,chr(av)):
+                return True
+            if o is sre_parse.LITERAL and _charMatches(op,av,chr(a)):
+                return True
+            if op is not sre_parse.LITERAL and o is not sre_parse.LITERAL:
+                return True
+    return False
+
+def _ambiguous (items,separators):
+    # looks for an item which may consume the text of the next iteration of an unbounded repeat
+    for (op,av) in items:
+        if op is sre_parse.SUBPATTERN:
+            found = _ambiguous(av[3],separators)
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[0] != av[1] and av[2].getwidth()[1] > 0:
+            found = not _escapes(av[2],separators)
+            if found:
+                found = 'nested quantifiers'
+            else:
+                found = _ambiguous(av[2],separators)
+        elif op is sre_parse.BRANCH:
+            # (a|a) is parsed as a(?:|), alternatives which may both match nothing are the same path twice
+            empty = len([branch for branch in av[1] if branch.getwidth()[0] == 0])
+            found = empty > 1 or (_overlaps(av[1]) and not _escapes([(op,av)],separators))
+            if found:
+                found = 'overlapping alternatives under a quantifier'
+            else:
+                for branch in av[1]:
+                    found = _ambiguous(branch,separators)
+                    if found:
+                        break
+        else:
+            found = False
+        if found:
+            return found
+    return False
+
+# bounded repeats of variable width bodies from this maximum are checked as unbounded ones
+_boundedRepeatMinimum = 5
+
+def _backtracking (items):
+    for (op,av) in items:
+        found = False
+        if op is sre_parse.SUBPATTERN:
+            found = _backtracking(av[3])
+        elif op is sre_parse.BRANCH:
+            for branch in av[1]:
+                found = _backtracking(branch)
+                if found:
+                    break
+        elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            found = _backtracking(av[1])
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            (mini,maxi,sub) = av
+            (low,high) = sub.getwidth()
+            if maxi == sre_parse.MAXREPEAT and high > 0:
+                found = _ambiguous(sub,_separators(sub))
+            elif maxi >= _boundedRepeatMinimum and low != high:
+                # (a+){20} tries every way to split the text in 20 parts
+                found = _ambiguous(sub,_separators(sub))
+            if not found:
+                found = _backtracking(sub)
+        if found:
+            return found
+    return False
+
+def catastrophicShape (regexp):
+    """return a description of the first exponential backtracking shape found in a compiled regexp, or None"""
+    try:
+        tree = sre_parse.parse(regexp.pattern,regexp.flags)
+    except:
+        return None
+    return _backtracking(tree) or None
+
 def floatToGMT (t):
     f = None
     try:
@@ -147,7 +575,7 @@ addConverter('getPatternAndMatcher', getPatternAndMatcher)
 
 class Ircd (object):
 
-    __slots__ = ('irc', 'channels','whowas','klines','queues','opered','defcon','pending','logs','limits','netsplit','ping','servers','resolving','stats','patterns','throttled','lastDefcon','god','mx','tokline','toklineresults','dlines', 'invites', 'nicks', 'domains', 'cleandomains', 'ilines', 'klinednicks', 'lastKlineOper')
+    __slots__ = ('irc', 'channels','whowas','klines','queues','opered','defcon','pending','logs','limits','netsplit','ping','servers','resolving','stats','patterns','matcher','triggers','hits','throttled','lastDefcon','god','mx','tokline','toklineresults','dlines', 'invites', 'nicks', 'domains', 'cleandomains', 'ilines', 'klinednicks', 'lastKlineOper', 'wheel')
 
     def __init__(self,irc):
         self.irc = irc
@@ -155,13 +583,20 @@ class Ircd (object):
         self.channels = {}
         # contains Pattern instances
         self.patterns = {}
+        # PatternSet compiled from patterns
+        self.matcher = PatternSet()
+        # [uid] = calls not yet written in database
+        self.triggers = {}
+        # [(uid,minute)] = calls not yet written in pattern_hits
+        self.hits = {}
         # contains whowas requested for a short period of time
         self.whowas = {}
         # contains klines requested for a short period of time
         self.klines = {}
-        # contains various TimeoutQueue for detection purpose
-        # often it's [host] { with various TimeOutQueue and others elements }
-        self.queues = {}
+        # expiry of buffers, klines, alerts and delayed calls
+        self.wheel = TimingWheel()
+        # StateTable of windows and timestamps for detection purpose, by kind then mask, channel, account, ...
+        self.queues = StateRegistry(self.wheel)
         # flag or time
         self.opered = False
         # flag or time
@@ -208,7 +643,13 @@ class Ircd (object):
                     regexp = True
                 else:
                     regexp = False
-                self.patterns[uid] = Pattern(uid,pattern,regexp,limit,life)
+                loaded = Pattern(uid,pattern,regexp,limit,life)
+                shape = regexp and catastrophicShape(loaded._match)
+                if shape:
+                    log.warning('Sigyn: pattern #%s not loaded, %s may backtrack exponentially (%s)' % (uid,pattern,shape))
+                    continue
+                self.patterns[uid] = loaded
+                self.matcher.add(self.patterns[uid])
         c.close()
 
     def add (self,db,prefix,pattern,limit,life,regexp):
@@ -219,22 +660,94 @@ class Ircd (object):
         c.execute("""INSERT INTO patterns VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, NULL, NULL)""", (pattern,t,limit,life,prefix,'',0,float(time.time())))
         uid = int(c.lastrowid)
         self.patterns[uid] = Pattern(uid,pattern,regexp,limit,life)
+        self.matcher.add(self.patterns[uid])
         db.commit()
         c.close()
         return uid
 
-    def count(self,db,uid):
+    def count(self,uid):
         uid = int(uid)
         if uid in self.patterns:
-            c = db.cursor()
-            c.execute("""SELECT id, triggered FROM patterns WHERE id=? LIMIT 1""",(uid,))
-            items = c.fetchall()
-            if len(items):
-                (uid,triggered) = items[0]
-                triggered = int(triggered + 1)
-                c.execute("""UPDATE patterns SET triggered=? WHERE id=?""",(triggered,uid))
-                db.commit()
-            c.close()
+            self.triggers[uid] = self.triggers.get(uid,0) + 1
+            t = int(time.time())
+            key = (uid,t - t % 60)
+            self.hits[key] = self.hits.get(key,0) + 1
+
+    def flush (self,db,days):
+        # writes pending calls and their minute/hour buckets in a single transaction, hour buckets are kept for days
+        if not len(self.triggers) and not len(self.hits):
+            return
+        (triggers,self.triggers) = (self.triggers,{})
+        (hits,self.hits) = (self.hits,{})
+        buckets = {}
+        for ((uid,minute),n) in hits.items():
+            for (span,bucket) in ((60,minute),(3600,minute - minute % 3600)):
+                buckets[(uid,span,bucket)] = buckets.get((uid,span,bucket),0) + n
+        c = db.cursor()
+        try:
+            c.execute("""BEGIN""")
+            c.executemany("""UPDATE patterns SET triggered=triggered+? WHERE id=?""",[(n,uid) for (uid,n) in triggers.items()])
+            c.executemany("""INSERT OR IGNORE INTO pattern_hits VALUES (?, ?, ?, 0)""",list(buckets.keys()))
+            c.executemany("""UPDATE pattern_hits SET hits=hits+? WHERE id=? AND span=? AND bucket=?""",[(n,uid,span,bucket) for ((uid,span,bucket),n) in buckets.items()])
+            now = int(time.time())
+            c.execute("""DELETE FROM pattern_hits WHERE span=60 AND bucket<?""",(now - 86400,))
+            c.execute("""DELETE FROM pattern_hits WHERE span=3600 AND bucket<?""",(now - days*86400 - 3600,))
+            c.execute("""COMMIT""")
+        except sqlite3.Error:
+            if db.in_transaction:
+                c.execute("""ROLLBACK""")
+            for (uid,n) in triggers.items():
+                self.triggers[uid] = self.triggers.get(uid,0) + n
+            for (key,n) in hits.items():
+                self.hits[key] = self.hits.get(key,0) + n
+        c.close()
+
+    def top (self,db,number,minutes):
+        # minutes buckets are kept for a day, hours ones for patternHitsDays
+        since = int(time.time()) - minutes*60
+        span = 60
+        if minutes > 1440:
+            span = 3600
+        c = db.cursor()
+        c.execute("""SELECT id, SUM(hits) FROM pattern_hits WHERE span=? AND bucket>? GROUP BY id""",(span,since - span))
+        items = c.fetchall()
+        c.close()
+        counts = {}
+        for (uid,hits) in items:
+            counts[uid] = hits
+        for ((uid,minute),n) in list(self.hits.items()):
+            if minute > since - 60:
+                counts[uid] = counts.get(uid,0) + n
+        results = []
+        for uid in sorted(counts,key=lambda uid: counts[uid],reverse=True):
+            if uid in self.patterns:
+                results.append((uid,self.patterns[uid].pattern,counts[uid]))
+                if len(results) == number:
+                    break
+        return results
+
+    def tracked (self,db):
+        # when calls started to be recorded in pattern_hits
+        c = db.cursor()
+        c.execute("""SELECT since FROM pattern_tracking""")
+        item = c.fetchone()
+        c.close()
+        if item:
+            return item[0]
+        return time.time()
+
+    def dead (self,db,days,tracked):
+        # active patterns older than days without calls since, tracked is the result of tracked(db)
+        since = int(time.time()) - days*86400
+        if tracked > since:
+            # patterns created before pattern_hits have no history to judge
+            return []
+        c = db.cursor()
+        c.execute("""SELECT patterns.id, patterns.pattern, MAX(pattern_hits.bucket) FROM patterns LEFT JOIN pattern_hits ON pattern_hits.id=patterns.id AND pattern_hits.span=3600 WHERE patterns.removed_at IS NULL AND patterns.at<? GROUP BY patterns.id HAVING MAX(pattern_hits.bucket) IS NULL OR MAX(pattern_hits.bucket)<? ORDER BY patterns.id""",(since,since))
+        items = c.fetchall()
+        c.close()
+        pending = set([uid for (uid,minute) in list(self.hits.keys())])
+        return [item for item in items if not item[0] in pending]
 
     def ls (self,db,pattern,deep=False):
         c = db.cursor()
@@ -258,6 +771,7 @@ class Ircd (object):
             results = []
             for item in items:
                 (uid,pattern,regexp,operator,at,triggered,removed_at,removed_by,comment,limit,life) = item
+                triggered = triggered + self.triggers.get(uid,0)
                 end = ''
                 if i:
                     if removed_by:
@@ -266,6 +780,8 @@ class Ircd (object):
                     reg = 'not case sensitive'
                     if regexp == 1:
                         reg = 'regexp pattern'
+                        if uid in self.patterns and self.patterns[uid].calls:
+                            reg = '%s, %.3fms average on %s runs' % (reg,self.patterns[uid].elapsed*1000/self.patterns[uid].calls,self.patterns[uid].calls)
                     results.append('#%s "%s" by %s on %s (%s calls) %s/%ss%s %s - %s' % (uid,pattern,operator.split('!')[0],floatToGMT(at),triggered,limit,life,end,comment,reg))
                 else:
                     if removed_by:
@@ -274,6 +790,16 @@ class Ircd (object):
             return results
         return []
 
+    def shape (self,db,uid):
+        # catastrophicShape of stored regexp pattern #uid, or None
+        c = db.cursor()
+        c.execute("""SELECT pattern, regexp FROM patterns WHERE id=? LIMIT 1""",(int(uid),))
+        item = c.fetchone()
+        c.close()
+        if item and int(item[1]) == 1:
+            return catastrophicShape(utils.str.perlReToPythonRe(item[0]))
+        return None
+
     def edit (self,db,uid,limit,life,comment):
         c = db.cursor()
         uid = int(uid)
@@ -304,10 +830,12 @@ class Ircd (object):
             if active and removed_at:
                 c.execute("""UPDATE patterns SET removed_at=NULL, removed_by=NULL WHERE id=? LIMIT 1""",(uid,))
                 self.patterns[uid] = Pattern(uid,pattern,regexp == 1,limit,life)
+                self.matcher.add(self.patterns[uid])
                 updated = True
             elif not removed_at and not active:
                 c.execute("""UPDATE patterns SET removed_at=?, removed_by=? WHERE id=? LIMIT 1""",(float(time.time()),prefix,uid))
                 if uid in self.patterns:
+                    self.matcher.remove(self.patterns[uid])
                     del self.patterns[uid]
                 updated = True
             db.commit()
@@ -325,6 +853,7 @@ class Ircd (object):
             c.execute("""DELETE FROM patterns WHERE id=? LIMIT 1""",(uid,))
             if not removed_at:
                 if uid in self.patterns:
+                    self.matcher.remove(self.patterns[uid])
                     del self.patterns[uid]
             updated = True
             db.commit()
@@ -332,9 +861,10 @@ class Ircd (object):
         return updated
 
 class Chan (object):
-    __slots__ = ('channel', 'patterns', 'buffers', 'logs', 'nicks', 'called', 'klines', 'requestedBySpam')
+    __slots__ = ('channel', 'patterns', 'buffers', 'logs', 'nicks', 'called', 'klines', 'requestedBySpam', 'hilights')
     def __init__(self,channel):
         self.channel = channel
+        self.hilights = ChannelNicks()
         self.patterns = None
         self.buffers = {}
         self.logs = {}
@@ -347,14 +877,323 @@ class Chan (object):
         return '%s(channel=%r, patterns=%r, buffers=%r, logs=%r, nicks=%r)' % (self.__class__.__name__,
         self.channel, self.patterns, self.buffers, self.logs, self.nicks)
 
+def channelValueNames ():
+    # channel specific values of config.py, lastActionTaken is state rather than configuration
+    group = conf.supybot.plugins.Sigyn
+    return tuple(sorted(name for (name,value) in group.getValues(fullNames=False) if value._channelValue and name != 'lastActionTaken'))
+
+class ChannelPolicy (object):
+    """channel specific values of config.py resolved once for a channel, read-only, see Sigyn.getPolicy"""
+    __slots__ = ('channel', 'generation', 'sources') + channelValueNames()
+    def __init__(self,channel,generation):
+        group = conf.supybot.plugins.Sigyn
+        sources = []
+        for name in self.__slots__[3:]:
+            value = group.get(name).getSpecific(channel=channel)
+            sources.append(value)
+            object.__setattr__(self,name,value())
+        object.__setattr__(self,'channel',channel)
+        object.__setattr__(self,'generation',generation)
+        object.__setattr__(self,'sources',tuple(sources))
+
+    def __setattr__(self,name,value):
+        raise AttributeError('%s is read-only' % self.__class__.__name__)
+
+    def __repr__(self):
+        return '%s(channel=%r, generation=%r)' % (self.__class__.__name__,self.channel,self.generation)
+
+class CapabilityCache (object):
+    """ircdb.checkCapability results of the detector chain as a bitmask per hostmask and channel,
+    least recently used hostmasks are dropped past size, everything is dropped when ircdb or capabilities config change"""
+    __slots__ = ('size', 'entries', 'stamp', 'stale', 'hits', 'misses')
+    names = ('protected', 'pattern', 'badunicode', 'hilight', 'massRepeat', 'lowMassRepeat', 'repeat', 'lowRepeat',
+        'lowHilight', 'flood', 'lowFlood', 'ctcp', 'notice', 'cap')
+    bits = dict((name,1 << index) for (index,name) in enumerate(names))
+
+    def __init__(self,size):
+        self.size = size
+        # [prefix] = {channel: bitmask}, channel None holds the global protected capability
+        self.entries = {}
+        self.stamp = self.getStamp()
+        # set by expire, the next refresh drops everything again
+        self.stale = False
+        self.hits = 0
+        self.misses = 0
+
+    def getStamp(self):
+        # ircdb commands flush users and channels databases on change
+        stamp = []
+        for db in (ircdb.users, ircdb.channels):
+            filename = getattr(db,'filename',None)
+            try:
+                stamp.append(os.stat(filename).st_mtime_ns)
+            except (OSError, TypeError):
+                stamp.append(None)
+        return tuple(stamp)
+
+    def get(self,prefix,channel):
+        channels = self.entries.pop(prefix,None)
+        if channels is None:
+            channels = {}
+        # re-inserted as most recently used
+        self.entries[prefix] = channels
+        mask = channels.get(channel)
+        if mask is not None:
+            self.hits = self.hits + 1
+            return mask
+        self.misses = self.misses + 1
+        mask = 0
+        names = self.names
+        if channel is None:
+            names = ('protected',)
+        for name in names:
+            capability = name
+            if channel is not None:
+                capability = ircdb.makeChannelCapability(channel,name)
+            if ircdb.checkCapability(prefix,capability):
+                mask = mask | self.bits[name]
+        channels[channel] = mask
+        while len(self.entries) > self.size:
+            del self.entries[next(iter(self.entries))]
+        return mask
+
+    def check(self,prefix,channel,name):
+        return bool(self.get(prefix,channel) & self.bits[name])
+
+    def discard(self,prefix):
+        self.entries.pop(prefix,None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def expire(self):
+        # ircdb may be changed in memory only, by a command still running
+        self.clear()
+        self.stale = True
+
+    def refresh(self):
+        stamp = self.getStamp()
+        if stamp != self.stamp or self.stale:
+            self.stamp = stamp
+            self.stale = False
+            self.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return '%s(size=%r, entries=%r, hits=%r, misses=%r)' % (self.__class__.__name__,self.size,len(self.entries),self.hits,self.misses)
+
+class Detector (object):
+    """a channel detector of handleMsg, rank is its priority when several trigger, lower wins"""
+    __slots__ = ('name', 'rank', 'method', 'publicreason', 'switches', 'context', 'only', 'skippable', 'fallback')
+    def __init__(self,name,rank,method,publicreason,switches=(),context=False,only=None,skippable=True,fallback=False):
+        self.name = name
+        self.rank = rank
+        self.method = method
+        self.publicreason = publicreason
+        # (value, minimum) of ChannelPolicy the detector needs to do anything
+        self.switches = switches
+        # method wants the MessageContext rather than the text
+        self.context = context
+        # 'ctcp' or 'notice' when only such messages are checked
+        self.only = only
+        # may be skipped once a better ranked detector decided a kline, when the channel has no abuse windows
+        # its isBadOnChannel state is only about the mask
+        self.skippable = skippable
+        # only runs when no better ranked detector triggered
+        self.fallback = fallback
+
+    def enabled(self,policy):
+        for (name,minimum) in self.switches:
+            if getattr(policy,name) < minimum:
+                return False
+        return True
+
+    def run(self,sig,irc,msg,channel,mask,context,isNotice):
+        if self.only == 'ctcp' and (ircmsgs.isAction(msg) or not ircmsgs.isCtcp(msg)):
+            return False
+        if self.only == 'notice' and (ircmsgs.isAction(msg) or not isNotice):
+            return False
+        if self.context:
+            return getattr(sig,self.method)(irc,msg,channel,mask,context)
+        return getattr(sig,self.method)(irc,msg,channel,mask,context.text)
+
+    def __repr__(self):
+        return '%s(name=%r, rank=%r)' % (self.__class__.__name__,self.name,self.rank)
+
+# linkspam, rank 2, is decided before the detectors, when joinSpamPart buffers are filled
+_linkspamRank = 2
+# repeats feed channel wide windows and computed patterns, they always run
+_detectors = (
+    Detector('hilight',0,'isChannelHilight','nicks/hilight spam',(('hilightNick',0),('hilightPermit',0))),
+    Detector('badunicode',1,'isChannelUnicode','unreadable unicode glyphes',(('badunicodeLimit',1),('badunicodePermit',0)),context=True),
+    Detector('tmpPattern',3,'isChannelTmpPattern','your sentence matches temporary blacklisted words',skippable=False,fallback=True),
+    Detector('massRepeat',4,'isChannelMassRepeat','repetition detected',(('massRepeatPermit',0),),context=True,skippable=False),
+    Detector('lowMassRepeat',5,'isChannelLowMassRepeat','repetition detected',(('lowMassRepeatPermit',0),),context=True,skippable=False),
+    Detector('repeat',6,'isChannelRepeat','repetition detected',(('repeatPermit',0),),context=True,skippable=False),
+    Detector('lowRepeat',7,'isChannelLowRepeat','repetition detected',(('lowRepeatPermit',0),),context=True,skippable=False),
+    Detector('lowHilight',8,'isChannelLowHilight','nicks/hilight spam',(('lowHilightNick',0),('lowHilightPermit',0))),
+    Detector('cap',9,'isChannelCap','uppercase detected',(('capPermit',0),),context=True),
+    Detector('flood',10,'isChannelFlood','flood detected',(('floodPermit',0),),context=True),
+    Detector('lowFlood',11,'isChannelLowFlood','flood detected',(('lowFloodPermit',0),)),
+    Detector('ctcp',12,'isChannelCtcp','channel CTCP',(('ctcpPermit',0),),only='ctcp'),
+    Detector('notice',13,'isChannelNotice','channel notice',(('noticePermit',0),),only='notice'),
+)
+
+class DetectorStats (object):
+    __slots__ = ('calls', 'triggers', 'skipped', 'cpu')
+    def __init__(self):
+        self.calls = 0
+        self.triggers = 0
+        self.skipped = 0
+        self.cpu = 0.0
+
+    def cost(self):
+        if not self.calls:
+            return 0.0
+        return self.cpu / self.calls
+
+    def __repr__(self):
+        return '%s(calls=%r, triggers=%r, skipped=%r, cpu=%r)' % (self.__class__.__name__,self.calls,self.triggers,self.skipped,self.cpu)
+
+class DetectorPipeline (object):
+    """detectors enabled by a ChannelPolicy, cheapest first by measured cost, see Sigyn.getPipeline"""
+    __slots__ = ('channel', 'generation', 'detectors', 'abuse')
+    def __init__(self,channel,generation,policy,stats):
+        self.channel = channel
+        self.generation = generation
+        # detectors which trigger feed isAbuseOnChannel, none may be skipped
+        self.abuse = policy.abusePermit > -1
+        detectors = [detector for detector in _detectors if detector.enabled(policy)]
+        detectors.sort(key=lambda detector: (stats[detector.name].cost(),detector.rank))
+        for detector in [detector for detector in detectors if detector.fallback]:
+            detectors.remove(detector)
+            index = 0
+            for (n,other) in enumerate(detectors):
+                if other.rank < detector.rank:
+                    index = n + 1
+            detectors.insert(index,detector)
+        self.detectors = tuple(detectors)
+
+    def decided(self,best,done):
+        # no detector able to give a better reason is left, and the others would not escalate the channel
+        if self.abuse:
+            return False
+        for detector in self.detectors:
+            if detector.rank < best and not detector.name in done:
+                return False
+        return True
+
+    def __repr__(self):
+        return '%s(channel=%r, detectors=%r)' % (self.__class__.__name__,self.channel,[detector.name for detector in self.detectors])
+
+class ChannelNicks (object):
+    """lowercased nicks of a channel's users, those present in a message are found in one pass by an Automaton, see isHilight;
+    kept up to date by joins, parts, kicks, quits, nick changes and who replies, resynced when the channel's size differs"""
+    __slots__ = ('nicks', 'words', 'automaton', 'built', 'added', 'stale')
+    # below, words are searched one by one, which is cheaper than a python walk of the message
+    automatonMinimum = 256
+    def __init__(self):
+        # [nick] = lowercased nick, None for ChanServ and nicks of 3 chars or less, which are not counted
+        self.nicks = {}
+        # [word] = number of nicks lowercased as word
+        self.words = {}
+        self.automaton = None
+        # words of the automaton, words added since, words of the automaton gone since
+        self.built = frozenset()
+        self.added = set()
+        self.stale = 0
+
+    def add (self,nick):
+        if nick in self.nicks:
+            return
+        word = None
+        if nick != 'ChanServ' and len(nick) > 3:
+            word = nick.lower()
+            self.words[word] = self.words.get(word,0) + 1
+            if not word in self.built:
+                self.added.add(word)
+        self.nicks[nick] = word
+
+    def discard (self,nick):
+        word = self.nicks.pop(nick,None)
+        if word is None:
+            return
+        self.words[word] = self.words[word] - 1
+        if not self.words[word]:
+            del self.words[word]
+            if word in self.built:
+                self.stale = self.stale + 1
+            else:
+                self.added.discard(word)
+
+    def rename (self,old,new):
+        if old in self.nicks:
+            self.discard(old)
+            self.add(new)
+
+    def sync (self,users):
+        if len(users) != len(self.nicks):
+            self.nicks = {}
+            self.words = {}
+            self.automaton = None
+            self.built = frozenset()
+            self.added = set()
+            self.stale = 0
+            for nick in users:
+                self.add(nick)
+
+    def build (self):
+        automaton = Automaton()
+        for word in self.words:
+            automaton.add(word,word)
+        automaton.build()
+        self.automaton = automaton
+        self.built = frozenset(self.words)
+        self.added = set()
+        self.stale = 0
+
+    def search (self,text):
+        # lowercased nicks present in text
+        words = self.words
+        if len(words) < self.automatonMinimum:
+            return [word for word in words if word in text]
+        if self.automaton is None or len(self.added) + self.stale > max(64,len(words) >> 3):
+            self.build()
+        found = [word for word in self.automaton.search(text) if word in words]
+        for word in self.added:
+            if word in text:
+                found.append(word)
+        return found
+
+    def count (self,text,sender):
+        # distinct nicks present in text, but sender's
+        found = self.search(text)
+        word = self.nicks.get(sender)
+        if word is not None and word in found and self.words[word] == 1:
+            return len(found) - 1
+        return len(found)
+
+    def __len__(self):
+        return len(self.nicks)
+
+    def __repr__(self):
+        return '%s(nicks=%r, words=%r, added=%r, stale=%r)' % (self.__class__.__name__,len(self.nicks),len(self.words),len(self.added),self.stale)
+
 class Pattern (object):
-    __slots__ = ('uid', 'pattern', 'limit', 'life', '_match')
+    __slots__ = ('uid', 'pattern', 'limit', 'life', '_match', 'calls', 'elapsed', 'overruns', 'struck')
     def __init__(self,uid,pattern,regexp,limit,life):
         self.uid = uid
         self.pattern = pattern
         self.limit = limit
         self.life = life
         self._match = False
+        # regexp runs, cpu seconds spent in them, and runs over regexpBudget since struck
+        self.calls = 0
+        self.elapsed = 0.0
+        self.overruns = 0
+        self.struck = 0
         if regexp:
             self._match = utils.str.perlReToPythonRe(pattern)
         else:
@@ -375,6 +1214,727 @@ class Pattern (object):
         return '%s(uid=%r, pattern=%r, limit=%r, life=%r, _match=%r)' % (self.__class__.__name__,
         self.uid, self.pattern, self.limit, self.life, self._match)
 
+class Automaton (object):
+    """Aho-Corasick automaton, finds keys of every stored word present in a text in a single pass"""
+    __slots__ = ('goto', 'fail', 'keys', 'out', 'dirty')
+    def __init__(self):
+        # node 0 is the root, each node has its transitions, its failure link,
+        # keys of words ending on it, and keys of every word ending on it or on its failure chain
+        self.goto = [{}]
+        self.fail = [0]
+        self.keys = [None]
+        self.out = [None]
+        self.dirty = False
+
+    def add (self,word,key):
+        node = 0
+        for c in word:
+            n = self.goto[node].get(c)
+            if n is None:
+                n = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.keys.append(None)
+                self.out.append(None)
+                self.goto[node][c] = n
+            node = n
+        if self.keys[node] is None:
+            self.keys[node] = set()
+        self.keys[node].add(key)
+        self.dirty = True
+
+    def discard (self,word,key):
+        node = 0
+        for c in word:
+            node = self.goto[node].get(c)
+            if node is None:
+                return
+        if self.keys[node] and key in self.keys[node]:
+            self.keys[node].discard(key)
+            if not len(self.keys[node]):
+                self.keys[node] = None
+            self.dirty = True
+
+    def copy (self):
+        # independent automaton with the same words, to build while this one keeps changing
+        automaton = Automaton()
+        automaton.goto = [dict(transitions) for transitions in self.goto]
+        automaton.fail = list(self.fail)
+        automaton.keys = [keys and set(keys) for keys in self.keys]
+        automaton.out = list(self.out)
+        automaton.dirty = self.dirty
+        return automaton
+
+    def build (self):
+        # breadth first walk, failure links and outputs only depend on shallower nodes
+        goto = self.goto
+        fail = self.fail
+        keys = self.keys
+        out = self.out
+        out[0] = None
+        queue = []
+        for n in goto[0].values():
+            fail[n] = 0
+            queue.append(n)
+        index = 0
+        while index < len(queue):
+            node = queue[index]
+            index = index + 1
+            if keys[node] and out[fail[node]]:
+                out[node] = tuple(keys[node]) + out[fail[node]]
+            elif keys[node]:
+                out[node] = tuple(keys[node])
+            else:
+                out[node] = out[fail[node]]
+            for (c,n) in goto[node].items():
+                f = fail[node]
+                while f and not c in goto[f]:
+                    f = fail[f]
+                fail[n] = goto[f].get(c,0)
+                queue.append(n)
+        self.dirty = False
+
+    def search (self,text):
+        if self.dirty:
+            self.build()
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        found = set()
+        if self.keys[0]:
+            found.update(self.keys[0])
+        node = 0
+        for c in text:
+            n = goto[node].get(c)
+            while n is None and node:
+                node = fail[node]
+                n = goto[node].get(c)
+            if n is None:
+                continue
+            node = n
+            if out[node]:
+                found.update(out[node])
+        return found
+
+    def __len__(self):
+        return len(self.goto)
+
+# runs over regexpBudget within _regexpStrikeWindow seconds before a regexp is disabled
+_regexpStrikes = 3
+_regexpStrikeWindow = 3600
+
+class PatternSet (object):
+    """permanent patterns compiled together, literals share one automaton, regexps are woken up by their required literals"""
+    __slots__ = ('literals', 'searcher', 'regexps', 'unfiltered', 'fragments', 'slow', 'lock')
+    def __init__(self):
+        # literal patterns are stored under their uid, required literals of regexps under -uid,
+        # literals is only changed under lock, searcher is a built copy of it swapped in whole
+        self.literals = Automaton()
+        self.searcher = Automaton()
+        self.regexps = {}
+        self.unfiltered = {}
+        self.fragments = {}
+        # [uid] = cpu seconds spent by a regexp on the latest text over budget, once it happened _regexpStrikes times
+        self.slow = {}
+        self.lock = threading.Lock()
+
+    def add (self,pattern):
+        with self.lock:
+            if pattern._match:
+                self.regexps[pattern.uid] = pattern
+                fragments = requiredLiterals(pattern._match)
+                if fragments:
+                    self.fragments[pattern.uid] = fragments
+                    for fragment in fragments:
+                        self.literals.add(fragment,-pattern.uid)
+                else:
+                    self.unfiltered[pattern.uid] = pattern
+            else:
+                self.literals.add(pattern.pattern,pattern.uid)
+
+    def remove (self,pattern):
+        with self.lock:
+            if pattern._match:
+                if pattern.uid in self.regexps:
+                    del self.regexps[pattern.uid]
+                if pattern.uid in self.unfiltered:
+                    del self.unfiltered[pattern.uid]
+                if pattern.uid in self.fragments:
+                    for fragment in self.fragments[pattern.uid]:
+                        self.literals.discard(fragment,-pattern.uid)
+                    del self.fragments[pattern.uid]
+            else:
+                self.literals.discard(pattern.pattern,pattern.uid)
+
+    def run (self,pattern,text,budget):
+        # cpu time of this thread, waits for the GIL or the scheduler are not the regexp's;
+        # it is only known once the regexp returned, a catastrophic one still stalls the bot that long
+        start = time.thread_time()
+        found = pattern.match(text)
+        elapsed = time.thread_time() - start
+        pattern.calls = pattern.calls + 1
+        pattern.elapsed = pattern.elapsed + elapsed
+        if budget > 0 and elapsed > budget:
+            now = time.time()
+            if not pattern.overruns or now - pattern.struck > _regexpStrikeWindow:
+                pattern.overruns = 0
+                pattern.struck = now
+            pattern.overruns = pattern.overruns + 1
+            if pattern.overruns >= _regexpStrikes:
+                self.slow[pattern.uid] = elapsed
+        return found
+
+    def match (self,text,budget=0):
+        # returns uids of all patterns matching text, in ascending order
+        if isinstance(text,bytes):
+            text = str(text, "utf-8")
+        if self.literals.dirty:
+            with self.lock:
+                if self.literals.dirty:
+                    searcher = self.literals.copy()
+                    searcher.build()
+                    self.literals.dirty = False
+                    self.searcher = searcher
+        uids = set()
+        for key in self.searcher.search(text.lower()):
+            if key > 0:
+                uids.add(key)
+            else:
+                pattern = self.regexps.get(-key)
+                if pattern and self.run(pattern,text,budget):
+                    uids.add(pattern.uid)
+        for pattern in list(self.unfiltered.values()):
+            if self.run(pattern,text,budget):
+                uids.add(pattern.uid)
+        return sorted(uids)
+
+    def __repr__(self):
+        return '%s(literals=%r, regexps=%r, unfiltered=%r)' % (self.__class__.__name__,
+        len(self.literals), len(self.regexps), len(self.unfiltered))
+
+class SlidingWindowCounter (object):
+    """number of events during the last timeout seconds, a TimeoutQueue which only keeps timestamps"""
+    __slots__ = ('timeout', 'times', 'start', 'count')
+    def __init__(self,timeout):
+        self.timeout = timeout
+        # ring of timestamps, the oldest one at start
+        self.times = array.array('d',[0.0]) * 4
+        self.start = 0
+        self.count = 0
+
+    def _getTimeout(self):
+        if callable(self.timeout):
+            return self.timeout()
+        return self.timeout
+
+    def setTimeout(self,timeout):
+        self.timeout = timeout
+
+    def _clearOldElements(self):
+        now = time.time()
+        timeout = self._getTimeout()
+        while self.count and now - self.times[self.start] > timeout:
+            self.start = (self.start + 1) % len(self.times)
+            self.count = self.count - 1
+
+    def reset(self):
+        self.times = array.array('d',[0.0]) * 4
+        self.start = 0
+        self.count = 0
+
+    def enqueue(self,elt=None,at=None):
+        # elt is ignored, like TimeoutQueue.enqueue(key) then len() did
+        if at is None:
+            at = time.time()
+        if self.count == len(self.times):
+            self._clearOldElements()
+        if self.count == len(self.times):
+            times = self.times[self.start:] + self.times[:self.start]
+            self.times = times + array.array('d',[0.0]) * len(times)
+            self.start = 0
+        self.times[(self.start + self.count) % len(self.times)] = at
+        self.count = self.count + 1
+
+    def __len__(self):
+        self._clearOldElements()
+        return self.count
+
+    def __repr__(self):
+        return '%s(timeout=%r, count=%r)' % (self.__class__.__name__,self.timeout,len(self))
+
+class ChannelBuffer (object):
+    """window of a channel buffer and when it was created, dropped together once the window is empty and ignoreDuration is over"""
+    __slots__ = ('window', 'created')
+    def __init__(self,window,created=None):
+        if created is None:
+            created = time.time()
+        self.window = window
+        self.created = created
+
+    def _getTimeout(self):
+        return self.window._getTimeout()
+
+    def enqueue(self,elt=None):
+        self.window.enqueue(elt)
+
+    def reset(self):
+        self.window.reset()
+
+    def __iter__(self):
+        return iter(self.window)
+
+    def __len__(self):
+        return len(self.window)
+
+    def __repr__(self):
+        return '%s(window=%r, created=%r)' % (self.__class__.__name__,self.window,self.created)
+
+class TimingWheel (object):
+    """hierarchical timing wheel, callbacks scheduled at a given time are run by advance() during the next tick after it"""
+    __slots__ = ('resolution', 'size', 'levels', 'tick', 'count')
+    def __init__(self,resolution=1.0,size=64,depth=4,now=None):
+        if now is None:
+            now = time.time()
+        self.resolution = resolution
+        self.size = size
+        # levels[l][s] holds (tick,callback), a slot of level l spans size**l ticks
+        self.levels = [[[] for s in range(size)] for l in range(depth)]
+        self.tick = int(now // resolution)
+        self.count = 0
+
+    def _insert(self,tick,callback):
+        delta = tick - self.tick
+        span = 1
+        for level in self.levels:
+            if delta < span * self.size or level is self.levels[-1]:
+                break
+            span = span * self.size
+        if delta >= span * self.size:
+            # beyond the wheel, parked in the last slot of the top level and cascaded again later
+            level[(self.tick // span - 1) % self.size].append((tick,callback))
+        else:
+            level[(tick // span) % self.size].append((tick,callback))
+
+    def schedule(self,callback,at):
+        self._insert(max(int(at // self.resolution) + 1,self.tick + 1),callback)
+        self.count = self.count + 1
+
+    def _cascade(self,l):
+        span = self.size ** l
+        if l + 1 < len(self.levels) and not (self.tick // span) % self.size:
+            self._cascade(l + 1)
+        slots = self.levels[l]
+        k = (self.tick // span) % self.size
+        (entries, slots[k]) = (slots[k], [])
+        for (tick,callback) in entries:
+            self._insert(tick,callback)
+
+    def advance(self,now=None):
+        if now is None:
+            now = time.time()
+        target = int(now // self.resolution)
+        while self.tick < target:
+            self.tick = self.tick + 1
+            if len(self.levels) > 1 and not self.tick % self.size:
+                self._cascade(1)
+            slots = self.levels[0]
+            k = self.tick % self.size
+            (entries, slots[k]) = (slots[k], [])
+            self.count = self.count - len(entries)
+            for (tick,callback) in entries:
+                try:
+                    callback()
+                except Exception:
+                    log.exception('Uncaught exception in timing wheel callback %r' % callback)
+
+    def __len__(self):
+        return self.count
+
+    def __repr__(self):
+        return '%s(resolution=%r, pending=%r)' % (self.__class__.__name__,self.resolution,self.count)
+
+def deepSize (value):
+    # bytes held by value and what it references, each object counted once, code and classes are ignored
+    seen = set()
+    size = 0
+    stack = [value]
+    while len(stack):
+        value = stack.pop()
+        if id(value) in seen or isinstance(value,(type,types.ModuleType,types.FunctionType,types.MethodType,types.BuiltinFunctionType)):
+            continue
+        seen.add(id(value))
+        size += sys.getsizeof(value)
+        if isinstance(value,(str,bytes,int,float,bool)) or value is None:
+            continue
+        if isinstance(value,dict):
+            stack.extend(list(value.items()))
+        elif isinstance(value,(list,tuple,set,frozenset)):
+            stack.extend(list(value))
+        else:
+            for cls in type(value).__mro__:
+                slots = getattr(cls,'__slots__',())
+                if isinstance(slots,str):
+                    slots = (slots,)
+                for name in slots:
+                    stack.append(getattr(value,name,None))
+            if hasattr(value,'__dict__'):
+                stack.append(value.__dict__)
+    return size
+
+class StateTable (object):
+    """entries of one kind of state, keyed by mask, channel, account, ..., dropped by the timing wheel:
+    windows built by factory once empty, timestamps when factory is None after their life"""
+    __slots__ = ('name', 'factory', 'wheel', 'entries', 'owned', 'created', 'expired')
+    def __init__(self,name,factory,wheel):
+        self.name = name
+        self.factory = factory
+        self.wheel = wheel
+        self.entries = {}
+        # [mask] = keys of entries keyed by (mask, something), to forget them without a scan
+        self.owned = {}
+        self.created = 0
+        self.expired = 0
+
+    def _own(self,key):
+        if isinstance(key,tuple):
+            if not key[0] in self.owned:
+                self.owned[key[0]] = set()
+            self.owned[key[0]].add(key)
+
+    def _disown(self,key):
+        if isinstance(key,tuple) and key[0] in self.owned:
+            keys = self.owned[key[0]]
+            keys.discard(key)
+            if not len(keys):
+                del self.owned[key[0]]
+
+    def _drop(self,key,value):
+        if self.entries.get(key) is value:
+            del self.entries[key]
+            self._disown(key)
+            self.expired = self.expired + 1
+
+    def get(self,key,life):
+        # window for key, created if needed
+        entries = self.entries
+        if key in entries:
+            window = entries[key]
+            if window.timeout != life:
+                window.setTimeout(life)
+            return window
+        window = entries[key] = self.factory(life)
+        self._own(key)
+        self.created = self.created + 1
+        def expire ():
+            if len(window):
+                self.wheel.schedule(expire,time.time()+window._getTimeout())
+            else:
+                self._drop(key,window)
+        self.wheel.schedule(expire,time.time()+life)
+        return window
+
+    def mark(self,key,life):
+        # timestamp for key, forgotten after life seconds
+        now = time.time()
+        self.entries[key] = now
+        self._own(key)
+        self.created = self.created + 1
+        self.wheel.schedule(lambda: self._drop(key,now),now+life)
+
+    def pop(self,key):
+        value = self.entries.pop(key,None)
+        if value is not None:
+            if not self.factory is None:
+                value.reset()
+            self._disown(key)
+            self.expired = self.expired + 1
+        return value
+
+    def discard(self,owner):
+        # forgets owner and every (owner, something) entry
+        self.pop(owner)
+        for key in list(self.owned.get(owner,())):
+            self.pop(key)
+
+    def size(self):
+        return deepSize((self.entries,self.owned))
+
+    def __contains__(self,key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return '%s(name=%r, entries=%r, created=%r, expired=%r)' % (self.__class__.__name__,self.name,len(self.entries),self.created,self.expired)
+
+class StateRegistry (object):
+    """Ircd's StateTable by name"""
+    __slots__ = ('wheel', 'tables')
+    def __init__(self,wheel):
+        self.wheel = wheel
+        self.tables = {}
+
+    def table(self,name,factory=None):
+        if not name in self.tables:
+            self.tables[name] = StateTable(name,factory,self.wheel)
+        return self.tables[name]
+
+    def discard(self,key):
+        # forgets key and the entries keyed by (key, something) in every table
+        for table in self.tables.values():
+            table.discard(key)
+
+    def size(self):
+        # the wheel is shared with the other structures of Ircd, not counted here
+        return sum(table.size() for table in self.tables.values())
+
+    def keys(self):
+        keys = set()
+        for table in self.tables.values():
+            keys.update(table.entries)
+        return keys
+
+    def __iter__(self):
+        return iter(sorted(self.tables.values(),key=lambda table: table.name))
+
+    def __len__(self):
+        return sum(len(table) for table in self.tables.values())
+
+    def __repr__(self):
+        return '%s(tables=%r)' % (self.__class__.__name__,sorted(self.tables.values(),key=lambda table: table.name))
+
+class MessageWindow (utils.structures.TimeoutQueue):
+    """TimeoutQueue of (text, fingerprint), with a presence matrix of their ascii characters when numpy is available,
+    and optionally a minhash index of them when they are too many to be scanned"""
+    __slots__ = ('rows', 'sizes', 'first', 'last', 'buckets', 'dropped', 'sweep')
+    # below this number of messages, the python loop is faster ( see benchmark.py --windows )
+    vectorMinimum = 32
+    # from this number of messages, only candidates given by the index are compared, None to never build it,
+    # set from windowIndexMinimum by Sigyn.setWindowIndex: it misses some similar texts and is not faster than numpy
+    indexMinimum = None
+    # without numpy, the index is faster than the python loop from this number of messages ( see benchmark.py --windows )
+    indexDefault = 256
+    def __init__(self,timeout):
+        utils.structures.TimeoutQueue.__init__(self,timeout)
+        self.rows = None
+        self.sizes = None
+        # rows of the queued messages are rows[first:last]
+        self.first = 0
+        self.last = 0
+        # band of a signature -> serials of messages, the queued ones are from dropped
+        self.buckets = None
+        self.dropped = 0
+        self.sweep = 0
+
+    def reset(self):
+        self.dropped = self.dropped + len(self.queue)
+        utils.structures.TimeoutQueue.reset(self)
+        self.first = 0
+        self.last = 0
+        self.buckets = None
+
+    def _clearOldElements(self):
+        n = len(self.queue)
+        utils.structures.TimeoutQueue._clearOldElements(self)
+        self.first = self.first + n - len(self.queue)
+        self.dropped = self.dropped + n - len(self.queue)
+
+    def dequeue(self):
+        elt = utils.structures.TimeoutQueue.dequeue(self)
+        self.first = self.first + 1
+        self.dropped = self.dropped + 1
+        return elt
+
+    def _index(self,serial,text):
+        for key in minHashBands(text):
+            if key in self.buckets:
+                self.buckets[key].append(serial)
+            else:
+                self.buckets[key] = [serial]
+        if len(self.buckets) > self.sweep:
+            # buckets of expired messages are only emptied when looked up
+            buckets = {}
+            for (key,serials) in self.buckets.items():
+                serials = [serial for serial in serials if serial >= self.dropped]
+                if len(serials):
+                    buckets[key] = serials
+            self.buckets = buckets
+            self.sweep = 2 * len(buckets) + 1024
+
+    def enqueue(self,elt,at=None):
+        utils.structures.TimeoutQueue.enqueue(self,elt,at)
+        (text,bits) = elt
+        if self.buckets is not None:
+            self._index(self.dropped + len(self.queue) - 1,text)
+        if numpy is None:
+            return
+        if self.rows is None:
+            self.rows = numpy.zeros((64,128),dtype=numpy.uint8)
+            self.sizes = numpy.zeros(64,dtype=numpy.int32)
+        if self.last == len(self.rows):
+            # moves rows still queued at the beginning, with at least half of the rows free
+            n = self.last - self.first
+            size = 64
+            while size < n * 2:
+                size = size * 2
+            if size != len(self.rows):
+                rows = numpy.zeros((size,128),dtype=numpy.uint8)
+                sizes = numpy.zeros(size,dtype=numpy.int32)
+            else:
+                (rows,sizes) = (self.rows,self.sizes)
+            rows[:n] = self.rows[self.first:self.last]
+            sizes[:n] = self.sizes[self.first:self.last]
+            (self.rows,self.sizes,self.first,self.last) = (rows,sizes,0,n)
+        if isinstance(bits,int):
+            self.sizes[self.last] = _popcount(bits)
+        else:
+            self.sizes[self.last] = len(bits)
+            ascii = 0
+            for c in bits:
+                if ord(c) < 128:
+                    ascii = ascii | (1 << ord(c))
+            bits = ascii
+        self.rows[self.last] = numpy.unpackbits(numpy.frombuffer(bits.to_bytes(16,'little'),dtype=numpy.uint8),bitorder='little')
+        self.last = self.last + 1
+
+    def candidates (self,text):
+        """return serials of queued messages which share a band of their minhash with text, oldest first"""
+        serials = set()
+        for key in minHashBands(text):
+            if key in self.buckets:
+                bucket = self.buckets[key]
+                n = 0
+                while n < len(bucket) and bucket[n] < self.dropped:
+                    n = n + 1
+                if n:
+                    del bucket[:n]
+                serials.update(bucket)
+        return sorted(serials)
+
+    def _scores (self,bits,positions=None):
+        # jaccard similarities of an ascii fingerprint with the queued messages at positions, or all of them
+        # only ascii characters of logged messages may be in an ascii text
+        query = numpy.unpackbits(numpy.frombuffer(bits.to_bytes(16,'little'),dtype=numpy.uint8),bitorder='little')
+        rows = self.rows[self.first:self.last]
+        sizes = self.sizes[self.first:self.last]
+        if positions is not None:
+            rows = rows[positions]
+            sizes = sizes[positions]
+        common = rows.dot(query.astype(numpy.int32))
+        return common / (sizes + _popcount(bits) - common).astype(numpy.float64)
+
+    def similar (self,text,bits,trigger):
+        """return the first queued text with compareFingerprint above trigger, or None"""
+        self._clearOldElements()
+        if self.buckets is None and self.indexMinimum is not None and len(self.queue) >= self.indexMinimum:
+            self.buckets = {}
+            for (k,(t,(m,fm))) in enumerate(self.queue):
+                self._index(self.dropped + k,m)
+        elif self.buckets is not None and (self.indexMinimum is None or len(self.queue) < self.indexMinimum // 2):
+            self.buckets = None
+        # positions in the queue of messages to compare, all of them without index
+        positions = None
+        n = len(self.queue)
+        if self.buckets is not None:
+            positions = [serial - self.dropped for serial in self.candidates(text)]
+            n = len(positions)
+        now = time.time()
+        timeout = self._getTimeout()
+        scored = self.rows is not None and isinstance(bits,int) and bits and n >= self.vectorMinimum
+        if scored:
+            # positions above trigger
+            found = numpy.flatnonzero(self._scores(bits,positions) > trigger)
+            if positions is not None:
+                found = [positions[k] for k in found]
+        elif positions is None:
+            found = range(n)
+        else:
+            found = positions
+        for k in found:
+            (t,(m,fm)) = self.queue[k]
+            if now - t < timeout and (scored or compareFingerprint(m,fm,text,bits) > trigger):
+                return m
+        return None
+
+# weirdness of the latest distinct texts, spam waves repeat the same payloads
+_weirdnessCacheSize = 4096
+
+@functools.lru_cache(maxsize=_weirdnessCacheSize)
+def _cachedWeirdness (text):
+    return sequence_weirdness(text)
+
+def weirdness (text):
+    # ftfy finds nothing weird in printable ascii, latin-1 must still be scored: mojibake is made of it
+    if text.isascii() and text.isprintable():
+        return 0
+    return _cachedWeirdness(text)
+
+# glyphs of unicode spam, see isChannelUniSpam
+_spamchars = {'Ḕ', 'Î', 'Ù', 'Ṋ', 'ℰ', 'Ừ', 'ś', 'ï', 'ℯ', 'ļ', 'ẋ', 'ᾒ', 'ἶ', 'ệ', 'ℓ', 'Ŋ', 'Ḝ', 'ξ', 'ṵ', 'û', 'ẻ', 'Ũ', 'ṡ', '§', 'Ƚ', 'Š', 'ᶙ', 'ṩ', '¹', 'ư', 'Ῐ', 'Ü', 'ŝ', 'ὴ', 'Ș', 'ũ', 'ῑ', 'ⱷ', 'Ǘ', 'Ɇ', 'ĭ', 'ἤ', 'Ɲ', 'Ǝ', 'ủ', 'µ', 'Ỵ', 'Ű', 'ū', 'į', 'ἳ', 'ΐ', 'ḝ', 'Ɛ', 'ṇ', 'È', 'ῆ', 'ử', 'Ň', 'υ', 'Ǜ', 'Ἔ', 'Ὑ', 'μ', 'Ļ', 'ů', 'Ɫ', 'ŷ', 'Ǚ', 'ἠ', 'Ĺ', 'Ę', 'Ὲ', 'Ẍ', 'Ɣ', 'Ϊ', 'ℇ', 'ẍ', 'ῧ', 'ϵ', 'ἦ', 'ừ', 'ṳ', 'ᾕ', 'ṋ', 'ù', 'ῦ', 'Ι', 'ῠ', 'ṥ', 'ὲ', 'ê', 'š', 'ě', 'ề', 'ẽ', 'ī', 'Ė', 'ỷ', 'Ủ', 'ḯ', 'Ἓ', 'Ὓ', 'Ş', 'ύ', 'Ṧ', 'Ŷ', 'ἒ', 'ἵ', 'ė', 'ἰ', 'ẹ', 'Ȇ', 'Ɏ', 'Ί', 'ὶ', 'Ε', 'ḛ', 'Ὤ', 'ǐ', 'ȇ', 'ἢ', 'í', 'ȕ', 'Ữ', '＄', 'ή', 'Ṡ', 'ἷ', 'Ḙ', 'Ὢ', 'Ṉ', 'Ľ', 'ῃ', 'Ụ', 'Ṇ', 'ᾐ', 'Ů', 'Ἕ', 'ý', 'Ȅ', 'ᴌ', 'ύ', 'ņ', 'ὒ', 'Ý', 'ế', 'ĩ', 'ǘ', 'Ē', 'ṹ', 'Ư', 'é', 'Ÿ', 'ΰ', 'Ὦ', 'Ë', 'ỳ', 'ἓ', 'ĕ', 'ἑ', 'ṅ', 'ȗ', 'Ν', 'ί', 'ể', 'ᴟ', 'è', 'ᴇ', 'ḭ', 'ȝ', 'ϊ', 'ƪ', 'Ὗ', 'Ų', 'Ề', 'Ṷ', 'ü', 'Ɨ', 'Ώ', 'ň', 'ṷ', 'ƞ', 'Ȗ', 'ș', 'ῒ', 'Ś', 'Ự', 'Ń', 'Ἳ', 'Ứ', 'Ἷ', 'ἱ', 'ᾔ', 'ÿ', 'Ẽ', 'ὖ', 'ὑ', 'ἧ', 'Ὥ', 'ṉ', 'Ὠ', 'ℒ', 'Ệ', 'Ὼ', 'Ẻ', 'ḙ', 'Ŭ', '₴', 'Ὡ', 'ȉ', 'Ṅ', 'ᵪ', 'ữ', 'Ὧ', 'ń', 'Ἐ', 'Ú', 'ɏ', 'î', 'Ⱡ', 'Ƨ', 'Ě', 'ȿ', 'ᴉ', 'Ṩ', 'Ê', 'ȅ', 'ᶊ', 'Ṻ', 'Ḗ', 'ǹ', 'ᴣ', 'ş', 'Ï', 'ᾗ', 'ự', 'ὗ', 'ǔ', 'ᶓ', 'Ǹ', 'Ἶ', 'Ṳ', 'Ʊ', 'ṻ', 'Ǐ', 'ᵴ', 'ῇ', 'Ẹ', 'Ế', 'Ϋ', 'Ū', 'Ῑ', 'ί', 'ỹ', 'Ḯ', 'ǀ', 'Ὣ', 'Ȳ', 'ǃ', 'ų', 'ϴ', 'Ώ', 'Í', 'ì', 'ι', 'ῄ', 'ΰ', 'ἣ', 'ῡ', 'Ἒ', 'Ḽ', 'Ȉ', 'Έ', 'ἴ', 'ᶇ', 'ἕ', 'ǚ', 'Ī', 'Έ', '¥', 'Ṵ', 'ὔ', 'Ŝ', 'ῢ', 'Ἱ', 'ű', 'Ḷ', 'Ὶ', 'ḗ', 'ᴜ', 'ę', 'ὐ', 'Û', 'ᾑ', 'Ʋ', 'Ἑ', 'Ì', 'ŋ', 'Ḛ', 'ỵ', 'Ễ', '℮', '×', 'Ῠ', 'Ἵ', 'Ύ', 'Ử', 'ᴈ', 'ē', 'Ἰ', 'ᶖ', 'ȳ', 'Ǯ', 'ὓ', 'ὕ', 'ῂ', 'Ĕ', 'É', 'ᾓ', 'Ḻ', 'Ņ', 'ἥ', 'ḕ', 'ὺ', 'Ȋ', 'ı', 'Ȕ', 'ṧ', 'ᾖ', 'Ί', 'ΐ', '€', 'Ḭ', 'Ƴ', 'ȵ', 'Ṹ', 'Ñ', 'Ƞ', 'Ȩ', 'ῐ', 'ứ', 'έ', 'ł', 'ŭ', '϶', 'ƴ', '₤', 'ƨ', '£', 'Ł', 'ñ', 'ë', 'ễ', 'ǯ', 'ᶕ', 'ή', 'ᶔ', 'Π', 'ȩ', 'ἐ', 'Ể', 'ε', 'Ĩ', 'ǜ', 'Į', 'Ξ', 'Ḹ', 'Ῡ', '∩', 'ú', 'Χ', 'ụ'}
+_spamcharsTable = dict.fromkeys(map(ord,_spamchars))
+_upperTable = dict.fromkeys(range(ord('A'),ord('Z') + 1))
+
+class TextFeatures (object):
+    """counts about a message the detectors need, each is one scan by a str builtin"""
+    __slots__ = ('length', 'spaceless', 'upper', 'digit', 'spamchars', 'nonascii', 'url')
+    def __init__(self,raw,text):
+        self.length = len(text)
+        self.spaceless = len(raw) - raw.count(' ')
+        # A to Z only, as the former [A-Z] regexp
+        self.upper = len(raw) - len(raw.translate(_upperTable))
+        self.digit = text.isdigit()
+        self.spamchars = len(text) - len(text.translate(_spamcharsTable))
+        if text.isascii():
+            self.nonascii = 0
+        else:
+            self.nonascii = len(text) - len(text.encode('ascii','ignore'))
+        self.url = 'http' in text
+
+    def __repr__(self):
+        return '%s(length=%r, spaceless=%r, upper=%r, digit=%r, spamchars=%r, nonascii=%r, url=%r)' % (self.__class__.__name__,
+        self.length, self.spaceless, self.upper, self.digit, self.spamchars, self.nonascii, self.url)
+
+class MessageContext (object):
+    """channel independent results about a message, computed once whatever the number of targets"""
+    __slots__ = ('raw', 'text', 'mask', 'matcher', 'budget', '_matches', '_weirdness', '_features', '_fingerprint')
+    def __init__(self,raw,mask,matcher,budget=0):
+        self.raw = raw
+        self.text = raw.lower()
+        self.mask = mask
+        self.matcher = matcher
+        self.budget = budget
+        self._matches = None
+        self._weirdness = None
+        self._features = None
+        self._fingerprint = None
+
+    def matches (self):
+        # uids of permanent patterns which matches the message
+        if self._matches is None:
+            self._matches = self.matcher.match(self.raw,self.budget)
+        return self._matches
+
+    def weirdness (self):
+        if self._weirdness is None:
+            self._weirdness = weirdness(self.text)
+        return self._weirdness
+
+    def features (self):
+        if self._features is None:
+            self._features = TextFeatures(self.raw,self.text)
+        return self._features
+
+    def fingerprint (self):
+        # of text, compared by repeat detectors and amsg with their logs
+        if self._fingerprint is None:
+            self._fingerprint = fingerprint(self.text)
+        return self._fingerprint
+
+    def __repr__(self):
+        return '%s(raw=%r, mask=%r, matches=%r, weirdness=%r, features=%r, fingerprint=%r)' % (self.__class__.__name__,
+        self.raw, self.mask, self._matches, self._weirdness, self._features, self._fingerprint)
+
 class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
     """Network and Channels Spam protections"""
     threaded = True
@@ -387,10 +1947,30 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         self.cache = {}
         self.getIrc(irc)
         self.starting = world.starting
-        self.recaps = re.compile("[A-Z]")
         self.ipfiltered = {}
         self.rmrequestors = {}
-        self.spamchars = {'Ḕ', 'Î', 'Ù', 'Ṋ', 'ℰ', 'Ừ', 'ś', 'ï', 'ℯ', 'ļ', 'ẋ', 'ᾒ', 'ἶ', 'ệ', 'ℓ', 'Ŋ', 'Ḝ', 'ξ', 'ṵ', 'û', 'ẻ', 'Ũ', 'ṡ', '§', 'Ƚ', 'Š', 'ᶙ', 'ṩ', '¹', 'ư', 'Ῐ', 'Ü', 'ŝ', 'ὴ', 'Ș', 'ũ', 'ῑ', 'ⱷ', 'Ǘ', 'Ɇ', 'ĭ', 'ἤ', 'Ɲ', 'Ǝ', 'ủ', 'µ', 'Ỵ', 'Ű', 'ū', 'į', 'ἳ', 'ΐ', 'ḝ', 'Ɛ', 'ṇ', 'È', 'ῆ', 'ử', 'Ň', 'υ', 'Ǜ', 'Ἔ', 'Ὑ', 'μ', 'Ļ', 'ů', 'Ɫ', 'ŷ', 'Ǚ', 'ἠ', 'Ĺ', 'Ę', 'Ὲ', 'Ẍ', 'Ɣ', 'Ϊ', 'ℇ', 'ẍ', 'ῧ', 'ϵ', 'ἦ', 'ừ', 'ṳ', 'ᾕ', 'ṋ', 'ù', 'ῦ', 'Ι', 'ῠ', 'ṥ', 'ὲ', 'ê', 'š', 'ě', 'ề', 'ẽ', 'ī', 'Ė', 'ỷ', 'Ủ', 'ḯ', 'Ἓ', 'Ὓ', 'Ş', 'ύ', 'Ṧ', 'Ŷ', 'ἒ', 'ἵ', 'ė', 'ἰ', 'ẹ', 'Ȇ', 'Ɏ', 'Ί', 'ὶ', 'Ε', 'ḛ', 'Ὤ', 'ǐ', 'ȇ', 'ἢ', 'í', 'ȕ', 'Ữ', '＄', 'ή', 'Ṡ', 'ἷ', 'Ḙ', 'Ὢ', 'Ṉ', 'Ľ', 'ῃ', 'Ụ', 'Ṇ', 'ᾐ', 'Ů', 'Ἕ', 'ý', 'Ȅ', 'ᴌ', 'ύ', 'ņ', 'ὒ', 'Ý', 'ế', 'ĩ', 'ǘ', 'Ē', 'ṹ', 'Ư', 'é', 'Ÿ', 'ΰ', 'Ὦ', 'Ë', 'ỳ', 'ἓ', 'ĕ', 'ἑ', 'ṅ', 'ȗ', 'Ν', 'ί', 'ể', 'ᴟ', 'è', 'ᴇ', 'ḭ', 'ȝ', 'ϊ', 'ƪ', 'Ὗ', 'Ų', 'Ề', 'Ṷ', 'ü', 'Ɨ', 'Ώ', 'ň', 'ṷ', 'ƞ', 'Ȗ', 'ș', 'ῒ', 'Ś', 'Ự', 'Ń', 'Ἳ', 'Ứ', 'Ἷ', 'ἱ', 'ᾔ', 'ÿ', 'Ẽ', 'ὖ', 'ὑ', 'ἧ', 'Ὥ', 'ṉ', 'Ὠ', 'ℒ', 'Ệ', 'Ὼ', 'Ẻ', 'ḙ', 'Ŭ', '₴', 'Ὡ', 'ȉ', 'Ṅ', 'ᵪ', 'ữ', 'Ὧ', 'ń', 'Ἐ', 'Ú', 'ɏ', 'î', 'Ⱡ', 'Ƨ', 'Ě', 'ȿ', 'ᴉ', 'Ṩ', 'Ê', 'ȅ', 'ᶊ', 'Ṻ', 'Ḗ', 'ǹ', 'ᴣ', 'ş', 'Ï', 'ᾗ', 'ự', 'ὗ', 'ǔ', 'ᶓ', 'Ǹ', 'Ἶ', 'Ṳ', 'Ʊ', 'ṻ', 'Ǐ', 'ᵴ', 'ῇ', 'Ẹ', 'Ế', 'Ϋ', 'Ū', 'Ῑ', 'ί', 'ỹ', 'Ḯ', 'ǀ', 'Ὣ', 'Ȳ', 'ǃ', 'ų', 'ϴ', 'Ώ', 'Í', 'ì', 'ι', 'ῄ', 'ΰ', 'ἣ', 'ῡ', 'Ἒ', 'Ḽ', 'Ȉ', 'Έ', 'ἴ', 'ᶇ', 'ἕ', 'ǚ', 'Ī', 'Έ', '¥', 'Ṵ', 'ὔ', 'Ŝ', 'ῢ', 'Ἱ', 'ű', 'Ḷ', 'Ὶ', 'ḗ', 'ᴜ', 'ę', 'ὐ', 'Û', 'ᾑ', 'Ʋ', 'Ἑ', 'Ì', 'ŋ', 'Ḛ', 'ỵ', 'Ễ', '℮', '×', 'Ῠ', 'Ἵ', 'Ύ', 'Ử', 'ᴈ', 'ē', 'Ἰ', 'ᶖ', 'ȳ', 'Ǯ', 'ὓ', 'ὕ', 'ῂ', 'Ĕ', 'É', 'ᾓ', 'Ḻ', 'Ņ', 'ἥ', 'ḕ', 'ὺ', 'Ȋ', 'ı', 'Ȕ', 'ṧ', 'ᾖ', 'Ί', 'ΐ', '€', 'Ḭ', 'Ƴ', 'ȵ', 'Ṹ', 'Ñ', 'Ƞ', 'Ȩ', 'ῐ', 'ứ', 'έ', 'ł', 'ŭ', '϶', 'ƴ', '₤', 'ƨ', '£', 'Ł', 'ñ', 'ë', 'ễ', 'ǯ', 'ᶕ', 'ή', 'ᶔ', 'Π', 'ȩ', 'ἐ', 'Ể', 'ε', 'Ĩ', 'ǜ', 'Į', 'Ξ', 'Ḹ', 'Ῡ', '∩', 'ú', 'Χ', 'ụ'}
+        # tracemalloc snapshot of the previous memory --snapshot
+        self.snapshot = None
+        # [channel] = ChannelPolicy, rebuilt once generation is bumped by a change of one of their values
+        self.policies = {}
+        self.generation = 0
+        self.policyCallback = self.forgetPolicies
+        # detector chain capabilities per hostmask and channel, see handleMsg
+        self.capabilities = CapabilityCache(self.registryValue('capabilityCacheSize'))
+        self.capabilityCallback = self.forgetCapabilities
+        for value in self.capabilitySources():
+            value.addCallback(self.capabilityCallback)
+        self.windowIndexCallback = self.setWindowIndex
+        conf.supybot.plugins.Sigyn.windowIndexMinimum.addCallback(self.windowIndexCallback)
+        self.setWindowIndex()
+        # [channel] = DetectorPipeline, sorted again by cleanup with the costs measured since
+        self.pipelines = {}
+        self.detectorStats = dict((detector.name,DetectorStats()) for detector in _detectors)
+        self.countersCallback = self.scheduleCounters
+        conf.supybot.plugins.Sigyn.patternCountInterval.addCallback(self.countersCallback)
+        self.scheduleCounters()
+        schedule.addPeriodicEvent(self.advanceWheels,1,name='SigynWheel',now=False)
+        self.spamchars = _spamchars
 
     def removeDnsbl (self,irc,ip,droneblHost,droneblKey):
         headers = {
@@ -502,35 +2082,42 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
             self.logChannel(irc,'DNSBL: %s (%s)' % (ip,e))
 
     def state (self,irc,msg,args,channel):
-        """[<channel>]
+        """[<channel>|tables]
 
-        returns state of the plugin, for optional <channel>"""
+        returns state of the plugin, for optional <channel>, or entries and approximate bytes of each detection table"""
         self.cleanup(irc)
         i = self.getIrc(irc)
-        if not channel:
+        if channel == 'tables':
+            for table in i.queues:
+                irc.queueMsg(ircmsgs.privmsg(msg.nick,'%s: %s entries, %s created, %s expired, ~%s bytes' % (table.name,len(table),table.created,table.expired,table.size())))
+            irc.queueMsg(ircmsgs.privmsg(msg.nick,'%s entries in %s tables' % (len(i.queues),len(i.queues.tables))))
+        elif not channel:
             irc.queueMsg(ircmsgs.privmsg(msg.nick,'Opered %s, enable %s, defcon %s, netsplit %s' % (i.opered,self.registryValue('enable'),(i.defcon),i.netsplit)))
             irc.queueMsg(ircmsgs.privmsg(msg.nick,'There are %s permanent patterns and %s channels directly monitored' % (len(i.patterns),len(i.channels))))
             channels = 0
             prefixs = 0
-            for k in i.queues:
+            for k in i.queues.keys():
+                if not isinstance(k,str):
+                    continue
                 if irc.isChannel(k):
                     channels += 1
                 elif ircutils.isUserHostmask(k):
                     prefixs += 1
             irc.queueMsg(ircmsgs.privmsg(msg.nick,"Via server's notices: %s channels and %s users monitored" % (channels,prefixs)))
+            irc.queueMsg(ircmsgs.privmsg(msg.nick,'%s expiries pending' % len(i.wheel)))
         for chan in i.channels:
             if channel == chan:
                 ch = self.getChan(irc,chan)
-                if not self.registryValue('ignoreChannel',channel=chan):
+                if not self.getPolicy(chan).ignoreChannel:
                     called = ""
                     if ch.called:
                         called = 'currently in defcon'
                     irc.queueMsg(ircmsgs.privmsg(msg.nick,'On %s (%s users) %s:' % (chan,len(ch.nicks),called)))
                     protections = ['flood','lowFlood','repeat','lowRepeat','massRepeat','lowMassRepeat','hilight','nick','ctcp']
                     for protection in protections:
-                        if self.registryValue('%sPermit' % protection,channel=chan) > -1:
-                            permit = self.registryValue('%sPermit' % protection,channel=chan)
-                            life = self.registryValue('%sLife' % protection,channel=chan)
+                        if getattr(self.getPolicy(chan),'%sPermit' % protection) > -1:
+                            permit = getattr(self.getPolicy(chan),'%sPermit' % protection)
+                            life = getattr(self.getPolicy(chan),'%sLife' % protection)
                             abuse = self.hasAbuseOnChannel(irc,chan,protection)
                             if abuse:
                                 abuse = ' (ongoing abuses) '
@@ -551,7 +2138,81 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                                 count = ""
                             irc.queueMsg(ircmsgs.privmsg(msg.nick," - %s : %s/%ss %s%s" % (protection,permit,life,abuse,count)))
         irc.replySuccess()
-    state = wrap(state,['owner',optional('channel')])
+    state = wrap(state,['owner',optional(first(('literal','tables'),'channel'))])
+
+    def memory (self,irc,msg,args,optlist):
+        """[--channels <number>] [--snapshot]
+
+        returns entries and deep sizes of the plugin's structures, for each network and its <number> most expensive channels (10 by default);
+        --snapshot also compares a tracemalloc snapshot with the one taken by the previous --snapshot call"""
+        top = 10
+        snapshot = False
+        for (option, arg) in optlist:
+            if option == 'channels':
+                top = arg
+            elif option == 'snapshot':
+                snapshot = True
+        def sizeOf (value):
+            if isinstance(value,StateRegistry):
+                return value.size()
+            return deepSize(value)
+        def describe (name,value,size):
+            entries = '-'
+            if hasattr(value,'__len__'):
+                entries = len(value)
+            return '%s: %s entries, ~%s bytes' % (name,entries,size)
+        for name in ('cache','ipfiltered','rmrequestors','spamchars','capabilities'):
+            irc.queueMsg(ircmsgs.privmsg(msg.nick,describe(name,getattr(self,name),deepSize(getattr(self,name)))))
+        for network in list(self._ircs.keys()):
+            i = self._ircs[network]
+            sizes = []
+            for name in Ircd.__slots__:
+                if name in ('irc','channels') or not hasattr(i,name):
+                    continue
+                value = getattr(i,name)
+                sizes.append((sizeOf(value),name,value))
+            sizes.sort(key=lambda item: item[0],reverse=True)
+            for (size,name,value) in sizes:
+                irc.queueMsg(ircmsgs.privmsg(msg.nick,'[%s] %s' % (network,describe(name,value,size))))
+            channels = []
+            for channel in list(i.channels.keys()):
+                chan = i.channels[channel]
+                parts = [(name,getattr(chan,name)) for name in ('nicks','logs','buffers','patterns','klines','hilights')]
+                parts = [(name,value,deepSize(value)) for (name,value) in parts]
+                channels.append((sum(part[2] for part in parts),channel,parts))
+            channels.sort(key=lambda item: item[0],reverse=True)
+            irc.queueMsg(ircmsgs.privmsg(msg.nick,'[%s] %s channels, ~%s bytes' % (network,len(channels),sum(item[0] for item in channels))))
+            for (size,channel,parts) in channels[:top]:
+                details = ', '.join('%s %s/~%s' % (name,len(value) if value is not None else 0,cost) for (name,value,cost) in parts)
+                irc.queueMsg(ircmsgs.privmsg(msg.nick,'[%s] %s: ~%s bytes (%s)' % (network,channel,size,details)))
+        if snapshot:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.snapshot = None
+            current = tracemalloc.take_snapshot()
+            if self.snapshot is None:
+                irc.queueMsg(ircmsgs.privmsg(msg.nick,'tracemalloc snapshot taken, call memory --snapshot again to compare'))
+            else:
+                for stat in current.compare_to(self.snapshot,'lineno')[:10]:
+                    irc.queueMsg(ircmsgs.privmsg(msg.nick,str(stat)))
+            self.snapshot = current
+        irc.replySuccess()
+    memory = wrap(memory,['owner',getopts({'channels': 'positiveInt', 'snapshot': ''})])
+
+    def detectors (self,irc,msg,args,channel):
+        """[<channel>]
+
+        returns invocations, triggers, skips and cpu time of each channel detector, and the order they run in <channel>, then the weirdness cache hits"""
+        for detector in _detectors:
+            stats = self.detectorStats[detector.name]
+            irc.queueMsg(ircmsgs.privmsg(msg.nick,'%s: %s calls, %s triggers, %s skipped, %.1fms cpu, %.1fus per call' % (detector.name,stats.calls,stats.triggers,stats.skipped,stats.cpu*1000,stats.cost()*1000000)))
+        if channel:
+            pipeline = self.getPipeline(channel)
+            irc.queueMsg(ircmsgs.privmsg(msg.nick,'[%s] %s' % (channel,', '.join(detector.name for detector in pipeline.detectors))))
+        cache = _cachedWeirdness.cache_info()
+        irc.queueMsg(ircmsgs.privmsg(msg.nick,'weirdness cache: %s/%s entries, %s hits, %s misses' % (cache.currsize,cache.maxsize,cache.hits,cache.misses)))
+        irc.replySuccess()
+    detectors = wrap(detectors,['owner',optional('channel')])
 
     def defcon (self,irc,msg,args,channel):
         """[<channel>]
@@ -559,13 +2220,13 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         limits are lowered, globally or for a specific <channel>"""
         i = self.getIrc(irc)
         if channel and channel != self.registryValue('logChannel'):
-            if channel in i.channels and self.registryValue('abuseDuration',channel=channel) > 0:
+            if channel in i.channels and self.getPolicy(channel).abuseDuration > 0:
                 chan = self.getChan(irc,channel)
                 if chan.called:
-                    self.logChannel(irc,'INFO: [%s] rescheduled ignores lifted, limits lowered (by %s) for %ss' % (channel,msg.nick,self.registryValue('abuseDuration',channel=channel)))
+                    self.logChannel(irc,'INFO: [%s] rescheduled ignores lifted, limits lowered (by %s) for %ss' % (channel,msg.nick,self.getPolicy(channel).abuseDuration))
                     chan.called = time.time()
                 else:
-                    self.logChannel(irc,'INFO: [%s] ignores lifted, limits lowered (by %s) for %ss' % (channel,msg.nick,self.registryValue('abuseDuration',channel=channel)))
+                    self.logChannel(irc,'INFO: [%s] ignores lifted, limits lowered (by %s) for %ss' % (channel,msg.nick,self.getPolicy(channel).abuseDuration))
                     chan.called = time.time()
         else:
             if i.defcon:
@@ -653,7 +2314,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
             if irc.isChannel(channel):
                 if self.registryValue('mainChannel') in channel or channel == self.registryValue('reportChannel') or self.registryValue('snoopChannel') == channel or self.registryValue('secretChannel') == channel:
                     continue
-                if self.registryValue('ignoreChannel',channel):
+                if self.getPolicy(channel).ignoreChannel:
                     continue
                 action = self.registryValue('lastActionTaken',channel=channel)
                 if action > 0:
@@ -685,10 +2346,8 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         i = self.getIrc(irc)
         patterns = []
         text = text.encode('utf-8').strip()
-        for k in i.patterns:
-            pattern = i.patterns[k]
-            if pattern.match(text):
-                patterns.append('#%s' % pattern.uid)
+        for uid in i.matcher.match(text):
+            patterns.append('#%s' % uid)
         if len(patterns):
             irc.queueMsg(ircmsgs.privmsg(msg.nick,'%s matches: %s' % (len(patterns),', '.join(patterns))))
         else:
@@ -747,6 +2406,10 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         add a permanent /<pattern>/ to kline after <limit> calls raised during <life> seconds,
         for immediate kline use limit 0"""
         i = self.getIrc(irc)
+        shape = catastrophicShape(pattern[1])
+        if shape:
+            irc.error('%s may backtrack exponentially (%s)' % (pattern[0],shape))
+            return
         result = i.add(self.getDb(irc.network),msg.prefix,pattern[0],limit,life,True)
         self.logChannel(irc,'PATTERN: %s added #%s : "%s" %s/%ss' % (msg.nick,result,pattern[0],limit,life))
         irc.reply('#%s added' % result)
@@ -757,6 +2420,10 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
 
         edit #<id> with new <limit> <life> and <comment>"""
         i = self.getIrc(irc)
+        shape = i.shape(self.getDb(irc.network),uid)
+        if shape:
+            irc.error('#%s may backtrack exponentially (%s), remove it instead' % (uid,shape))
+            return
         result = i.edit(self.getDb(irc.network),uid,limit,life,comment)
         if result:
             if comment:
@@ -773,6 +2440,10 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
 
         activate or deactivate #<id>"""
         i = self.getIrc(irc)
+        shape = toggle and i.shape(self.getDb(irc.network),uid)
+        if shape:
+            irc.error('#%s may backtrack exponentially (%s)' % (uid,shape))
+            return
         result = i.toggle(self.getDb(irc.network),uid,msg.prefix,toggle)
         if result:
             if toggle:
@@ -784,6 +2455,57 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
             irc.reply("#%s doesn't exist or is already in requested state" % uid)
     togglepattern = wrap(togglepattern,['owner','positiveInt','boolean'])
 
+    def disableSlowPatterns (self,irc):
+        i = self.getIrc(irc)
+        budget = self.registryValue('regexpBudget')
+        while len(i.matcher.slow):
+            (uid,elapsed) = i.matcher.slow.popitem()
+            if i.toggle(self.getDb(irc.network),uid,irc.prefix,False):
+                self.logChannel(irc,'PATTERN: #%s disabled, %s messages over budget, %.3fs spent on the latest (budget %ss)' % (uid,_regexpStrikes,elapsed,budget))
+
+    def toppattern (self,irc,msg,args,number,minutes):
+        """[<number>] [<minutes>]
+
+        returns the <number> permanent patterns with most calls during the last <minutes>, 10 patterns and 60 minutes by default"""
+        days = self.registryValue('patternHitsDays')
+        if minutes > days*1440:
+            irc.error('calls are kept for %s days' % days)
+            return
+        i = self.getIrc(irc)
+        results = []
+        for (uid,pattern,hits) in i.top(self.getDb(irc.network),number,minutes):
+            results.append('#%s "%s" %s calls (%.2f/min)' % (uid,pattern,hits,hits/float(minutes)))
+        if len(results):
+            irc.replies(results,None,None,False)
+        else:
+            irc.reply('no calls during the last %s minutes' % minutes)
+    toppattern = wrap(toppattern,['owner',optional('positiveInt',10),optional('positiveInt',60)])
+
+    def deadpattern (self,irc,msg,args,days):
+        """[<days>]
+
+        returns active permanent patterns without calls during the last <days>, 90 by default, candidates for rmpattern"""
+        if days > self.registryValue('patternHitsDays'):
+            irc.error('calls are kept for %s days' % self.registryValue('patternHitsDays'))
+            return
+        i = self.getIrc(irc)
+        db = self.getDb(irc.network)
+        tracked = i.tracked(db)
+        if tracked > time.time() - days*86400:
+            irc.reply('calls are recorded since %s' % floatToGMT(tracked))
+            return
+        results = []
+        for (uid,pattern,last) in i.dead(db,days,tracked):
+            if last:
+                results.append('[#%s "%s" last call %s]' % (uid,pattern,floatToGMT(last)))
+            else:
+                results.append('[#%s "%s" no call recorded]' % (uid,pattern))
+        if len(results):
+            irc.replies(results,None,None,False)
+        else:
+            irc.reply('no pattern without calls during the last %s days' % days)
+    deadpattern = wrap(deadpattern,['owner',optional('positiveInt',90)])
+
     def lstmp (self,irc,msg,args,channel):
         """[<channel>]
 
@@ -854,9 +2576,9 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         i = self.getIrc(irc)
         if channel in i.channels:
             chan = self.getChan(irc,channel)
-            shareID = self.registryValue('shareComputedPatternID',channel=channel)
+            shareID = self.getPolicy(channel).shareComputedPatternID
             if shareID == -1 or not i.defcon:
-                life = self.registryValue('computedPatternLife',channel=channel)
+                life = self.getPolicy(channel).computedPatternLife
                 if not chan.patterns:
                     chan.patterns = utils.structures.TimeoutQueue(life)
                 elif chan.patterns.timeout != life:
@@ -866,12 +2588,12 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                 irc.replySuccess()
             else:
                 n = 0
-                l = self.registryValue('computedPatternLife',channel=channel)
+                l = self.getPolicy(channel).computedPatternLife
                 for channel in i.channels:
                     chan = self.getChan(irc,channel)
-                    id = self.registryValue('shareComputedPatternID',channel=channel)
+                    id = self.getPolicy(channel).shareComputedPatternID
                     if id == shareID:
-                        life = self.registryValue('computedPatternLife',channel=channel)
+                        life = self.getPolicy(channel).computedPatternLife
                         if not chan.patterns:
                             chan.patterns = utils.structures.TimeoutQueue(life)
                         elif chan.patterns.timeout != life:
@@ -893,7 +2615,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         n = 0
         for channel in i.channels:
             chan = self.getChan(irc,channel)
-            life = self.registryValue('computedPatternLife',channel=channel)
+            life = self.getPolicy(channel).computedPatternLife
             if not chan.patterns:
                 chan.patterns = utils.structures.TimeoutQueue(life)
             elif chan.patterns.timeout != life:
@@ -911,11 +2633,11 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         i = self.getIrc(irc)
         if channel in i.channels:
             chan = self.getChan(irc,channel)
-            shareID = self.registryValue('shareComputedPatternID',channel=channel)
+            shareID = self.getPolicy(channel).shareComputedPatternID
             if shareID != -1:
                 n = 0
                 for channel in i.channels:
-                    id = self.registryValue('shareComputedPatternID',channel=channel)
+                    id = self.getPolicy(channel).shareComputedPatternID
                     if id == shareID:
                        if i.channels[channel].patterns:
                            i.channels[channel].patterns.reset()
@@ -956,7 +2678,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                                   irc.sendMsg(ircmsgs.IrcMsg('PRIVMSG OperServ :AKILL DEL %s' % ip))
                               else:
                                   irc.queueMsg(ircmsgs.IrcMsg('UNKLINE %s' % ip))
-                              if self.registryValue('clearTmpPatternOnUnkline',channel=channel):
+                              if self.getPolicy(channel).clearTmpPatternOnUnkline:
                                   if chan.patterns and len(chan.patterns):
                                       self.logChannel(irc,'PATTERN: [%s] removed %s tmp pattern by %s' % (channel,len(chan.patterns),msg.nick))
                                       chan.patterns.reset()
@@ -1006,7 +2728,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
     def applyDefcon (self, irc):
         i = self.getIrc(irc)
         for channel in irc.state.channels:
-            if irc.isChannel(channel) and self.registryValue('defconMode',channel=channel):
+            if irc.isChannel(channel) and self.getPolicy(channel).defconMode:
                 chan = self.getChan(irc,channel)
                 if i.defcon or chan.called:
                     if not 'z' in irc.state.channels[channel].modes:
@@ -1173,11 +2895,12 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         (nick, ident, host) = (msg.args[5], msg.args[2], msg.args[3])
         if irc.isChannel(channel):
             chan = self.getChan(irc,channel)
+            chan.hilights.add(nick)
             t = time.time()
             prefix = '%s!%s@%s' % (nick,ident,host)
             mask = self.prefixToMask(irc,prefix,channel)
             if isCloaked(prefix,self):
-                t = t - self.registryValue('ignoreDuration',channel=channel) - 1
+                t = t - self.getPolicy(channel).ignoreDuration - 1
             chan.nicks[nick] = [t,prefix,mask,'','']
 
     def spam (self,irc,msg,args,channel):
@@ -1186,7 +2909,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         trusted users can ask the bot to join <channel> for a limited period of time
         """
         if not channel in irc.state.channels:
-            t = time.time() - (self.registryValue('leaveChannelIfNoActivity',channel=channel) * 24 * 3600) + 3600
+            t = time.time() - (self.getPolicy(channel).leaveChannelIfNoActivity * 24 * 3600) + 3600
             self.setRegistryValue('lastActionTaken',t,channel=channel)
             irc.sendMsg(ircmsgs.join(channel))
             chan = self.getChan(irc,channel)
@@ -1229,7 +2952,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
        channels = []
        for channel in list(irc.state.channels):
            flag = ''
-           if self.registryValue('leaveChannelIfNoActivity',channel=channel) == -1:
+           if self.getPolicy(channel).leaveChannelIfNoActivity == -1:
                flag = '*'
            l = len(irc.state.channels[channel].users)
            if not channel == self.registryValue('secretChannel') and not channel == self.registryValue('snoopChannel') and not channel == self.registryValue('reportChannel') and not channel == self.registryValue('logChannel'):
@@ -1345,7 +3068,11 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                 irc.queueMsg(ircmsgs.IrcMsg('OPER %s %s' % (self.registryValue('operatorNick'),self.registryValue('operatorPassword'))))
         return self._ircs[irc.network]
 
+    def doChghost (self,irc,msg):
+        self.capabilities.discard(msg.prefix)
+
     def doAccount (self,irc,msg):
+        self.capabilities.discard(msg.prefix)
         i = self.getIrc(irc)
         if ircutils.isUserHostmask(msg.prefix):
             nick = ircutils.nickFromHostmask(msg.prefix)
@@ -1365,7 +3092,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                             i.tokline[src] = src
                             def f ():
                                 irc.sendMsg(ircmsgs.IrcMsg('WHOIS %s %s' % (src,src)))
-                            schedule.addEvent(f,time.time()+random.randint(0,7))
+                            i.wheel.schedule(f,time.time()+random.randint(0,7))
                             #irc.sendMsg(ircmsgs.IrcMsg('WHOIS %s %s' % (src,src)))
                         break
             for channel in irc.state.channels:
@@ -1378,6 +3105,69 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                         else:
                             chan.nicks[msg.nick] = [a[0],a[1],a[2],'',acc]
 
+    def getPolicy (self,channel):
+        # ChannelPolicy of channel, the values registryValue(name,channel=channel) would return
+        policy = self.policies.get(channel)
+        if policy is not None and policy.generation == self.generation:
+            return policy
+        if channel is not None and not ircutils.isChannel(channel):
+            # like registryValue, anything else gets the global values
+            return self.getPolicy(None)
+        previous = policy
+        policy = ChannelPolicy(channel,self.generation)
+        if previous is None:
+            for value in policy.sources:
+                value.addCallback(self.policyCallback)
+        self.policies[channel] = policy
+        return policy
+
+    def forgetPolicies (self):
+        self.generation = self.generation + 1
+
+    def getPipeline (self,channel):
+        pipeline = self.pipelines.get(channel)
+        if pipeline is None or pipeline.generation != self.generation:
+            pipeline = DetectorPipeline(channel,self.generation,self.getPolicy(channel),self.detectorStats)
+            self.pipelines[channel] = pipeline
+        return pipeline
+
+    def capabilitySources (self):
+        return (conf.supybot.capabilities, conf.supybot.capabilities.default, conf.supybot.plugins.Sigyn.capabilityCacheSize)
+
+    def forgetCapabilities (self):
+        self.capabilities.size = self.registryValue('capabilityCacheSize')
+        self.capabilities.clear()
+
+    def setWindowIndex (self):
+        # MessageWindow.indexMinimum from windowIndexMinimum, windows build or drop their index on their next check
+        minimum = self.registryValue('windowIndexMinimum')
+        if minimum < 0:
+            minimum = 0
+            if numpy is None:
+                minimum = MessageWindow.indexDefault
+        MessageWindow.indexMinimum = minimum or None
+
+    def updateChannelNicks (self,irc,msg):
+        # ChannelNicks of monitored channels, others are synced with irc.state once monitored
+        i = self.getIrc(irc)
+        if msg.command == 'JOIN':
+            for channel in msg.args[0].split(','):
+                if channel in i.channels:
+                    i.channels[channel].hilights.add(msg.nick)
+        elif msg.command == 'PART':
+            for channel in msg.args[0].split(','):
+                if channel in i.channels:
+                    i.channels[channel].hilights.discard(msg.nick)
+        elif msg.command == 'KICK':
+            if msg.args[0] in i.channels:
+                i.channels[msg.args[0]].hilights.discard(msg.args[1])
+        elif msg.command == 'QUIT':
+            for chan in i.channels.values():
+                chan.hilights.discard(msg.nick)
+        elif msg.command == 'NICK':
+            for chan in i.channels.values():
+                chan.hilights.rename(msg.nick,msg.args[0])
+
     def getChan (self,irc,channel):
         i = self.getIrc(irc)
         if not channel in i.channels and irc.isChannel(channel):
@@ -1487,32 +3277,60 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
             i = self.getIrc(irc)
             if mask in i.klines:
                 del i.klines[mask]
-        schedule.addEvent(forgetKline,time.time()+7)
+        i.wheel.schedule(forgetKline,time.time()+7)
 
     def ban (self,irc,nick,prefix,mask,duration,reason,message,log,killReason=None):
         self.kill(irc,nick,killReason)
         self.kline(irc,prefix,mask,duration,reason,message)
         self.logChannel(irc,log)
 
-    def getIrcQueueFor (self,irc,key,kind,life):
+    def getIrcQueueFor (self,irc,kind,key,life):
         i = self.getIrc(irc)
-        if not key in i.queues:
-            i.queues[key] = {}
-        if not kind in i.queues[key]:
-            i.queues[key][kind] = utils.structures.TimeoutQueue(life)
-        elif i.queues[key][kind].timeout != life:
-            i.queues[key][kind].setTimeout(life)
-        return i.queues[key][kind]
-
-    def rmIrcQueueFor (self,irc,key):
+        return i.queues.table(kind,utils.structures.TimeoutQueue).get(key,life)
+
+    def getIrcCounterFor (self,irc,kind,key,life):
+        # getIrcQueueFor, when only the number of events matters
+        i = self.getIrc(irc)
+        return i.queues.table(kind,SlidingWindowCounter).get(key,life)
+
+    def getChanBufferFor (self,irc,channel,kind,key,life,queue=False):
+        # channel's ChannelBuffer for (kind,key), its window only counts events unless queue is set
+        chan = self.getChan(irc,channel)
+        if not kind in chan.buffers:
+            chan.buffers[kind] = {}
+        if not key in chan.buffers[kind]:
+            if queue:
+                chan.buffers[kind][key] = ChannelBuffer(utils.structures.TimeoutQueue(life))
+            else:
+                chan.buffers[kind][key] = ChannelBuffer(SlidingWindowCounter(life))
+            # created must outlive ignoreDuration, otherwise key would be a new user again
+            until = chan.buffers[kind][key].created + self.getPolicy(channel).ignoreDuration
+            self.expireWhenEmpty(irc,chan.buffers,kind,key,until)
+        elif chan.buffers[kind][key].window.timeout != life:
+            chan.buffers[kind][key].window.setTimeout(life)
+        return chan.buffers[kind][key]
+
+    def expireWhenEmpty (self,irc,container,outer,inner,until=0):
+        # container[outer][inner] is dropped by the timing wheel once empty and after until, as well as container[outer] when nothing else remains
+        i = self.getIrc(irc)
+        queue = container[outer][inner]
+        def expire ():
+            if outer in container and container[outer].get(inner) is queue:
+                now = time.time()
+                if len(queue):
+                    i.wheel.schedule(expire,now+queue._getTimeout())
+                    return
+                if now < until:
+                    i.wheel.schedule(expire,until)
+                    return
+                del container[outer][inner]
+                if not len(container[outer]):
+                    del container[outer]
+        i.wheel.schedule(expire,time.time()+queue._getTimeout())
+
+    def rmIrcQueueFor (self,irc,mask):
         i = self.getIrc(irc)
-        if key in i.queues:
-            for k in i.queues[key]:
-                if type(i.queues[key][k]) == utils.structures.TimeoutQueue:
-                    i.queues[key][k].reset()
-                    i.queues[key][k].queue = None
-            i.queues[key].clear()
-            del i.queues[key]
+        i.queues.discard(mask)
 
     def do015 (self,irc,msg):
         try:
@@ -1546,7 +3364,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                     if not i.netsplit:
                         self.logChannel(irc,'INFO: netsplit activated for %ss due to %s/%ss of lags with %s : some abuses are ignored' % (self.registryValue('netsplitDuration'),self.registryValue('lagPermit'),self.registryValue('lagPermit'),server))
                     i.netsplit = time.time() + self.registryValue('netsplitDuration')
-            schedule.addEvent(bye,time.time()+self.registryValue('lagPermit'))
+            i.wheel.schedule(bye,time.time()+self.registryValue('lagPermit'))
             irc.queueMsg(ircmsgs.IrcMsg('TIME %s' % server))
 
     def resync (self,irc,msg,args):
@@ -1577,45 +3395,24 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
 
     def cleanup (self,irc):
         i = self.getIrc(irc)
+        self.pipelines = {}
         partReason = 'Leaving the channel. /invite %s %s again if needed'
         for channel in irc.state.channels:
             if irc.isChannel(channel) and not channel in self.registryValue('mainChannel') and not channel == self.registryValue('snoopChannel') and not channel == self.registryValue('logChannel') and not channel == self.registryValue('reportChannel') and not channel == self.registryValue('secretChannel'):
-                if self.registryValue('lastActionTaken',channel=channel) > 1.0 and self.registryValue('leaveChannelIfNoActivity',channel=channel) > -1 and not i.defcon:
-                    if time.time() - self.registryValue('lastActionTaken',channel=channel) > (self.registryValue('leaveChannelIfNoActivity',channel=channel) * 24 * 3600):
+                if self.registryValue('lastActionTaken',channel=channel) > 1.0 and self.getPolicy(channel).leaveChannelIfNoActivity > -1 and not i.defcon:
+                    if time.time() - self.registryValue('lastActionTaken',channel=channel) > (self.getPolicy(channel).leaveChannelIfNoActivity * 24 * 3600):
                        irc.queueMsg(ircmsgs.part(channel, partReason % (irc.nick,channel)))
                        chan = self.getChan(irc,channel)
                        if chan.requestedBySpam:
                            self.setRegistryValue('lastActionTaken',self.registryValue('lastActionTaken'),channel=channel)
                        else:
                            self.setRegistryValue('lastActionTaken',time.time(),channel=channel)
-                       self.logChannel(irc,'PART: [%s] due to inactivity for %s days' % (channel,self.registryValue('leaveChannelIfNoActivity',channel=channel)))
+                       self.logChannel(irc,'PART: [%s] due to inactivity for %s days' % (channel,self.getPolicy(channel).leaveChannelIfNoActivity))
                        try:
                            network = conf.supybot.networks.get(irc.network)
                            network.channels().remove(channel)
                        except KeyError:
                            pass
-        kinds = []
-        for kind in i.queues:
-            count = 0
-            ks = []
-            try:
-                for k in i.queues[kind]:
-                    if isinstance(i.queues[kind][k],utils.structures.TimeoutQueue):
-                        if not len(i.queues[kind][k]):
-                            ks.append(k)
-                        else:
-                           count += 1
-                    else:
-                        count += 1
-            except:
-                self.log.error('Exception with %s' % kind)
-            if len(ks):
-                for k in ks:
-                    del i.queues[kind][k]
-            if count == 0:
-               kinds.append(kind)
-        for kind in kinds:
-            del i.queues[kind]
         chs = []
         for channel in i.channels:
             chan = i.channels[channel]
@@ -1628,24 +3425,6 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                     ns.append(n)
             for n in ns:
                 del chan.nicks[n]
-            bs = []
-            for b in chan.buffers:
-                 qs = []
-                 count = 0
-                 for q in chan.buffers[b]:
-                     if isinstance(chan.buffers[b][q],utils.structures.TimeoutQueue):
-                         if not len(chan.buffers[b][q]):
-                            qs.append(q)
-                         else:
-                            count += 1
-                     else:
-                        count +=1
-                 for q in qs:
-                     del chan.buffers[b][q]
-                 if count == 0:
-                     bs.append(b)
-            for b in bs:
-                del chan.buffers[b]
             logs = []
             if chan.logs:
                 for log in chan.logs:
@@ -1653,8 +3432,8 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                         logs.append(log)
             for log in logs:
                 del chan.logs[log]
-            if len(ns) or len(bs) or len(logs):
-                chs.append('[%s : %s nicks, %s buffers, %s logs]' % (channel,len(ns),len(bs),len(logs)))
+            if len(ns) or len(logs):
+                chs.append('[%s : %s nicks, %s logs]' % (channel,len(ns),len(logs)))
 
     def do391 (self,irc,msg):
         i = self.getIrc(irc)
@@ -1747,9 +3526,9 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
     def doInvite(self, irc, msg):
        channel = msg.args[1]
        i = self.getIrc(irc)
-       self.log.info('%s inviting %s in %s (%s | %s | %s)' % (msg.prefix,irc.nick,channel,self.registryValue('leaveChannelIfNoActivity',channel=channel),self.registryValue('lastActionTaken',channel=channel),self.registryValue('minimumUsersInChannel')))
+       self.log.info('%s inviting %s in %s (%s | %s | %s)' % (msg.prefix,irc.nick,channel,self.getPolicy(channel).leaveChannelIfNoActivity,self.registryValue('lastActionTaken',channel=channel),self.registryValue('minimumUsersInChannel')))
        if channel and not channel in irc.state.channels and not ircdb.checkIgnored(msg.prefix):
-           if self.registryValue('leaveChannelIfNoActivity',channel=channel) == -1:
+           if self.getPolicy(channel).leaveChannelIfNoActivity == -1:
                irc.queueMsg(ircmsgs.join(channel))
                self.logChannel(irc,"JOIN: [%s] due to %s's invite" % (channel,msg.prefix))
                try:
@@ -1853,7 +3632,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                 t.setDaemon(True)
                 t.start()
             account = account.lower().strip()
-            q = self.getIrcQueueFor(irc,account,'nsregister',600)
+            q = self.getIrcCounterFor(irc,'nsregister',account,600)
             q.enqueue(email)
         if msg.nick == 'NickServ':
             src = text.split(' ')[0].lower().strip()
@@ -1874,7 +3653,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                 grouping = True
                 target = text.split('UNGROUP: ')[1]
             if len(target) and grouping:
-                q = self.getIrcQueueFor(irc,src,'nsAccountGroup',120)
+                q = self.getIrcQueueFor(irc,'nsAccountGroup',src,120)
                 q.enqueue(text)
                 if len(q) == 3:
                     index = 0
@@ -1904,7 +3683,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                                     i.tokline[src] = src
                                     def f ():
                                         irc.sendMsg(ircmsgs.IrcMsg('WHOIS %s %s' % (src,src)))
-                                    schedule.addEvent(f,time.time()+random.randint(0,7))
+                                    i.wheel.schedule(f,time.time()+random.randint(0,7))
                                 break
     def do211 (self,irc,msg):
         i = self.getIrc(irc)
@@ -1919,7 +3698,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         channel = msg.args[1]
         value = msg.args[3]
         op = msg.args[4]
-        if self.registryValue('defconMode',channel=channel) and not i.defcon:
+        if self.getPolicy(channel).defconMode and not i.defcon:
             if value == '$~a' and op == irc.prefix:
                 if channel == self.registryValue('mainChannel'):
                     irc.sendMsg(ircmsgs.IrcMsg('MODE %s -qz $~a' % channel))
@@ -1940,9 +3719,10 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
             raw = ircutils.stripFormatting(text)
         except:
             raw = text
-        text = raw.lower()
         mask = self.prefixToMask(irc,msg.prefix)
         i = self.getIrc(irc)
+        context = MessageContext(raw,mask,i.matcher,self.registryValue('regexpBudget'))
+        text = context.text
         if not i.ping or time.time() - i.ping > self.registryValue('lagInterval'):
             i.ping = time.time()
             self.cleanup(irc)
@@ -1957,7 +3737,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                 i.defcon = False
                 self.logChannel(irc,"INFO: triggers restored to normal behaviour")
                 for channel in irc.state.channels:
-                    if irc.isChannel(channel) and self.registryValue('defconMode',channel=channel):
+                    if irc.isChannel(channel) and self.getPolicy(channel).defconMode:
                         if 'z' in irc.state.channels[channel].modes and irc.nick in list(irc.state.channels[channel].ops) and not 'm' in irc.state.channels[channel].modes:
                             irc.queueMsg(ircmsgs.IrcMsg('MODE %s q' % channel))
         if i.netsplit:
@@ -1980,19 +3760,20 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                     self.handleSnoopMessage(irc,msg)
                 if self.registryValue('secretChannel') == channel:
                     self.handleSecretMessage(irc,msg)
-                if self.registryValue('ignoreChannel',channel):
+                if self.getPolicy(channel).ignoreChannel:
                     continue
-                if ircdb.checkCapability(msg.prefix, 'protected'):
+                if self.capabilities.check(msg.prefix,None,'protected'):
                     if msg.nick in list(irc.state.channels[channel].ops) and irc.nick in text:
                         self.logChannel(irc,'OP: [%s] <%s> %s' % (channel,msg.nick,text))
                     continue
+                capabilities = self.capabilities.get(msg.prefix,channel)
                 chan = self.getChan(irc,channel)
                 if chan.called:
-                    if time.time() - chan.called > self.registryValue('abuseDuration',channel=channel):
+                    if time.time() - chan.called > self.getPolicy(channel).abuseDuration:
                         chan.called = False
                         if not i.defcon:
                             self.logChannel(irc,'INFO: [%s] returns to regular state' % channel)
-                        if irc.isChannel(channel) and self.registryValue('defconMode',channel=channel) and not i.defcon:
+                        if irc.isChannel(channel) and self.getPolicy(channel).defconMode and not i.defcon:
                             if 'z' in irc.state.channels[channel].modes and irc.nick in list(irc.state.channels[channel].ops) and not 'm' in irc.state.channels[channel].modes:
                                 irc.queueMsg(ircmsgs.IrcMsg('MODE %s q' % channel))
                 if isBanned:
@@ -2001,39 +3782,40 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                     if irc.nick in raw:
                         self.logChannel(irc,'OP: [%s] <%s> %s' % (channel,msg.nick,text))
                     continue
-                if self.registryValue('ignoreVoicedUser',channel=channel):
+                if self.getPolicy(channel).ignoreVoicedUser:
                     if msg.nick in list(irc.state.channels[channel].voices):
                         continue
-                protected = ircdb.makeChannelCapability(channel, 'protected')
-                if ircdb.checkCapability(msg.prefix, protected):
+                if capabilities & CapabilityCache.bits['protected']:
                     continue
-                if self.registryValue('ignoreRegisteredUser',channel=channel):
+                if self.getPolicy(channel).ignoreRegisteredUser:
                     if msg.nick in chan.nicks and len(chan.nicks[msg.nick]) > 4:
                         if chan.nicks[msg.nick][4]:
                             continue
-                killReason = self.registryValue('killMessage',channel=channel)
+                killReason = self.getPolicy(channel).killMessage
                 if msg.nick in chan.nicks and len(chan.nicks[msg.nick]) > 4:
                     if chan.nicks[msg.nick][3] == "https://webchat.freenode.net":
                         hh = mask.split('@')[1]
                         mask = '*@%s' % hh
-                flag = ircdb.makeChannelCapability(channel, 'pattern')
-                if ircdb.checkCapability(msg.prefix, flag):
-                    for k in i.patterns:
-                        pattern = i.patterns[k]
-                        if pattern.match(raw):
+                if capabilities & CapabilityCache.bits['pattern']:
+                    matches = context.matches()
+                    if len(i.matcher.slow):
+                        self.disableSlowPatterns(irc)
+                    for k in matches:
+                        pattern = i.patterns.get(k)
+                        if pattern:
                             if pattern.limit == 0:
                                 isBanned = True
                                 uid = random.randint(0,1000000)
                                 reason = '%s - matches #%s in %s' % (uid,pattern.uid,channel)
                                 log = 'BAD: [%s] %s (matches #%s - %s)' % (channel,msg.prefix,pattern.uid,uid)
                                 self.ban(irc,msg.nick,msg.prefix,mask,self.registryValue('klineDuration'),reason,self.registryValue('klineMessage'),log,killReason)
-                                i.count(self.getDb(irc.network),pattern.uid)
+                                i.count(pattern.uid)
                                 chan.klines.enqueue('%s %s' % (msg.nick.lower(),mask))
                                 self.isAbuseOnChannel(irc,channel,'pattern',mask)
                                 self.setRegistryValue('lastActionTaken',time.time(),channel=channel)
                                 break
                             else:
-                                queue = self.getIrcQueueFor(irc,mask,pattern.uid,pattern.life)
+                                queue = self.getIrcCounterFor(irc,'pattern',(mask,pattern.uid),pattern.life)
                                 queue.enqueue(text)
                                 if len(queue) > pattern.limit:
                                     isBanned = True
@@ -2042,15 +3824,15 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                                     log = 'BAD: [%s] %s (matches #%s %s/%ss - %s)' % (channel,msg.prefix,pattern.uid,pattern.limit,pattern.life,uid)
                                     self.ban(irc,msg.nick,msg.prefix,mask,self.registryValue('klineDuration'),reason,self.registryValue('klineMessage'),log,killReason)
                                     self.rmIrcQueueFor(irc,mask)
-                                    i.count(self.getDb(irc.network),pattern.uid)
+                                    i.count(pattern.uid)
                                     chan.klines.enqueue('%s %s' % (msg.nick.lower(),mask))
                                     self.isAbuseOnChannel(irc,channel,'pattern',mask)
                                     self.setRegistryValue('lastActionTaken',time.time(),channel=channel)
                                     break
-                                i.count(self.getDb(irc.network),pattern.uid)
+                                i.count(pattern.uid)
                 if isBanned:
                     continue
-                if i.defcon and self.isChannelUniSpam(irc,msg,channel,mask,text):
+                if i.defcon and self.isChannelUniSpam(irc,msg,channel,mask,context):
                     isBanned = True
                     uid = random.randint(0,1000000)
                     reason = '!dnsbl UniSpam'
@@ -2062,7 +3844,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                     i.defcon = time.time()
                 if isBanned:
                     continue
-                ignoreDuration = self.registryValue('ignoreDuration',channel=channel)
+                ignoreDuration = self.getPolicy(channel).ignoreDuration
                 if not msg.nick in chan.nicks:
                     t = time.time()
                     if isCloaked(msg.prefix,self):
@@ -2075,145 +3857,50 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                         isIgnored = True
                 reason = ''
                 publicreason = ''
-                if self.registryValue('joinSpamPartPermit',channel=channel) > -1:
+                if self.getPolicy(channel).joinSpamPartPermit > -1:
                     kind = 'joinSpamPart'
-                    life = self.registryValue('joinSpamPartLife',channel=channel)
+                    life = self.getPolicy(channel).joinSpamPartLife
                     key = mask
-                    isNew = False
-                    if not kind in chan.buffers:
-                        chan.buffers[kind] = {}
-                    if not key in chan.buffers[kind]:
-                        isNew = True
-                        chan.buffers[kind][key] = utils.structures.TimeoutQueue(life)
-                    elif chan.buffers[kind][key].timeout != life:
-                        chan.buffers[kind][key].setTimeout(life)
-                    chan.buffers[kind][key].enqueue(key)
-                    if not isIgnored and isNew and len(chan.buffers[kind][key]) == 1 and text.startswith('http') and time.time()-chan.nicks[msg.nick][0] < 15 and 'z' in irc.state.channels[channel].modes and channel == '#freenode':
+                    isNew = not kind in chan.buffers or not key in chan.buffers[kind]
+                    buffer = self.getChanBufferFor(irc,channel,kind,key,life)
+                    buffer.enqueue(key)
+                    if not isIgnored and isNew and len(buffer) == 1 and text.startswith('http') and time.time()-chan.nicks[msg.nick][0] < 15 and 'z' in irc.state.channels[channel].modes and channel == '#freenode':
                         publicreason = 'link spam once joined'
                         reason = 'linkspam'
-                badunicode = False
-                flag = ircdb.makeChannelCapability(channel,'badunicode')
-                if ircdb.checkCapability(msg.prefix,flag):
-                    badunicode = self.isChannelUnicode(irc,msg,channel,mask,text)
-                    if badunicode and self.hasAbuseOnChannel(irc,channel,'badunicode'):
-                        isIgnored = False
-                    if badunicode:
-                        publicreason = 'unreadable unicode glyphes'
-                        reason = badunicode
-                hilight = False
-                flag = ircdb.makeChannelCapability(channel, 'hilight')
-                if ircdb.checkCapability(msg.prefix, flag):
-                    hilight = self.isChannelHilight(irc,msg,channel,mask,text)
-                    if hilight and self.hasAbuseOnChannel(irc,channel,'hilight'):
-                        isIgnored = False
-                    if hilight:
-                         publicreason = 'nicks/hilight spam'
-                         reason = hilight
-                if chan.patterns and not len(reason):
-                    for pattern in chan.patterns:
-                        if pattern in text:
+                # detectors cheapest first, the best ranked one gives the reason
+                best = None
+                if reason:
+                    best = _linkspamRank
+                results = {}
+                done = set()
+                pipeline = self.getPipeline(channel)
+                for detector in pipeline.detectors:
+                    stats = self.detectorStats[detector.name]
+                    if best is not None and detector.rank > best:
+                        if detector.fallback:
+                            done.add(detector.name)
+                            continue
+                        if detector.skippable and not isIgnored and pipeline.decided(best,done):
+                            stats.skipped = stats.skipped + 1
+                            done.add(detector.name)
+                            continue
+                    done.add(detector.name)
+                    if detector.name in CapabilityCache.bits and not capabilities & CapabilityCache.bits[detector.name]:
+                        continue
+                    start = time.thread_time()
+                    result = detector.run(self,irc,msg,channel,mask,context,isNotice)
+                    stats.cpu = stats.cpu + time.thread_time() - start
+                    stats.calls = stats.calls + 1
+                    if result:
+                        stats.triggers = stats.triggers + 1
+                        results[detector.name] = result
+                        if detector.fallback or self.hasAbuseOnChannel(irc,channel,detector.name):
                             isIgnored = False
-                            reason = 'matches tmp pattern in %s' % channel
-                            publicreason = 'your sentence matches temporary blacklisted words'
-                            chan.patterns.enqueue(pattern)
-                            self.isAbuseOnChannel(irc,channel,'pattern',mask)
-                            break
-                massrepeat = False
-                flag = ircdb.makeChannelCapability(channel, 'massRepeat')
-                if ircdb.checkCapability(msg.prefix, flag):
-                    massrepeat = self.isChannelMassRepeat(irc,msg,channel,mask,text)
-                    if massrepeat and self.hasAbuseOnChannel(irc,channel,'massRepeat'):
-                        isIgnored = False
-                lowmassrepeat = False
-                flag = ircdb.makeChannelCapability(channel, 'lowMassRepeat')
-                if ircdb.checkCapability(msg.prefix, flag):
-                    lowmassrepeat = self.isChannelLowMassRepeat(irc,msg,channel,mask,text)
-                    if lowmassrepeat and self.hasAbuseOnChannel(irc,channel,'lowMassRepeat'):
-                        isIgnored = False
-                repeat = False
-                flag = ircdb.makeChannelCapability(channel, 'repeat')
-                if ircdb.checkCapability(msg.prefix, flag):
-                    repeat = self.isChannelRepeat(irc,msg,channel,mask,text)
-                    if repeat and self.hasAbuseOnChannel(irc,channel,'repeat'):
-                        isIgnored = False
-                lowrepeat = False
-                flag = ircdb.makeChannelCapability(channel, 'lowRepeat')
-                if ircdb.checkCapability(msg.prefix, flag):
-                    lowrepeat = self.isChannelLowRepeat(irc,msg,channel,mask,text)
-                    if lowrepeat and self.hasAbuseOnChannel(irc,channel,'lowRepeat'):
-                        isIgnored = False
-                lowhilight = False
-                flag = ircdb.makeChannelCapability(channel, 'lowHilight')
-                if ircdb.checkCapability(msg.prefix, flag):
-                    lowhilight = self.isChannelLowHilight(irc,msg,channel,mask,text)
-                    if lowhilight and self.hasAbuseOnChannel(irc,channel,'lowHilight'):
-                        isIgnored = False
-                flood = False
-                flag = ircdb.makeChannelCapability(channel, 'flood')
-                if ircdb.checkCapability(msg.prefix, flag):
-                    flood = self.isChannelFlood(irc,msg,channel,mask,text)
-                    if flood and self.hasAbuseOnChannel(irc,channel,'flood'):
-                        isIgnored = False
-                lowflood = False
-                flag = ircdb.makeChannelCapability(channel, 'lowFlood')
-                if ircdb.checkCapability(msg.prefix, flag):
-                    lowflood = self.isChannelLowFlood(irc,msg,channel,mask,text)
-                    if lowflood and self.hasAbuseOnChannel(irc,channel,'lowFlood'):
-                        isIgnored = False
-                ctcp = False
-                flag = ircdb.makeChannelCapability(channel, 'ctcp')
-                if ircdb.checkCapability(msg.prefix, flag):
-                    if not ircmsgs.isAction(msg) and ircmsgs.isCtcp(msg):
-                        ctcp = self.isChannelCtcp(irc,msg,channel,mask,text)
-                    if ctcp and self.hasAbuseOnChannel(irc,channel,'ctcp'):
-                        isIgnored = False
-                notice = False
-                flag = ircdb.makeChannelCapability(channel, 'notice')
-                if ircdb.checkCapability(msg.prefix, flag):
-                    if not ircmsgs.isAction(msg) and isNotice:
-                        notice = self.isChannelNotice(irc,msg,channel,mask,text)
-                    if notice and self.hasAbuseOnChannel(irc,channel,'notice'):
-                        isIgnored = False
-                cap = False
-                flag = ircdb.makeChannelCapability(channel, 'cap')
-                if ircdb.checkCapability(msg.prefix, flag):
-                    cap = self.isChannelCap(irc,msg,channel,mask,raw)
-                    if cap and self.hasAbuseOnChannel(irc,channel,'cap'):
-                        isIgnored = False
-                if not reason:
-                    if massrepeat:
-                        reason = massrepeat
-                        publicreason = 'repetition detected'
-                    elif lowmassrepeat:
-                        reason = lowmassrepeat
-                        publicreason = 'repetition detected'
-                    elif repeat:
-                        reason = repeat
-                        publicreason = 'repetition detected'
-                    elif lowrepeat:
-                        reason = lowrepeat
-                        publicreason = 'repetition detected'
-                    elif hilight:
-                        reason = hilight
-                        publicreason = 'nicks/hilight spam'
-                    elif lowhilight:
-                        reason = lowhilight
-                        publicreason = 'nicks/hilight spam'
-                    elif cap:
-                        reason = cap
-                        publicreason = 'uppercase detected'
-                    elif flood:
-                        reason = flood
-                        publicreason = 'flood detected'
-                    elif lowflood:
-                        reason = lowflood
-                        publicreason = 'flood detected'
-                    elif ctcp:
-                        reason = ctcp
-                        publicreason = 'channel CTCP'
-                    elif notice:
-                        reason = notice
-                        publicreason = 'channel notice'
+                        if best is None or detector.rank < best:
+                            best = detector.rank
+                            reason = result
+                            publicreason = detector.publicreason
+                hilight = results.get('hilight',False)
                 if reason:
                     if isIgnored:
                         if self.warnedOnOtherChannel(irc,channel,mask):
@@ -2236,7 +3923,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                             if i.defcon:
                                 i.defcon = time.time()
                         else:
-                            q = self.getIrcQueueFor(irc,mask,'warned-%s' % channel,self.registryValue('alertPeriod'))
+                            q = self.getIrcCounterFor(irc,'warned',(mask,channel),self.registryValue('alertPeriod'))
                             if len(q) == 0:
                                 q.enqueue(text)
                                 self.logChannel(irc,'IGNORED: [%s] %s (%s)' % (channel,msg.prefix,reason))
@@ -2272,26 +3959,24 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
 
                 if not isBanned:
                     mini = self.registryValue('amsgMinimum')
-                    if len(text) > mini or text.find('http') != -1:
+                    features = context.features()
+                    if features.length > mini or features.url:
                         limit = self.registryValue('amsgPermit')
                         if limit > -1:
                             life = self.registryValue('amsgLife')
                             percent = self.registryValue('amsgPercent')
-                            queue = self.getIrcQueueFor(irc,mask,channel,life)
-                            queue.enqueue(text)
+                            bits = context.fingerprint()
+                            # recent messages of the mask in every channel, only those are compared
+                            queue = self.getIrcQueueFor(irc,'amsgRecent',mask,life)
                             found = None
-                            for ch in i.channels:
-                                chc = self.getChan(irc,ch)
-                                if msg.nick in chc.nicks and ch != channel:
-                                    queue = self.getIrcQueueFor(irc,mask,ch,life)
-                                    for m in queue:
-                                        if compareString(m,text) > percent:
-                                            found = ch
-                                            break
-                                    if found:
+                            for (ch,m,fm) in queue:
+                                if ch != channel and ch in i.channels and msg.nick in i.channels[ch].nicks:
+                                    if compareFingerprint(m,fm,text,bits) > percent:
+                                        found = ch
                                         break
+                            queue.enqueue((channel,text,bits))
                             if found:
-                                queue = self.getIrcQueueFor(irc,mask,'amsg',life)
+                                queue = self.getIrcQueueFor(irc,'amsg',mask,life)
                                 flag = False
                                 for q in queue:
                                     if found in q:
@@ -2302,15 +3987,14 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                                 if len(queue) > limit:
                                     chs = list(queue)
                                     queue.reset()
-                                    key = 'amsg %s' % mask
-                                    q = self.getIrcQueueFor(irc,key,'amsg',self.registryValue('alertPeriod'))
+                                    q = self.getIrcCounterFor(irc,'amsgAlert',mask,self.registryValue('alertPeriod'))
                                     if len(q) == 0:
                                         q.enqueue(mask)
                                         chs.append(channel)
                                         self.logChannel(irc,'AMSG: %s (%s) in %s' % (msg.nick,text,', '.join(chs)))
                                         for channel in i.channels:
                                             chan = self.getChan(irc,channel)
-                                            life = self.registryValue('computedPatternLife',channel=channel)
+                                            life = self.getPolicy(channel).computedPatternLife
                                             if not chan.patterns:
                                                 chan.patterns = utils.structures.TimeoutQueue(life)
                                             elif chan.patterns.timeout != life:
@@ -2350,7 +4034,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                if result:
                    ip = result.group(0)
                    if ip and 'type register to' in text:
-                       q = self.getIrcQueueFor(irc,ip,'register',self.registryValue('registerLife'))
+                       q = self.getIrcQueueFor(irc,'register',ip,self.registryValue('registerLife'))
                        q.enqueue(email)
                        if len(q) > self.registryValue('registerPermit'):
                            ms = []
@@ -2363,7 +4047,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                            else:
                                self.logChannel(irc,'SERVICE: %s load of accounts %s' % (h,', '.join(ms)))
                if 'type register to' in text:
-                   q = self.getIrcQueueFor(irc,email,'register',self.registryValue('registerLife'))
+                   q = self.getIrcQueueFor(irc,'register',email,self.registryValue('registerLife'))
                    text = text.replace('email for ','')
                    text = text.split(' type register')[0]
                    q.enqueue(text.strip())
@@ -2378,7 +4062,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                if limit > -1:
                    origin = text.split(' ')[0]
                    target = text.split(' ').pop()
-                   q = self.getIrcQueueFor(irc,origin,target,life)
+                   q = self.getIrcCounterFor(irc,'akick',(origin,target),life)
                    q.enqueue(text)
                    if len(q) > limit:
                        q.reset()
@@ -2439,7 +4123,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                         if found:
                             def k():
                                 self.kline(irc,hostmask,mask,self.registryValue('klineDuration'),'!dnsbl (%s in suspicious mask)' % found)
-                            schedule.addEvent(k,time.time()+random.uniform(1, 6))
+                            i.wheel.schedule(k,time.time()+random.uniform(1, 6))
                 if text.startswith('Killing client ') and 'due to lethal mask ' in text:
                     patterns = self.registryValue('droneblPatterns')
                     found = False
@@ -2461,6 +4145,9 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                             self.prefixToMask(irc,'*!*@%s' % ip,'',True,found)
 
     def doPrivmsg (self,irc,msg):
+        if callbacks.addressed(irc,msg):
+            # commands (identify, capability, hostmask...) change what ircdb knows, in memory only when it is not flushed
+            self.capabilities.expire()
         self.handleMsg(irc,msg,False)
         try:
             i = self.getIrc(irc)
@@ -2475,19 +4162,22 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                 if channel.startswith('+'):
                     channel = channel.replace('+','',1)
                 if not irc.isChannel(channel) and channel == irc.nick:
-                    killReason = self.registryValue('killMessage',channel=channel)
-                    for k in i.patterns:
-                        pattern = i.patterns[k]
-                        if pattern.match(text):
+                    killReason = self.getPolicy(channel).killMessage
+                    matches = i.matcher.match(text,self.registryValue('regexpBudget'))
+                    if len(i.matcher.slow):
+                        self.disableSlowPatterns(irc)
+                    for k in matches:
+                        pattern = i.patterns.get(k)
+                        if pattern:
                             if pattern.limit == 0:
                                 uid = random.randint(0,1000000)
                                 reason = '%s - matches #%s in pm' % (pattern.uid,uid)
                                 log = 'BAD: [%s] %s (matches #%s - %s)' % (channel,msg.prefix,pattern.uid,uid)
                                 self.ban(irc,msg.nick,msg.prefix,mask,self.registryValue('klineDuration'),reason,self.registryValue('klineMessage'),log,killReason)
-                                i.count(self.getDb(irc.network),pattern.uid)
+                                i.count(pattern.uid)
                                 break
                             else:
-                                queue = self.getIrcQueueFor(irc,mask,pattern.uid,pattern.life)
+                                queue = self.getIrcCounterFor(irc,'pattern',(mask,pattern.uid),pattern.life)
                                 queue.enqueue(text)
                                 if len(queue) > pattern.limit:
                                     uid = random.randint(0,1000000)
@@ -2495,9 +4185,9 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                                     log = 'BAD: [%s] %s (matches #%s %s/%ss - %s)' % (channel,msg.prefix,pattern.uid,pattern.limit,pattern.life,uid)
                                     self.ban(irc,msg.nick,msg.prefix,mask,self.registryValue('klineDuration'),reason,self.registryValue('klineMessage'),log,killReason)
                                     self.rmIrcQueueFor(irc,mask)
-                                    i.count(self.getDb(irc.network),pattern.uid)
+                                    i.count(pattern.uid)
                                     break
-                                i.count(self.getDb(irc.network),pattern.uid)
+                                i.count(pattern.uid)
         except:
             return
 
@@ -2525,10 +4215,10 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
             life = self.registryValue('channelFloodLife')
             key = 'snoteFloodAlerted'
             if limit > -1:
-                if not self.registryValue('ignoreChannel',target):
+                if not self.getPolicy(target).ignoreChannel:
                     protected = ircdb.makeChannelCapability(target, 'protected')
                     if not ircdb.checkCapability(user, protected):
-                        queue = self.getIrcQueueFor(irc,target,'snoteFlood',life)
+                        queue = self.getIrcQueueFor(irc,'snoteFlood',target,life)
                         if i.defcon:
                             if limit > 0:
                                 limit = limit - 1
@@ -2543,7 +4233,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                         if len(queue) > limit:
                             self.logChannel(irc,'NOTE: [%s] is flooded by %s' % (target,', '.join(users)))
                             queue.reset()
-                            queue = self.getIrcQueueFor(irc,target,'snoteFloodJoin',life)
+                            queue = self.getIrcCounterFor(irc,'snoteFloodJoin',target,life)
                             queue.enqueue(text)
                             if len(queue) > 1 or i.defcon:
                                 if self.registryValue('lastActionTaken',channel=target) > 0.0 and not target in irc.state.channels:
@@ -2553,7 +4243,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                                             uid = random.randint(0,1000000)
                                             self.kline(irc,user,mask,self.registryValue('klineDuration'),'%s - snote flood on %s' % (uid,target))
                                             self.logChannel(irc,"BAD: %s (snote flood on %s - %s)" % (user,target,uid))
-                                    t = time.time() - (self.registryValue('leaveChannelIfNoActivity',channel=target) * 24 * 3600) + 1800
+                                    t = time.time() - (self.getPolicy(target).leaveChannelIfNoActivity * 24 * 3600) + 1800
                                     self.setRegistryValue('lastActionTaken',t,channel=target)
                                     irc.sendMsg(ircmsgs.join(target))
                                     self.logChannel(irc,"JOIN: [%s] due to flood snote" % target)
@@ -2569,7 +4259,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
             if limit > -1:
                 if target.startswith('freenode-connect'):
                     return
-                queue = self.getIrcQueueFor(irc,target,'snoteFlood',life)
+                queue = self.getIrcQueueFor(irc,'snoteFlood',target,life)
                 stored = False
                 for u in queue:
                     if u == user:
@@ -2580,7 +4270,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                 users = list(queue)
                 if len(queue) > limit:
                     queue.reset()
-                    queue = self.getIrcQueueFor(irc,target,'snoteFloodLethal',life)
+                    queue = self.getIrcQueueFor(irc,'snoteFloodLethal',target,life)
                     queue.enqueue(','.join(users))
                     if i.defcon or len(queue) > 1:
                         for m in queue:
@@ -2594,7 +4284,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                         self.logChannel(irc,'NOTE: %s is flooded by %s' % (target,', '.join(users)))
                 if ircdb.checkCapability(user, 'protected'):
                     return
-                queue = self.getIrcQueueFor(irc,user,'snoteFlood',life)
+                queue = self.getIrcQueueFor(irc,'snoteFlood',user,life)
                 stored = False
                 for u in queue:
                     if u == target:
@@ -2605,7 +4295,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                 if len(queue)> limit:
                     targets = list(queue)
                     queue.reset()
-                    queue = self.getIrcQueueFor(irc,user,'snoteFloodLethal',life)
+                    queue = self.getIrcQueueFor(irc,'snoteFloodLethal',user,life)
                     queue.enqueue(target)
                     if i.defcon or len(queue) > 1:
                          mask = self.prefixToMask(irc,user)
@@ -2619,7 +4309,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         limit = self.registryValue('joinRatePermit')
         life = self.registryValue('joinRateLife')
         target = text.split('trying to join ')[1].split(' is')[0]
-        if self.registryValue('ignoreChannel',target):
+        if self.getPolicy(target).ignoreChannel:
             return
         user = text.split('User ')[1].split(')')[0]
         user = user.replace('(','!').replace(')','').replace(' ','')
@@ -2631,7 +4321,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         protected = ircdb.makeChannelCapability(target, 'protected')
         if ircdb.checkCapability(user, protected):
             return
-        queue = self.getIrcQueueFor(irc,user,'snoteJoin',life)
+        queue = self.getIrcQueueFor(irc,'snoteJoin',user,life)
         stored = False
         for u in queue:
             if u == user:
@@ -2644,7 +4334,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         if len(queue) > limit and limit > 0:
             users = list(queue)
             queue.reset()
-            queue = self.getIrcQueueFor(irc,user,'snoteJoinAlert',self.registryValue('alertPeriod'))
+            queue = self.getIrcCounterFor(irc,'snoteJoinAlert',user,self.registryValue('alertPeriod'))
             if len(queue):
                self.logChannel(irc,'NOTE: [%s] join/part by %s' % (target,', '.join(users)))
             queue.enqueue(','.join(users))
@@ -2652,7 +4342,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         limit = self.registryValue('crawlPermit')
         if limit < 0:
             return
-        queue = self.getIrcQueueFor(irc,mask,'snoteJoin',life)
+        queue = self.getIrcQueueFor(irc,'snoteJoin',mask,life)
         stored = False
         for u in queue:
             if u == target:
@@ -2665,7 +4355,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         if len(queue) > limit:
             channels = list(queue)
             queue.reset()
-            queue = self.getIrcQueueFor(irc,mask,'snoteJoinLethal',self.registryValue('alertPeriod'))
+            queue = self.getIrcCounterFor(irc,'snoteJoinLethal',mask,self.registryValue('alertPeriod'))
             if len(queue) == 0:
                 self.logChannel(irc,'NOTE: %s is indexing the network (%s)' % (user,', '.join(channels)))
                 queue.enqueue(mask)
@@ -2683,23 +4373,17 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         life = self.registryValue('idLife')
         if limit < 0:
             return
-        queue = self.getIrcQueueFor(irc,user,'snoteId',life)
+        queue = self.getIrcQueueFor(irc,'snoteId',user,life)
         queue.enqueue(target)
         i = self.getIrc(irc)
         targets = []
-        key = 'snoteIdAlerted'
+        alerted = i.queues.table('snoteIdAlerted')
         if len(queue) > limit:
             targets = list(queue)
             queue.reset()
-            if not key in i.queues[user]:
-                def rcu():
-                    i = self.getIrc(irc)
-                    if user in i.queues:
-                        if key in i.queues[user]:
-                            del i.queues[user][key]
-                i.queues[user][key] = time.time()
-                schedule.addEvent(rcu,time.time()+self.registryValue('abuseLife'))
-        if key in i.queues[user]:
+            if not user in alerted:
+                alerted.mark(user,self.registryValue('abuseLife'))
+        if user in alerted:
             if len(queue):
                 targets = list(queue)
                 queue.reset()
@@ -2716,20 +4400,14 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                     privateReason = '!dnsbl ' + privateReason
                 self.kline(irc,user,mask,self.registryValue('klineDuration'), privateReason)
                 self.logChannel(irc,"BAD: %s (%s)" % (user,privateReason))
-        queue = self.getIrcQueueFor(irc,target,'snoteId',life)
+        queue = self.getIrcQueueFor(irc,'snoteId',target,life)
         queue.enqueue(user)
         targets = []
         if len(queue) > limit:
             targets = list(queue)
             queue.reset()
-            def rct():
-                i = self.getIrc(irc)
-                if target in i.queues:
-                    if key in i.queues[target]:
-                        del i.queues[target][key]
-            i.queues[target][key] = time.time()
-            schedule.addEvent(rct,time.time()+self.registryValue('abuseLife'))
-        if key in i.queues[target]:
+            alerted.mark(target,self.registryValue('abuseLife'))
+        if target in alerted:
             if len(queue):
                 targets = list(queue)
                 queue.reset()
@@ -2786,7 +4464,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
             announced = False
             for range in ranges:
                 range = range
-                queue = self.getIrcQueueFor(irc,range,'klineNote',7)
+                queue = self.getIrcCounterFor(irc,'klineNote',range,7)
                 queue.enqueue(user)
                 if len(queue) == permit:
                     if not announced:
@@ -2808,7 +4486,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         i = self.getIrc(irc)
         if not i.defcon:
             return
-        queue = self.getIrcQueueFor(irc,mask,'snoteNick',life)
+        queue = self.getIrcQueueFor(irc,'snoteNick',mask,life)
         queue.enqueue(nick)
         if len(queue) > limit:
             nicks = list(queue)
@@ -2853,7 +4531,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                     account = text.split('(')[1].split(')')[0]
                     account = account.split('@gateway/vpn/privateinternetaccess/')[1].split('/')[0]
                     #self.log.info('connecting %s' % account)
-                    q = self.getIrcQueueFor(irc,account,'nsregister',600)
+                    q = self.getIrcCounterFor(irc,'nsregister',account,600)
                     if len(q) == 1:
                         self.logChannel(irc,"SERVICE: fresh account %s moved to pia" % account)
             if text.startswith('Possible Flooder '):
@@ -2887,7 +4565,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                         i = self.getIrc(irc)
                         if 'services.' in i.limits:
                             del i.limits['services.']
-                    schedule.addEvent(rct,time.time()+self.registryValue('alertPeriod'))
+                    i.wheel.schedule(rct,time.time()+self.registryValue('alertPeriod'))
             elif 'K-Line for [*@' in text:
                 oper = text.split(' ')[0]
                 i = self.getIrc(irc)
@@ -2944,7 +4622,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                 if utils.net.isIPV4(ip) or utils.net.bruteIsIPV6(ip):
                     if not ip in self.ipfiltered:
                         if self.registryValue('serverFilteringPermit') > -1:
-                            q = self.getIrcQueueFor(irc,'serverSideFiltering',ip,self.registryValue('serverFilteringLife'))
+                            q = self.getIrcCounterFor(irc,'serverSideFiltering',ip,self.registryValue('serverFilteringLife'))
                             q.enqueue(ip)
                             reason = 'Server Side Filtering'
                             if len(q) > self.registryValue('serverFilteringPermit'):
@@ -3015,7 +4693,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
     def hasAbuseOnChannel (self,irc,channel,key):
         chan = self.getChan(irc,channel)
         kind = 'abuse'
-        limit = self.registryValue('%sPermit' % kind,channel=channel)
+        limit = getattr(self.getPolicy(channel),'%sPermit' % kind)
         if kind in chan.buffers:
             if key in chan.buffers[kind]:
                 if len(chan.buffers[kind][key]) > limit:
@@ -3025,35 +4703,30 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
     def isAbuseOnChannel (self,irc,channel,key,mask):
         chan = self.getChan(irc,channel)
         kind = 'abuse'
-        limit = self.registryValue('%sPermit' % kind,channel=channel)
+        limit = getattr(self.getPolicy(channel),'%sPermit' % kind)
         if limit < 0:
             return False
-        life = self.registryValue('%sLife' % kind,channel=channel)
-        if not kind in chan.buffers:
-            chan.buffers[kind] = {}
-        if not key in chan.buffers[kind]:
-            chan.buffers[kind][key] = utils.structures.TimeoutQueue(life)
-        elif chan.buffers[kind][key].timeout != life:
-            chan.buffers[kind][key].setTimeout(life)
+        life = getattr(self.getPolicy(channel),'%sLife' % kind)
+        buffer = self.getChanBufferFor(irc,channel,kind,key,life,queue=True)
         found = False
-        for m in chan.buffers[kind][key]:
+        for m in buffer:
             if mask == m:
                 found = True
                 break
         if not found:
-            chan.buffers[kind][key].enqueue(mask)
+            buffer.enqueue(mask)
         i = self.getIrc(irc)
         if i.defcon:
             limit = limit - 1
             if limit < 0:
                limit = 0
-        if len(chan.buffers[kind][key]) > limit:
-            self.log.debug('abuse in %s : %s : %s/%s' % (channel,key,len(chan.buffers[kind][key]),limit))
-            # chan.buffers[kind][key].reset()
+        if len(buffer) > limit:
+            self.log.debug('abuse in %s : %s : %s/%s' % (channel,key,len(buffer),limit))
+            # buffer.reset()
             # queue not reseted, that way during life, it returns True
             if not chan.called:
                 if not i.defcon:
-                    self.logChannel(irc,"INFO: [%s] ignores lifted, limits lowered due to %s abuses for %ss" % (channel,key,self.registryValue('abuseDuration',channel=channel)))
+                    self.logChannel(irc,"INFO: [%s] ignores lifted, limits lowered due to %s abuses for %ss" % (channel,key,self.getPolicy(channel).abuseDuration))
                 if not i.defcon:
                     i.defcon = time.time()
                     if not i.god:
@@ -3066,7 +4739,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
 
     def isBadOnChannel (self,irc,channel,kind,key):
         chan = self.getChan(irc,channel)
-        limit = self.registryValue('%sPermit' % kind,channel=channel)
+        limit = getattr(self.getPolicy(channel),'%sPermit' % kind)
         if limit < 0:
             return False
         i = self.getIrc(irc)
@@ -3074,29 +4747,22 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
             kinds = ['flood','lowFlood','nick','lowRepeat','lowMassRepeat','broken']
             if kind in kinds:
                 return False
-        life = self.registryValue('%sLife' % kind,channel=channel)
+        life = getattr(self.getPolicy(channel),'%sLife' % kind)
         if limit == 0:
             return '%s %s/%ss in %s' % (kind,limit,life,channel)
-        if not kind in chan.buffers:
-            chan.buffers[kind] = {}
-        newUser = False
-        if not key in chan.buffers[kind]:
-            newUser = True
-            chan.buffers[kind][key] = utils.structures.TimeoutQueue(life)
-            chan.buffers[kind]['%s-creation' % key] = time.time()
-        elif chan.buffers[kind][key].timeout != life:
-            chan.buffers[kind][key].setTimeout(life)
-        ignore = self.registryValue('ignoreDuration',channel=channel)
+        newUser = not kind in chan.buffers or not key in chan.buffers[kind]
+        buffer = self.getChanBufferFor(irc,channel,kind,key,life)
+        ignore = self.getPolicy(channel).ignoreDuration
         if ignore > 0:
-           if time.time() - chan.buffers[kind]['%s-creation' % key] < ignore:
+           if time.time() - buffer.created < ignore:
                newUser = True
-        chan.buffers[kind][key].enqueue(key)
+        buffer.enqueue(key)
         if newUser or i.defcon or self.hasAbuseOnChannel(irc,channel,kind) or chan.called:
             limit = limit - 1
             if limit < 0:
                 limit = 0
-        if len(chan.buffers[kind][key]) > limit:
-            chan.buffers[kind][key].reset()
+        if len(buffer) > limit:
+            buffer.reset()
             if not kind == 'broken':
                 self.isAbuseOnChannel(irc,channel,kind,key)
             return '%s %s/%ss in %s' % (kind,limit,life,channel)
@@ -3110,9 +4776,9 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
             return False;
         return len(chan.buffers[kind][key]) > 0
 
-    def isChannelUniSpam (self,irc,msg,channel,mask,text):
-        count = len([char for char in text if char in self.spamchars])
-        return len(text) < 32 and count >=3
+    def isChannelUniSpam (self,irc,msg,channel,mask,context):
+        features = context.features()
+        return features.length < 32 and features.spamchars >= 3
 
     def isChannelCtcp (self,irc,msg,channel,mask,text):
         return self.isBadOnChannel(irc,channel,'ctcp',mask)
@@ -3123,24 +4789,25 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
     def isChannelLowFlood (self,irc,msg,channel,mask,text):
         return self.isBadOnChannel(irc,channel,'lowFlood',mask)
 
-    def isChannelCap (self,irc,msg,channel,mask,text):
-        text = text.replace(' ','')
-        if len(text) == 0 or len(text) > self.registryValue('capMinimum',channel=channel):
-            limit = self.registryValue('capPermit',channel=channel)
+    def isChannelCap (self,irc,msg,channel,mask,context):
+        features = context.features()
+        (matchs,length) = (features.upper,features.spaceless)
+        if length == 0 or length > self.getPolicy(channel).capMinimum:
+            limit = self.getPolicy(channel).capPermit
             if limit < 0:
                 return False
-            trigger = self.registryValue('capPercent',channel=channel)
-            matchs = self.recaps.findall(text)
-            #self.log.info ('%s : %s : %s :%s' % (mask,channel,text,len(matchs)))
-            if len(matchs) and len(text):
-                percent = (len(matchs)*100) / (len(text) * 1.0)
+            trigger = self.getPolicy(channel).capPercent
+            #self.log.info ('%s : %s : %s :%s' % (mask,channel,context.raw,matchs))
+            if matchs and length:
+                percent = (matchs*100) / (length * 1.0)
                 #self.log.info ('%s: %s/%s %s' % (mask,percent,trigger,text))
                 if percent >= trigger:
                     return self.isBadOnChannel(irc,channel,'cap',mask)
         return False
 
-    def isChannelFlood (self,irc,msg,channel,mask,text):
-        if len(text) == 0 or len(text) >= self.registryValue('floodMinimum',channel=channel) or text.isdigit():
+    def isChannelFlood (self,irc,msg,channel,mask,context):
+        features = context.features()
+        if features.length == 0 or features.length >= self.getPolicy(channel).floodMinimum or features.digit:
             return self.isBadOnChannel(irc,channel,'flood',mask)
         return False
 
@@ -3150,11 +4817,11 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
     def isChannelLowHilight (self,irc,msg,channel,mask,text):
         return self.isHilight(irc,msg,channel,mask,text,True)
 
-    def isChannelUnicode (self,irc,msg,channel,mask,text):
-        limit = self.registryValue('badunicodeLimit',channel=channel)
+    def isChannelUnicode (self,irc,msg,channel,mask,context):
+        limit = self.getPolicy(channel).badunicodeLimit
         if limit > 0:
-            score = sequence_weirdness(u'%s' % text)
-            count = self.registryValue('badunicodeScore',channel=channel)
+            score = context.weirdness()
+            count = self.getPolicy(channel).badunicodeScore
             if count < score:
                 return self.isBadOnChannel(irc,channel,'badunicode',mask)
         return False
@@ -3163,51 +4830,49 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         kind = 'hilight'
         if low:
             kind = 'lowHilight'
-        limit = self.registryValue('%sNick' % kind,channel=channel)
+        limit = getattr(self.getPolicy(channel),'%sNick' % kind)
         if limit < 0:
             return False
-        count = 0
-        users = []
-        if channel in irc.state.channels and irc.isChannel(channel):
-            for u in list(irc.state.channels[channel].users):
-                if u == 'ChanServ' or u == msg.nick:
-                    continue
-                users.append(u.lower())
         flag = False
-        us = {}
-        for user in users:
-            if len(user) > 3:
-                if not user in us and user in text:
-                    us[user] = True
-                    count = count + 1
-                    if count > limit:
-                        flag = True
-                        break
+        if channel in irc.state.channels and irc.isChannel(channel):
+            nicks = self.getChan(irc,channel).hilights
+            nicks.sync(irc.state.channels[channel].users)
+            flag = nicks.count(text,msg.nick) > limit
         result = False
         if flag:
             result = self.isBadOnChannel(irc,channel,kind,mask)
         return result
 
-    def isChannelRepeat (self,irc,msg,channel,mask,text):
-        return self.isRepeat(irc,msg,channel,mask,text,False)
+    def isChannelTmpPattern (self,irc,msg,channel,mask,text):
+        chan = self.getChan(irc,channel)
+        if chan.patterns:
+            for pattern in chan.patterns:
+                if pattern in text:
+                    chan.patterns.enqueue(pattern)
+                    self.isAbuseOnChannel(irc,channel,'pattern',mask)
+                    return 'matches tmp pattern in %s' % channel
+        return False
 
-    def isChannelLowRepeat (self,irc,msg,channel,mask,text):
-        return self.isRepeat(irc,msg,channel,mask,text,True)
+    def isChannelRepeat (self,irc,msg,channel,mask,context):
+        return self.isRepeat(irc,msg,channel,mask,context.text,False,context.fingerprint())
 
-    def isRepeat(self,irc,msg,channel,mask,text,low):
+    def isChannelLowRepeat (self,irc,msg,channel,mask,context):
+        return self.isRepeat(irc,msg,channel,mask,context.text,True,context.fingerprint())
+
+    def isRepeat(self,irc,msg,channel,mask,text,low,bits):
         kind = 'repeat'
         key = mask
         if low:
             kind = 'lowRepeat'
             key = 'low_repeat %s' % mask
-        limit = self.registryValue('%sPermit' % kind,channel=channel)
+        limit = getattr(self.getPolicy(channel),'%sPermit' % kind)
         if limit < 0:
             return False
-        if len(text) < self.registryValue('%sMinimum' % kind,channel=channel):
+        if len(text) < getattr(self.getPolicy(channel),'%sMinimum' % kind):
             return False
         chan = self.getChan(irc,channel)
-        life = self.registryValue('%sLife'  % kind,channel=channel)
-        trigger = self.registryValue('%sPercent' % kind,channel=channel)
+        life = getattr(self.getPolicy(channel),'%sLife'  % kind)
+        trigger = getattr(self.getPolicy(channel),'%sPercent' % kind)
         if not key in chan.logs:
             chan.logs[key] = utils.structures.TimeoutQueue(life)
         elif chan.logs[key].timeout != life:
@@ -3215,8 +4880,8 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         logs = chan.logs[key]
         flag = False
         result = False
-        for m in logs:
-            if compareString(m,text) > trigger:
+        for (m,fm) in logs:
+            if compareFingerprint(m,fm,text,bits) > trigger:
                 flag = True
                 break
         if flag:
@@ -3229,19 +4894,19 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                 if len(chan.buffers[kind][key])/(limit * 1.0) > 0.55:
                     enough = True
         if result or enough:
-            life = self.registryValue('computedPatternLife',channel=channel)
+            life = self.getPolicy(channel).computedPatternLife
             if not chan.patterns:
                 chan.patterns = utils.structures.TimeoutQueue(life)
             elif chan.patterns.timeout != life:
                 chan.patterns.setTimeout(life)
-            if self.registryValue('computedPattern',channel=channel) > -1 and len(text) > self.registryValue('computedPattern',channel=channel):
+            if self.getPolicy(channel).computedPattern > -1 and len(text) > self.getPolicy(channel).computedPattern:
                 repeats = []
                 if low:
                     pat = ''
-                    for m in logs:
-                        if compareString(m,text) > trigger:
+                    for (m,fm) in logs:
+                        if compareFingerprint(m,fm,text,bits) > trigger:
                             p = largestString(m,text)
-                            if len(p) > self.registryValue('computedPattern',channel=channel):
+                            if len(p) > self.getPolicy(channel).computedPattern:
                                 if len(p) > len(pat):
                                     pat = p
                     if len(pat):
@@ -3253,33 +4918,33 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                 for repeat in repeats:
                     (p,c) = repeat
                     #self.log.debug('%s :: %s' % (p,c))
-                    if len(p) < self.registryValue('%sMinimum' % kind, channel=channel):
+                    if len(p) < getattr(self.getPolicy(channel),'%sMinimum' % kind):
                         continue
                     p = p.strip()
                     if p in patterns:
                         patterns[p] += c
                     else:
                         patterns[p] = c
-                    if len(p) > self.registryValue('computedPattern',channel=channel):
+                    if len(p) > self.getPolicy(channel).computedPattern:
                         if len(p) > len(candidate):
                             candidate = p
-                    elif len(p) * c > self.registryValue('computedPattern',channel=channel):
+                    elif len(p) * c > self.getPolicy(channel).computedPattern:
                         tentative = ''.join(list((p,) * int(c)))
                         if not tentative in text:
                             tentative = ''.join(list(((p + ' '),) * int(c)))
                             if not tentative in text:
                                 tentative = ''
                         if len(tentative):
-                            tentative = tentative[:self.registryValue('computedPattern',channel=channel)]
+                            tentative = tentative[:self.getPolicy(channel).computedPattern]
                         if len(tentative) > len(candidate):
                             candidate = tentative
-                    elif patterns[p] > self.registryValue('%sCount' % kind,channel=channel):
+                    elif patterns[p] > getattr(self.getPolicy(channel),'%sCount' % kind):
                         if len(p) > len(candidate):
                             candidate = p
                 if candidate.strip() == channel:
                     self.log.debug('pattern candidate %s discared in %s' % (candidate,channel))
                     candidate = ''
-                if len(candidate) and len(candidate) > self.registryValue('%sMinimum' % kind, channel=channel):
+                if len(candidate) and len(candidate) > getattr(self.getPolicy(channel),'%sMinimum' % kind):
                     found = False
                     for p in chan.patterns:
                         if p in candidate:
@@ -3287,14 +4952,14 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                             break
                     if not found:
                         candidate = candidate.strip()
-                        shareID = self.registryValue('shareComputedPatternID',channel=channel)
+                        shareID = self.getPolicy(channel).shareComputedPatternID
                         i = self.getIrc(irc)
                         if shareID != -1 or i.defcon:
                             nb = 0
                             for chan in i.channels:
                                 ch = i.channels[chan]
-                                life = self.registryValue('computedPatternLife',channel=chan)
-                                if shareID != self.registryValue('shareComputedPatternID',channel=chan):
+                                life = self.getPolicy(chan).computedPatternLife
+                                if shareID != self.getPolicy(chan).shareComputedPatternID:
                                     continue
                                 if not ch.patterns:
                                     ch.patterns = utils.structures.TimeoutQueue(life)
@@ -3305,33 +4970,33 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                             self.logChannel(irc,'PATTERN: [%s] %s added "%s" in %s channels (%s)' % (channel,mask,candidate,nb,kind))
                         else:
                             chan.patterns.enqueue(candidate)
-                            self.logChannel(irc,'PATTERN: [%s] %s added "%s" for %ss (%s)' % (channel,mask,candidate,self.registryValue('computedPatternLife',channel=channel),kind))
-        logs.enqueue(text)
+                            self.logChannel(irc,'PATTERN: [%s] %s added "%s" for %ss (%s)' % (channel,mask,candidate,self.getPolicy(channel).computedPatternLife,kind))
+        logs.enqueue((text,bits))
         return result
 
-    def isChannelMassRepeat (self,irc,msg,channel,mask,text):
-        return self.isMassRepeat(irc,msg,channel,mask,text,False)
+    def isChannelMassRepeat (self,irc,msg,channel,mask,context):
+        return self.isMassRepeat(irc,msg,channel,mask,context.text,False,context.fingerprint())
 
-    def isChannelLowMassRepeat (self,irc,msg,channel,mask,text):
-        return self.isMassRepeat(irc,msg,channel,mask,text,True)
+    def isChannelLowMassRepeat (self,irc,msg,channel,mask,context):
+        return self.isMassRepeat(irc,msg,channel,mask,context.text,True,context.fingerprint())
 
-    def isMassRepeat (self,irc,msg,channel,mask,text,low):
+    def isMassRepeat (self,irc,msg,channel,mask,text,low,bits):
         kind = 'massRepeat'
         key = 'mass Repeat'
         if low:
             kind = 'lowMassRepeat'
             key = 'low mass Repeat'
-        limit = self.registryValue('%sPermit' % kind,channel=channel)
+        limit = getattr(self.getPolicy(channel),'%sPermit' % kind)
         if limit < 0:
             return False
-        if len(text) < self.registryValue('%sMinimum' % kind,channel=channel):
+        if len(text) < getattr(self.getPolicy(channel),'%sMinimum' % kind):
             return False
         chan = self.getChan(irc,channel)
-        life = self.registryValue('%sLife' % kind,channel=channel)
-        trigger = self.registryValue('%sPercent' % kind,channel=channel)
-        length = self.registryValue('computedPattern',channel=channel)
+        life = getattr(self.getPolicy(channel),'%sLife' % kind)
+        trigger = getattr(self.getPolicy(channel),'%sPercent' % kind)
+        length = self.getPolicy(channel).computedPattern
         if not key in chan.logs:
-            chan.logs[key] = utils.structures.TimeoutQueue(life)
+            chan.logs[key] = MessageWindow(life)
         elif chan.logs[key].timeout != life:
             chan.logs[key].setTimeout(life)
         flag = False
@@ -3339,24 +5004,22 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         pattern = None
         s = ''
         logs = chan.logs[key]
-        for m in logs:
-            found = compareString(m,text)
-            if found > trigger:
-                if length > 0:
-                    pattern = largestString(m,text)
-                    if len(pattern) < length:
-                        pattern = None
-                    else:
-                        s = s.strip()
-                        if len(s) > len(pattern):
-                            pattern = s
-                        s = pattern
-                flag = True
-                break
+        m = logs.similar(text,bits,trigger)
+        if m is not None:
+            if length > 0:
+                pattern = largestString(m,text)
+                if len(pattern) < length:
+                    pattern = None
+                else:
+                    s = s.strip()
+                    if len(s) > len(pattern):
+                        pattern = s
+                    s = pattern
+            flag = True
         if flag:
             result = self.isBadOnChannel(irc,channel,kind,channel)
             if result and pattern and length > -1:
-                life = self.registryValue('computedPatternLife',channel=channel)
+                life = self.getPolicy(channel).computedPatternLife
                 if not chan.patterns:
                     chan.patterns = utils.structures.TimeoutQueue(life)
                 elif chan.patterns.timeout != life:
@@ -3369,15 +5032,15 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                             found = True
                             break
                     if not found:
-                        shareID = self.registryValue('shareComputedPatternID',channel=channel)
+                        shareID = self.getPolicy(channel).shareComputedPatternID
                         if shareID != -1:
                             nb = 0
                             i = self.getIrc(irc)
                             for chan in i.channels:
                                 ch = i.channels[chan]
-                                if shareID != self.registryValue('shareComputedPatternID',channel=chan):
+                                if shareID != self.getPolicy(chan).shareComputedPatternID:
                                     continue
-                                life = self.registryValue('computedPatternLife',channel=chan)
+                                life = self.getPolicy(chan).computedPatternLife
                                 if not ch.patterns:
                                     ch.patterns = utils.structures.TimeoutQueue(life)
                                 elif ch.patterns.timeout != life:
@@ -3387,8 +5050,8 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                             self.logChannel(irc,'PATTERN: [%s] %s added "%s" in %s channels (%s)' % (channel,mask,pattern,nb,kind))
                         else:
                             chan.patterns.enqueue(pattern)
-                            self.logChannel(irc,'PATTERN: [%s] %s added "%s" for %ss (%s)' % (channel,mask,pattern,self.registryValue('computedPatternLife',channel=channel),kind))
-        logs.enqueue(text)
+                            self.logChannel(irc,'PATTERN: [%s] %s added "%s" for %ss (%s)' % (channel,mask,pattern,self.getPolicy(channel).computedPatternLife,kind))
+        logs.enqueue((text,bits))
         if result and pattern:
             return result
         return False
@@ -3404,7 +5067,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
             life = self.registryValue('announceLife')
             limit = self.registryValue('announcePermit')
             if limit > -1:
-                q = self.getIrcQueueFor(irc,'status','announce',life)
+                q = self.getIrcCounterFor(irc,'status','announce',life)
                 q.enqueue(message)
                 if len(q) > limit:
                     if not i.throttled:
@@ -3416,7 +5079,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                                 irc.sendMsg(ircmsgs.IrcMsg('MODE %s +p' % irc.nick))
                             else:
                                 for channel in irc.state.channels:
-                                    if irc.isChannel(channel) and self.registryValue('defconMode',channel=channel):
+                                    if irc.isChannel(channel) and self.getPolicy(channel).defconMode:
                                         if not 'z' in irc.state.channels[channel].modes:
                                             if irc.nick in list(irc.state.channels[channel].ops):
                                                 irc.sendMsg(ircmsgs.IrcMsg('MODE %s +qz $~a' % channel))
@@ -3437,6 +5100,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                     irc.queueMsg(msg)
 
     def doJoin (self,irc,msg):
+        self.updateChannelNicks(irc,msg)
         if irc.prefix == msg.prefix:
             i = self.getIrc(irc)
             return
@@ -3467,38 +5131,38 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                             i.tokline[src] = src
                             def f ():
                                 irc.sendMsg(ircmsgs.IrcMsg('WHOIS %s %s' % (src,src)))
-                            schedule.addEvent(f,time.time()+random.randint(0,7))
+                            i.wheel.schedule(f,time.time()+random.randint(0,7))
                             #irc.sendMsg(ircmsgs.IrcMsg('WHOIS %s %s' % (src,src)))
                         break
         for channel in channels:
             if ircutils.isChannel(channel) and channel in irc.state.channels:
-                if self.registryValue('ignoreChannel',channel):
+                if self.getPolicy(channel).ignoreChannel:
                     continue
                 chan = self.getChan(irc,channel)
                 t = time.time()
                 mask = self.prefixToMask(irc,msg.prefix,channel)
                 if isCloaked(msg.prefix,self) or account:
-                    t = t - self.registryValue('ignoreDuration',channel=channel) - 1
+                    t = t - self.getPolicy(channel).ignoreDuration - 1
                 chan.nicks[msg.nick] = [t,msg.prefix,mask,gecos,account]
-                if self.registryValue('ignoreRegisteredUser',channel=channel):
+                if self.getPolicy(channel).ignoreRegisteredUser:
                     if account:
                         continue
                 if i.netsplit:
                     continue
                 if 'gateway/shell/matrix.org' in msg.prefix:
                     continue
-                life = self.registryValue('massJoinLife',channel=channel)
-                limit = self.registryValue('massJoinPermit',channel=channel)
-                trigger = self.registryValue('massJoinPercent',channel=channel)
-                length = self.registryValue('massJoinMinimum',channel=channel)
+                life = self.getPolicy(channel).massJoinLife
+                limit = self.getPolicy(channel).massJoinPermit
+                trigger = self.getPolicy(channel).massJoinPercent
+                length = self.getPolicy(channel).massJoinMinimum
                 # massJoin for the whole channel
                 flags = []
                 if limit > -1:
                     b = self.isBadOnChannel(irc,channel,'massJoin',channel)
                     if b:
                         self.log.info('Massjoin detected in %s (%s/%s)' % (channel,life,limit))
-                life = self.registryValue('massJoinHostLife',channel=channel)
-                limit = self.registryValue('massJoinHostPermit',channel=channel)
+                life = self.getPolicy(channel).massJoinHostLife
+                limit = self.getPolicy(channel).massJoinHostPermit
                 ## massJoin same ip/host
                 if limit > -1:
                     b = self.isBadOnChannel(irc,channel,'massJoinHost',mask)
@@ -3506,8 +5170,8 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                         if not mask in flags:
                             flags.append(mask)
 #                        self.logChannel(irc,'NOTE: [%s] %s (%s)' % (channel,b,mask))
-#                life = self.registryValue('massJoinNickLife',channel=channel)
-#                limit = self.registryValue('massJoinNickPermit',channel=channel)
+#                life = self.getPolicy(channel).massJoinNickLife
+#                limit = self.getPolicy(channel).massJoinNickPermit
                 ## massJoin similar nicks
 #                if limit > -1:
 #                    key = 'massJoinNick'
@@ -3532,8 +5196,8 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
 #                            self.logChannel(irc,'NOTE: [%s] %s (%s)' % (channel,b,pattern))
 #                    logs.enqueue(msg.nick)
                 ## massJoin similar gecos
-#                life = self.registryValue('massJoinGecosLife',channel=channel)
-#                limit = self.registryValue('massJoinGecosPermit',channel=channel)
+#                life = self.getPolicy(channel).massJoinGecosLife
+#                limit = self.getPolicy(channel).massJoinGecosPermit
 #                if limit > -1:
 #                    key = 'massJoinGecos'
 #                    if not key in chan.logs:
@@ -3556,15 +5220,16 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
 #                                flags.append(mask)
 #                            self.logChannel(irc,'NOTE: [%s] %s (%s)' % (channel,b,pattern))
 #                    logs.enqueue(gecos)
-                if self.hasAbuseOnChannel(irc,channel,'cycle') and self.hasAbuseOnChannel(irc,channel,'massJoinHost') and len(flags) > 0 and self.registryValue('massJoinTakeAction',channel=channel):
+                if self.hasAbuseOnChannel(irc,channel,'cycle') and self.hasAbuseOnChannel(irc,channel,'massJoinHost') and len(flags) > 0 and self.getPolicy(channel).massJoinTakeAction:
                     for u in flags:
                         if not u in i.klines:
-                            self.kill(irc,msg.nick,self.registryValue('killMessage',channel=channel))
+                            self.kill(irc,msg.nick,self.getPolicy(channel).killMessage)
                             uid = random.randint(0,1000000)
                             self.kline(irc,msg.prefix,u,self.registryValue('klineDuration'),'%s - cycle/massJoinHost %s !dnsbl' % (uid,channel))
                             self.logChannel(irc,'BAD: [%s] %s (cycle/massJoinHost %s - %s)' % (channel,u,msg.prefix,uid))
 
     def doPart (self,irc,msg):
+        self.updateChannelNicks(irc,msg)
         channels = msg.args[0].split(',')
         i = self.getIrc(irc)
         reason = ''
@@ -3589,9 +5254,9 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
             if ircutils.isChannel(channel) and channel in irc.state.channels and not isBanned:
                 chan = self.getChan(irc,channel)
                 if msg.nick in chan.nicks:
-                    if self.registryValue('ignoreChannel',channel):
+                    if self.getPolicy(channel).ignoreChannel:
                         continue
-                    if self.registryValue('ignoreRegisteredUser',channel=channel):
+                    if self.getPolicy(channel).ignoreRegisteredUser:
                         if len(chan.nicks[msg.nick]) > 4:
                             if chan.nicks[msg.nick][4]:
                                 continue
@@ -3617,14 +5282,14 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                     if len(reason):
                         if 'Kicked by @appservice-irc:matrix.org' in reason or 'requested by' in reason:
                             continue
-                        bad = self.isChannelMassRepeat(irc,msg,channel,mask,reason)
+                        bad = self.isMassRepeat(irc,msg,channel,mask,reason,False,fingerprint(reason))
                         if bad:
                             # todo, needs to see more on that one to avoid false positive
                             #self.kill(irc,msg.nick,msg.prefix)
                             #self.kline(irc,msg.prefix,mask,self.registryValue('klineDuration'),'%s in %s' % (bad,channel))
                             self.logChannel(irc,"IGNORED: [%s] %s (Part's message %s) : %s" % (channel,msg.prefix,bad,reason))
                     if not isBanned:
-                        life = self.registryValue('abuseDuration',channel=channel)
+                        life = self.getPolicy(channel).abuseDuration
                         if self.hasAbuseOnChannel(irc,channel,'cycle') and time.time() - chan.nicks[msg.nick][0] < life:
                             isBanned = True
                             uid = random.randint(0,1000000)
@@ -3634,10 +5299,10 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                             self.setRegistryValue('lastActionTaken',time.time(),channel=channel)
                         flag = ircdb.makeChannelCapability(channel, 'joinSpamPart')
                         if ircdb.checkCapability(msg.prefix, flag) and not isBanned:
-                            limit = self.registryValue('joinSpamPartPermit',channel=channel)
+                            limit = self.getPolicy(channel).joinSpamPartPermit
                             if limit > -1:
                                 kind = 'joinSpamPart'
-                                life = self.registryValue('joinSpamPartLife',channel=channel)
+                                life = self.getPolicy(channel).joinSpamPartLife
                                 key = mask
                                 if kind in chan.buffers and key in chan.buffers[kind] and len(chan.buffers[kind][key]) == limit and msg.nick in chan.nicks and time.time() - chan.nicks[msg.nick][0] < life:
                                     self.isAbuseOnChannel(irc,channel,'joinSpamPart',mask)
@@ -3653,6 +5318,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                                         chan.buffers[kind][key].reset()
                                         continue
     def doKick (self,irc,msg):
+        self.updateChannelNicks(irc,msg)
         channel = target = reason = None
         if len(msg.args) == 3:
             (channel,target,reason) = msg.args
@@ -3674,6 +5340,8 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
     def doQuit (self,irc,msg):
         if msg.prefix == irc.prefix:
             return
+        self.capabilities.discard(msg.prefix)
+        self.updateChannelNicks(irc,msg)
         reason = ''
         if len(msg.args) == 1:
             reason = msg.args[0].lstrip().rstrip()
@@ -3690,10 +5358,10 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         for channel in irc.state.channels:
             if ircutils.isChannel(channel) and not i.netsplit:
                chan = self.getChan(irc,channel)
-               if self.registryValue('ignoreChannel',channel):
+               if self.getPolicy(channel).ignoreChannel:
                    continue
                if msg.nick in chan.nicks:
-                    if self.registryValue('ignoreRegisteredUser',channel=channel):
+                    if self.getPolicy(channel).ignoreRegisteredUser:
                         if len(chan.nicks[msg.nick]) > 4:
                             if chan.nicks[msg.nick][4]:
                                 continue
@@ -3716,10 +5384,10 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                         continue
                     flag = ircdb.makeChannelCapability(channel, 'joinSpamPart')
                     if ircdb.checkCapability(msg.prefix, flag) and reason == 'Remote host closed the connection':
-                        limit = self.registryValue('joinSpamPartPermit',channel=channel)
+                        limit = self.getPolicy(channel).joinSpamPartPermit
                         if limit > -1:
                             kind = 'joinSpamPart'
-                            life = self.registryValue('joinSpamPartLife',channel=channel)
+                            life = self.getPolicy(channel).joinSpamPartLife
                             key = mask
                             if kind in chan.buffers and key in chan.buffers[kind] and len(chan.buffers[kind][key]) == limit and msg.nick in chan.nicks and time.time() - chan.nicks[msg.nick][0] < life:
                                 self.isAbuseOnChannel(irc,channel,'joinSpamPart',mask)
@@ -3734,7 +5402,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                                     isBanned = True
                                     chan.buffers[kind][key].reset()
                                     continue
-                    hosts = self.registryValue('brokenHost',channel=channel)
+                    hosts = self.getPolicy(channel).brokenHost
                     reasons = ['Read error: Connection reset by peer','Client Quit','Excess Flood','Max SendQ exceeded','Remote host closed the connection']
                     if 'broken' in chan.buffers and mask in chan.buffers['broken'] and len(chan.buffers['broken'][mask]) > 1 and reason in reasons and len(hosts):
                         found = False
@@ -3756,6 +5424,8 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                                 self.logChannel(irc,'BAD: [%s] %s (%s - %s)' % (channel,msg.prefix,'broken bottish client',uid))
 
     def doNick (self,irc,msg):
+        self.capabilities.discard(msg.prefix)
+        self.updateChannelNicks(irc,msg)
         oldNick = msg.prefix.split('!')[0]
         newNick = msg.args[0]
         if oldNick == irc.nick or newNick == irc.nick:
@@ -3768,7 +5438,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         isBanned = False
         for channel in irc.state.channels:
             if ircutils.isChannel(channel):
-                if self.registryValue('ignoreChannel',channel):
+                if self.getPolicy(channel).ignoreChannel:
                     continue
                 protected = ircdb.makeChannelCapability(channel, 'protected')
                 if ircdb.checkCapability(newPrefix, protected):
@@ -3780,14 +5450,14 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                     if not newNick.startswith('Guest'):
                         if not isBanned:
                             reason = False
-                            if self.registryValue('ignoreRegisteredUser',channel=channel):
+                            if self.getPolicy(channel).ignoreRegisteredUser:
                                 if newNick in chan.nicks and len(chan.nicks[newNick]) > 4 and chan.nicks[newNick][4]:
                                     continue
                             flag = ircdb.makeChannelCapability(channel, 'nick')
                             if ircdb.checkCapability(msg.prefix, flag):
                                 reason = self.isBadOnChannel(irc,channel,'nick',mask)
                             hasBeenIgnored = False
-                            ignore = self.registryValue('ignoreDuration',channel=channel)
+                            ignore = self.getPolicy(channel).ignoreDuration
                             if ignore > 0:
                                 ts = chan.nicks[newNick][0]
                                 if time.time()-ts > ignore:
@@ -3817,11 +5487,51 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                                     isBanned = True
                     del chan.nicks[oldNick]
 
+    def scheduleCounters (self):
+        # registered again with the new interval when patternCountInterval changes
+        try:
+            schedule.removePeriodicEvent('SigynCounters')
+        except KeyError:
+            pass
+        schedule.addPeriodicEvent(self.flushCounters,self.registryValue('patternCountInterval'),name='SigynCounters',now=False)
+
+    def flushCounters (self):
+        for network in list(self._ircs.keys()):
+            self._ircs[network].flush(self.getDb(network),self.registryValue('patternHitsDays'))
+
+    def advanceWheels (self):
+        now = time.time()
+        for network in list(self._ircs.keys()):
+            self._ircs[network].wheel.advance(now)
+        self.capabilities.refresh()
+
     def reset(self):
+        self.flushCounters()
         self._ircs = ircutils.IrcDict()
 
     def die(self):
         self.log.info('die() called')
+        conf.supybot.plugins.Sigyn.patternCountInterval.removeCallback(self.countersCallback)
+        try:
+            schedule.removePeriodicEvent('SigynCounters')
+        except KeyError:
+            pass
+        try:
+            schedule.removePeriodicEvent('SigynWheel')
+        except KeyError:
+            pass
+        if self.snapshot is not None:
+            self.snapshot = None
+            tracemalloc.stop()
+        for policy in self.policies.values():
+            for value in policy.sources:
+                value.removeCallback(self.policyCallback)
+        self.policies = {}
+        for value in self.capabilitySources():
+            value.removeCallback(self.capabilityCallback)
+        conf.supybot.plugins.Sigyn.windowIndexMinimum.removeCallback(self.windowIndexCallback)
+        self.capabilities.clear()
+        self.flushCounters()
         self.cache = {}
         try:
             conf.supybot.protocols.irc.throttleTime.setValue(1.6)
@@ -3831,6 +5541,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         super().die()
 
     def doError (self,irc,msg):
+        self.flushCounters()
         self._ircs = ircutils.IrcDict()
 
     def makeDb(self, filename):
@@ -3838,6 +5549,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         if os.path.exists(filename):
             db = sqlite3.connect(filename,timeout=10)
             db.text_factory = str
+            self.makeHitsTable(db)
             return db
         db = sqlite3.connect(filename)
         db.text_factory = str
@@ -3857,8 +5569,26 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                 )""")
         db.commit()
         c.close()
+        self.makeHitsTable(db)
         return db
 
+    def makeHitsTable (self,db):
+        """Create calls buckets of patterns, per minute ( span 60 ) and per hour ( span 3600 ), and when they started to be recorded"""
+        c = db.cursor()
+        c.execute("""CREATE TABLE IF NOT EXISTS pattern_hits (
+                id INTEGER NOT NULL,
+                span INTEGER NOT NULL,
+                bucket INTEGER NOT NULL,
+                hits INTEGER NOT NULL,
+                PRIMARY KEY (id, span, bucket)
+                )""")
+        c.execute("""CREATE TABLE IF NOT EXISTS pattern_tracking (
+                since INTEGER NOT NULL
+                )""")
+        c.execute("""INSERT INTO pattern_tracking SELECT ? WHERE NOT EXISTS (SELECT 1 FROM pattern_tracking)""",(int(time.time()),))
+        db.commit()
+        c.close()
+
     def getDb(self, irc):
         """Use this to get a database for a specific irc."""
         currentThread = threading.currentThread()
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+###
+# Copyright (c) 2016, Nicolas Coevoet
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""Replay recorded IRC traffic through Sigyn, without any network.
+
+    python3 replay.py [--config <registry file>] [--channels #a,#b] [--clock virtual|wall] <log> [<log> ...]
+
+Each line of a log is a raw line received from the server, optionally
+preceded by its unix timestamp, ie:
+
+    1589200000.25 :nick!ident@host PRIVMSG #channel :some text
+    1589200001.5 :irc.server.net NOTICE * :*** Notice -- Client connecting: ...
+
+Lines are fed to irc.state then to the matching Sigyn.do* handler, outgoing
+messages ( KLINE, KILL, logChannel lines ... ) are collected, and messages
+per second and per handler latency percentiles are reported. With the
+virtual clock, time.time() follows the timestamps of the log.
+"""
+
+import os
+import sys
+import time
+import atexit
+import shutil
+import argparse
+import tempfile
+import importlib.util
+
+clock = [None]
+wallTime = time.time
+
+def virtualTime():
+    if clock[0] is None:
+        return wallTime()
+    return clock[0]
+
+def setup(config,directory):
+    # limnoria reads its directories when loaded, they must be set before anything else is imported
+    # directory is removed at exit, after limnoria's own atexit handlers which still log
+    atexit.register(shutil.rmtree,directory,True)
+    import supybot.registry as registry
+    if config:
+        registry.open_registry(config)
+    for path in ('conf','data','logs'):
+        os.makedirs(os.path.join(directory,path),exist_ok=True)
+    filename = os.path.join(directory,'conf','replay.conf')
+    with open(filename,'w') as f:
+        f.write("""supybot.directories.backup: /dev/null
+supybot.directories.conf: %s
+supybot.directories.data: %s
+supybot.directories.log: %s
+supybot.log.stdout: False
+supybot.protocols.irc.throttleTime: 0
+""" % (os.path.join(directory,'conf'),os.path.join(directory,'data'),os.path.join(directory,'logs')))
+    registry.open_registry(filename)
+    import supybot.log
+    import supybot.conf as conf
+    import supybot.ircdb
+    # nobody is protected, there is no user database during a replay
+    capabilities = conf.supybot.capabilities()
+    capabilities.add('-protected')
+    conf.supybot.capabilities.setValue(capabilities)
+
+def loadPlugin():
+    directory = os.path.dirname(os.path.abspath(__file__))
+    spec = importlib.util.spec_from_file_location('Sigyn',os.path.join(directory,'__init__.py'),submodule_search_locations=[directory])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['Sigyn'] = module
+    spec.loader.exec_module(module)
+    return module
+
+class FakeIrc (object):
+    """just enough of supybot.irclib.Irc for Sigyn's handlers"""
+
+    def __init__(self,network,nick):
+        import supybot.irclib as irclib
+        self.network = network
+        self.nick = nick
+        self.prefix = '%s!%s@replay' % (nick,nick)
+        self.state = irclib.IrcState()
+        self.outgoing = []
+
+    def isChannel(self,s):
+        import supybot.ircutils as ircutils
+        return ircutils.isChannel(s)
+
+    def queueMsg(self,msg):
+        self.outgoing.append(msg)
+
+    def sendMsg(self,msg):
+        self.outgoing.append(msg)
+
+    def reply(self,s,*args,**kwargs):
+        pass
+
+    def error(self,s,*args,**kwargs):
+        pass
+
+def parse(line):
+    # returns (timestamp or None, IrcMsg) or None
+    import supybot.ircmsgs as ircmsgs
+    line = line.rstrip('\r\n')
+    if not line.strip():
+        return None
+    t = None
+    (head,sep,tail) = line.partition(' ')
+    if not head.startswith(':'):
+        try:
+            t = float(head)
+            line = tail
+        except ValueError:
+            t = None
+    try:
+        return (t,ircmsgs.IrcMsg(line))
+    except Exception:
+        return None
+
+def percentile(values,p):
+    if not len(values):
+        return 0.0
+    return values[min(len(values)-1,int(round(p*(len(values)-1))))]
+
+class Replay (object):
+
+    def __init__(self,plugin,irc,autojoin=True):
+        self.plugin = plugin
+        self.irc = irc
+        self.autojoin = autojoin
+        self.timings = {}
+        self.actions = {}
+        self.lines = 0
+        self.skipped = 0
+        self.output = None
+
+    def handle(self,msg,measure=True):
+        self.irc.state.addMsg(self.irc,msg)
+        name = 'do%s' % msg.command.capitalize()
+        method = getattr(self.plugin,name,None)
+        if method is None:
+            return
+        start = time.perf_counter()
+        try:
+            method(self.irc,msg)
+        except Exception as e:
+            self.plugin.log.exception('%s failed on %r', name, msg)
+        elapsed = time.perf_counter() - start
+        if measure:
+            if not name in self.timings:
+                self.timings[name] = []
+            self.timings[name].append(elapsed)
+
+    def join(self,channel,prefix):
+        import supybot.ircmsgs as ircmsgs
+        self.handle(ircmsgs.join(channel,prefix=prefix),False)
+
+    def ensureJoined(self,msg):
+        # traffic is usually recorded without the JOIN of the bot or of the speakers
+        import supybot.ircutils as ircutils
+        if not self.autojoin or not msg.command in ('PRIVMSG','NOTICE') or not ircutils.isUserHostmask(msg.prefix):
+            return
+        for channel in msg.args[0].split(','):
+            channel = channel.lstrip('@+')
+            if not self.irc.isChannel(channel):
+                continue
+            if not channel in self.irc.state.channels:
+                self.join(channel,self.irc.prefix)
+            if not msg.nick in self.irc.state.channels[channel].users:
+                self.join(channel,msg.prefix)
+
+    def collect(self):
+        logChannel = self.plugin.registryValue('logChannel')
+        for msg in self.irc.outgoing:
+            kind = msg.command
+            if msg.command in ('PRIVMSG','NOTICE') and msg.args[0] == logChannel:
+                kind = 'logChannel'
+            self.actions[kind] = self.actions.get(kind,0) + 1
+            if self.output:
+                self.output.write('%.3f %s\n' % (time.time(),str(msg).rstrip('\r\n')))
+        self.irc.outgoing = []
+
+    def run(self,f):
+        import supybot.schedule as schedule
+        for line in f:
+            parsed = parse(line)
+            if parsed is None:
+                self.skipped = self.skipped + 1
+                continue
+            (t,msg) = parsed
+            if t is not None:
+                clock[0] = t
+            self.lines = self.lines + 1
+            self.ensureJoined(msg)
+            self.handle(msg)
+            schedule.run()
+            self.collect()
+
+    def report(self,out,elapsed):
+        total = 0.0
+        count = 0
+        for values in self.timings.values():
+            total = total + sum(values)
+            count = count + len(values)
+        out.write('%s lines replayed, %s skipped, %s handled in %.3fs of handlers, %.3fs of wall time\n' % (self.lines,self.skipped,count,total,elapsed))
+        if total > 0:
+            out.write('%.1f messages/s in handlers, %.1f lines/s overall\n' % (count/total,self.lines/max(elapsed,1e-9)))
+        out.write('%-12s %8s %10s %10s %10s %10s\n' % ('handler','calls','p50 ms','p90 ms','p99 ms','max ms'))
+        for name in sorted(self.timings):
+            values = sorted(self.timings[name])
+            out.write('%-12s %8s %10.3f %10.3f %10.3f %10.3f\n' % (name,len(values),percentile(values,0.5)*1000,percentile(values,0.9)*1000,percentile(values,0.99)*1000,values[-1]*1000))
+        out.write('actions: %s\n' % ', '.join(['%s %s' % (k,self.actions[k]) for k in sorted(self.actions)]))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='replay recorded IRC traffic through Sigyn')
+    parser.add_argument('logs',nargs='+',help='files of raw IRC lines, - for stdin')
+    parser.add_argument('--config',help='limnoria registry file to load, ie the production one')
+    parser.add_argument('--network',default='replay')
+    parser.add_argument('--nick',default='Sigyn')
+    parser.add_argument('--channels',default='',help='comma separated channels joined before the replay')
+    parser.add_argument('--clock',choices=('virtual','wall'),default='virtual',help='time.time() follows log timestamps or the wall clock')
+    parser.add_argument('--no-oper',dest='oper',action='store_false',help='do not start as an oper')
+    parser.add_argument('--no-autojoin',dest='autojoin',action='store_false',help='do not join channels and speakers on the fly')
+    parser.add_argument('--keep-netsplit',dest='netsplit',action='store_true',help='keep the netsplit mode Sigyn starts with')
+    parser.add_argument('--output',help='write outgoing messages to this file')
+    args = parser.parse_args(argv)
+    directory = tempfile.mkdtemp(prefix='sigyn-replay-')
+    setup(args.config,directory)
+    if args.clock == 'virtual':
+        time.time = virtualTime
+    import supybot.world as world
+    import supybot.ircmsgs as ircmsgs
+    world.starting = False
+    module = loadPlugin()
+    irc = FakeIrc(args.network,args.nick)
+    plugin = module.Class(irc)
+    replay = Replay(plugin,irc,args.autojoin)
+    channels = [c for c in args.channels.split(',') if len(c)]
+    if len(plugin.registryValue('logChannel')):
+        channels.append(plugin.registryValue('logChannel'))
+    for channel in channels:
+        replay.join(channel,irc.prefix)
+    if args.oper:
+        replay.handle(ircmsgs.IrcMsg(prefix='replay.server',command='381',args=(irc.nick,'You are now an IRC operator')),False)
+    if not args.netsplit:
+        plugin.getIrc(irc).netsplit = False
+    replay.collect()
+    replay.actions = {}
+    if args.output:
+        replay.output = open(args.output,'w')
+    start = wallTime()
+    for name in args.logs:
+        if name == '-':
+            replay.run(sys.stdin)
+        else:
+            with open(name,errors='replace') as f:
+                replay.run(f)
+    elapsed = wallTime() - start
+    plugin.die()
+    if replay.output:
+        replay.output.close()
+    replay.report(sys.stdout,elapsed)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
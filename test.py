@@ -28,10 +28,800 @@
 
 ###
 
+import re
+import sys
+import random
+
 from supybot.test import *
+import supybot.schedule as schedule
+
+from . import plugin as sigyn
+
+def referenceLargestString (s1,s2):
+    # former dynamic programming implementation of largestString
+    m = [[0] * (1 + len(s2)) for i in range(1 + len(s1))]
+    longest, x_longest = 0, 0
+    for x in range(1, 1 + len(s1)):
+        for y in range(1, 1 + len(s2)):
+            if s1[x - 1] == s2[y - 1]:
+                m[x][y] = m[x - 1][y - 1] + 1
+                if m[x][y] > longest:
+                    longest = m[x][y]
+                    x_longest = x
+            else:
+                m[x][y] = 0
+    return s1[x_longest - longest: x_longest]
+
+def referenceRepetitions (s):
+    # former regexp implementation of repetitions
+    for match in re.finditer(r"(.+?)\1+", s):
+        yield (match.group(1), len(match.group(0))/len(match.group(1)))
+
+class FakeClock(object):
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
 
 class SigynTestCase(PluginTestCase):
     plugins = ('Sigyn',)
 
+    def setUp(self):
+        PluginTestCase.setUp(self)
+        # die() of the previous test left the throttle of a regular client, replies would be late
+        conf.supybot.protocols.irc.throttleTime.setValue(0.0)
+
+    def testJoinsFootprint(self):
+        # a week of joins from new hosts, channel buffers must not grow with the number of hosts seen
+        cb = self.irc.getCallback('Sigyn')
+        clock = FakeClock(time.time())
+        capabilities = set(conf.supybot.capabilities())
+        conf.supybot.capabilities.setValue(capabilities | set(['-protected']))
+        values = {'massJoinHostPermit': 5, 'massJoinHostLife': 300, 'ignoreDuration': 600}
+        saved = dict((name, conf.supybot.plugins.Sigyn.get(name)()) for name in values)
+        for name in values:
+            conf.supybot.plugins.Sigyn.get(name).setValue(values[name])
+        sigyn.time = clock
+        try:
+            self.irc.feedMsg(ircmsgs.join('#test', prefix=self.irc.prefix))
+            cb.getIrc(self.irc).netsplit = False
+            sizes = []
+            for day in range(7):
+                for j in range(2880):
+                    n = day * 2880 + j
+                    clock.now = clock.now + 30
+                    self.irc.feedMsg(ircmsgs.join('#test', prefix='u%s!~u@10.%s.%s.%s.__no_testcap__' % (n, n >> 16, (n >> 8) & 255, n & 255)))
+                    cb.advanceWheels()
+                chan = cb.getChan(self.irc, '#test')
+                sizes.append(sigyn.deepSize(chan.buffers))
+            # about the ignoreDuration / 30 hosts which may still be new, 20160 hosts would be megabytes
+            self.assertTrue(max(sizes) < 64 * 1024, sizes)
+            self.assertTrue(abs(sizes[-1] - sizes[0]) <= sizes[0] / 10, sizes)
+        finally:
+            sigyn.time = time
+            conf.supybot.capabilities.setValue(capabilities)
+            for name in saved:
+                conf.supybot.plugins.Sigyn.get(name).setValue(saved[name])
+
+    def testIgnoreDuration(self):
+        # a mask stays new for ignoreDuration after it was first seen, even when its window empties meanwhile
+        cb = self.irc.getCallback('Sigyn')
+        clock = FakeClock(time.time())
+        values = {'floodPermit': 2, 'floodLife': 60, 'ignoreDuration': 600}
+        saved = dict((name, conf.supybot.plugins.Sigyn.get(name)()) for name in values)
+        for name in values:
+            conf.supybot.plugins.Sigyn.get(name).setValue(values[name])
+        sigyn.time = clock
+        try:
+            cb.getIrc(self.irc).netsplit = False
+            def events(mask, *offsets):
+                found = False
+                for offset in offsets:
+                    while clock.now < start + offset:
+                        clock.now = min(clock.now + 1, start + offset)
+                        cb.advanceWheels()
+                    found = cb.isBadOnChannel(self.irc, '#test', 'flood', mask)
+                return found
+            start = clock.now
+            self.assertFalse(events('*@old', 0, 590, 655))
+            self.assertFalse(events('*@old', 656))
+            # new masks are allowed one message less
+            self.assertTrue(events('*@new', 660, 661))
+        finally:
+            sigyn.time = time
+            for name in saved:
+                conf.supybot.plugins.Sigyn.get(name).setValue(saved[name])
+
+    def testFlushCounters(self):
+        cb = self.irc.getCallback('Sigyn')
+        db = cb.getDb(self.irc.network)
+        uid = cb.getIrc(self.irc).add(db, self.irc.prefix, 'hotword', 5, 60, False)
+        def stored():
+            c = db.cursor()
+            c.execute("""SELECT triggered FROM patterns WHERE id=?""", (uid,))
+            triggered = c.fetchone()[0]
+            c.execute("""SELECT span, SUM(hits) FROM pattern_hits WHERE id=? GROUP BY span""", (uid,))
+            hits = dict(c.fetchall())
+            c.close()
+            return (triggered, hits)
+        for n in range(3):
+            cb.getIrc(self.irc).count(uid)
+        self.assertEqual(stored(), (0, {}))
+        cb.flushCounters()
+        self.assertEqual(stored(), (3, {60: 3, 3600: 3}))
+        cb.flushCounters()
+        self.assertEqual(stored(), (3, {60: 3, 3600: 3}))
+        # increments pending when the state is dropped are written first
+        cb.getIrc(self.irc).count(uid)
+        cb.reset()
+        self.assertEqual(stored(), (4, {60: 4, 3600: 4}))
+        cb.getIrc(self.irc).count(uid)
+        cb.getIrc(self.irc).count(uid)
+        cb.die()
+        self.assertEqual(stored(), (6, {60: 6, 3600: 6}))
+
+    def testTopAndDeadPatterns(self):
+        cb = self.irc.getCallback('Sigyn')
+        db = cb.getDb(self.irc.network)
+        i = cb.getIrc(self.irc)
+        hot = i.add(db, self.irc.prefix, 'hotword', 5, 60, False)
+        cold = i.add(db, self.irc.prefix, 'coldword', 5, 60, False)
+        for n in range(3):
+            i.count(hot)
+        self.assertRegexp('toppattern', r'#%s "hotword" 3 calls \(0\.05/min\)' % hot)
+        cb.flushCounters()
+        self.assertRegexp('toppattern 10 3000', r'"hotword" 3 calls')
+        self.assertNotRegexp('toppattern 10 3000', 'coldword')
+        self.assertError('toppattern 10 %s' % (366 * 1440))
+        # patterns created before calls were recorded are not dead yet
+        db.execute("""UPDATE patterns SET at=0""")
+        self.assertRegexp('deadpattern', 'calls are recorded since')
+        db.execute("""UPDATE pattern_tracking SET since=0""")
+        self.assertRegexp('deadpattern', r'#%s "coldword" no call recorded' % cold)
+        self.assertNotRegexp('deadpattern', 'hotword')
+        self.assertError('deadpattern 400')
+        # hour buckets older than patternHitsDays are dropped on flush
+        old = int(time.time()) - 400 * 86400
+        db.execute("""INSERT INTO pattern_hits VALUES (?, 3600, ?, 7)""", (cold, old - old % 3600))
+        i.count(hot)
+        cb.flushCounters()
+        c = db.cursor()
+        c.execute("""SELECT COUNT(*) FROM pattern_hits WHERE id=?""", (cold,))
+        self.assertEqual(c.fetchone()[0], 0)
+        c.close()
+
+    def testAmsg(self):
+        # the same text in more than amsgPermit other channels becomes a temporary pattern everywhere
+        cb = self.irc.getCallback('Sigyn')
+        prefix = 'am!~am@__no_testcap__'
+        text = 'come visit my awesome website today'
+        caps = conf.supybot.capabilities()
+        values = {'amsgPermit': 1, 'amsgLife': 60, 'amsgPercent': 0.8, 'amsgMinimum': 5, 'logChannel': '#log'}
+        saved = dict((name, conf.supybot.plugins.Sigyn.get(name)()) for name in values)
+        for name in values:
+            conf.supybot.plugins.Sigyn.get(name).setValue(values[name])
+        try:
+            changed = ircdb.CapabilitySet(caps)
+            changed.add('-protected')
+            conf.supybot.capabilities.setValue(changed)
+            for channel in ('#log', '#amsg1', '#amsg2', '#amsg3'):
+                self.irc.feedMsg(ircmsgs.join(channel, prefix=self.irc.prefix))
+            cb.getIrc(self.irc).netsplit = False
+            for channel in ('#amsg1', '#amsg2', '#amsg3'):
+                self.irc.feedMsg(ircmsgs.join(channel, prefix=prefix))
+            # each message is compared with the oldest similar one of another channel
+            for channel in ('#amsg1', '#amsg2', '#amsg3'):
+                self.irc.feedMsg(ircmsgs.privmsg(channel, text, prefix=prefix))
+            self.assertFalse(cb.getChan(self.irc, '#amsg3').patterns)
+            self.irc.feedMsg(ircmsgs.privmsg('#amsg1', text.upper(), prefix=prefix))
+            msgs = []
+            m = self.irc.takeMsg()
+            while m is not None:
+                msgs.append(m)
+                m = self.irc.takeMsg()
+            self.assertTrue(any(m.command in ('PRIVMSG', 'NOTICE') and m.args[0] == '#log' and m.args[1].endswith(') in #amsg1, #amsg2, #amsg1') for m in msgs), msgs)
+            for channel in ('#amsg1', '#amsg2', '#amsg3'):
+                self.assertIn(text, list(cb.getChan(self.irc, channel).patterns))
+        finally:
+            conf.supybot.capabilities.setValue(caps)
+            for name in saved:
+                conf.supybot.plugins.Sigyn.get(name).setValue(saved[name])
+
+    def testCatastrophicPatterns(self):
+        cb = self.irc.getCallback('Sigyn')
+        db = cb.getDb(self.irc.network)
+        i = cb.getIrc(self.irc)
+        # stored before shapes were checked
+        uid = i.add(db, self.irc.prefix, '/(a+)+b/', 1, 60, True)
+        self.assertError('editpattern %s 2 60' % uid)
+        self.assertNotError('togglepattern %s false' % uid)
+        self.assertError('togglepattern %s true' % uid)
+        db.execute("""UPDATE patterns SET removed_at=NULL WHERE id=?""", (uid,))
+        cb.reset()
+        self.assertNotIn(uid, cb.getIrc(self.irc).patterns)
+
+    def testWindowIndex(self):
+        value = conf.supybot.plugins.Sigyn.windowIndexMinimum
+        (saved, numpy) = (value(), sigyn.numpy)
+        try:
+            value.setValue(100)
+            self.assertEqual(sigyn.MessageWindow.indexMinimum, 100)
+            value.setValue(0)
+            self.assertEqual(sigyn.MessageWindow.indexMinimum, None)
+            # by default, only without numpy
+            sigyn.numpy = None
+            value.setValue(-1)
+            self.assertEqual(sigyn.MessageWindow.indexMinimum, sigyn.MessageWindow.indexDefault)
+        finally:
+            sigyn.numpy = numpy
+            value.setValue(saved)
+        self.assertEqual(sigyn.MessageWindow.indexMinimum, None if numpy else sigyn.MessageWindow.indexDefault)
+
+    def testCountersInterval(self):
+        def scheduled():
+            return [t for (t, name, args, kwargs) in schedule.schedule.schedule if name == 'SigynCounters']
+        value = conf.supybot.plugins.Sigyn.patternCountInterval
+        saved = value()
+        try:
+            value.setValue(7200)
+            [when] = scheduled()
+            self.assertTrue(7100 < when - time.time() <= 7200, when)
+        finally:
+            value.setValue(saved)
+        [when] = scheduled()
+        self.assertTrue(when - time.time() <= saved, when)
+
+    def testStateTables(self):
+        cb = self.irc.getCallback('Sigyn')
+        cb.getIrcQueueFor(self.irc, 'sasl', 'account', 60).enqueue('test!~test@127.0.0.1')
+        self.assertRegexp('state tables', r'sasl: 1 entries, 1 created, 0 expired, ~\d+ bytes')
+
+    def testPolicy(self):
+        cb = self.irc.getCallback('Sigyn')
+        group = conf.supybot.plugins.Sigyn
+        saved = group.floodPermit.get('#test').value
+        try:
+            policy = cb.getPolicy('#test')
+            self.assertEqual(policy.floodPermit, cb.registryValue('floodPermit', channel='#test'))
+            self.assertIs(cb.getPolicy('#test'), policy)
+            self.assertRaises(AttributeError, setattr, policy, 'floodPermit', 0)
+            group.floodPermit.get('#test').setValue(saved + 1)
+            self.assertEqual(cb.getPolicy('#test').floodPermit, saved + 1)
+        finally:
+            group.floodPermit.get('#test').setValue(saved)
+        self.assertEqual(cb.getPolicy('#test').floodPermit, saved)
+
+    def testCapabilityCache(self):
+        cb = self.irc.getCallback('Sigyn')
+        cache = cb.capabilities
+        prefix = 'test!~test@__no_testcap__'
+        caps = conf.supybot.capabilities()
+        try:
+            changed = ircdb.CapabilitySet(caps)
+            changed.add('protected')
+            conf.supybot.capabilities.setValue(changed)
+            self.assertTrue(cache.check(prefix, None, 'protected'))
+            misses = cache.misses
+            self.assertTrue(cache.check(prefix, None, 'protected'))
+            self.assertEqual(cache.misses, misses)
+            changed = ircdb.CapabilitySet(caps)
+            changed.add('-protected')
+            conf.supybot.capabilities.setValue(changed)
+            self.assertFalse(cache.check(prefix, None, 'protected'))
+        finally:
+            conf.supybot.capabilities.setValue(caps)
+        self.assertTrue(cache.check(prefix, '#test', 'flood'))
+        self.irc.feedMsg(ircmsgs.IrcMsg(prefix=prefix, command='NICK', args=('other',)))
+        self.assertNotIn(prefix, cache.entries)
+        # commands may change ircdb without writing it, dropped at once and on the next wheel tick
+        cache.get(prefix, '#test')
+        self.irc.feedMsg(ircmsgs.privmsg('#test', '@echo hi', prefix='other!~test@__no_testcap__'))
+        self.assertEqual(len(cache), 0)
+        cache.get(prefix, '#test')
+        cb.advanceWheels()
+        self.assertEqual(len(cache), 0)
+        cache.get(prefix, '#test')
+        cb.advanceWheels()
+        self.assertEqual(len(cache), 1)
+        size = cache.size
+        try:
+            cache.size = 2
+            for n in range(4):
+                cache.get('test%s!~test@127.0.0.1' % n, '#test')
+            self.assertEqual(list(cache.entries), ['test2!~test@127.0.0.1', 'test3!~test@127.0.0.1'])
+        finally:
+            cache.size = size
+
+    def testPipeline(self):
+        cb = self.irc.getCallback('Sigyn')
+        group = conf.supybot.plugins.Sigyn
+        saved = (group.floodPermit.get('#test').value, group.abusePermit.get('#test').value)
+        try:
+            group.floodPermit.get('#test').setValue(-1)
+            pipeline = cb.getPipeline('#test')
+            self.assertNotIn('flood', [detector.name for detector in pipeline.detectors])
+            # measured costs reverse the ranks, tmpPattern still waits for better ranked detectors
+            for detector in sigyn._detectors:
+                cb.detectorStats[detector.name].calls = 1
+                cb.detectorStats[detector.name].cpu = 1.0 / (detector.rank + 1)
+            cb.pipelines = {}
+            detectors = cb.getPipeline('#test').detectors
+            names = [detector.name for detector in detectors]
+            ranks = [detector.rank for detector in detectors if not detector.fallback]
+            self.assertEqual(ranks, sorted(ranks, reverse=True))
+            position = names.index('tmpPattern')
+            self.assertEqual([detector.name for detector in detectors[position:] if detector.rank < 3], [])
+            self.assertFalse(pipeline.decided(6, set(['repeat'])))
+            self.assertTrue(pipeline.decided(6, set(['hilight', 'badunicode', 'tmpPattern', 'massRepeat', 'lowMassRepeat'])))
+            # with abuse windows, skipped detectors would not count towards the channel's abuse
+            group.abusePermit.get('#test').setValue(2)
+            pipeline = cb.getPipeline('#test')
+            self.assertFalse(pipeline.decided(6, set(['hilight', 'badunicode', 'tmpPattern', 'massRepeat', 'lowMassRepeat'])))
+        finally:
+            group.floodPermit.get('#test').setValue(saved[0])
+            group.abusePermit.get('#test').setValue(saved[1])
+        self.assertNotError('detectors #test')
+
+    def testMemory(self):
+        cb = self.irc.getCallback('Sigyn')
+        cb.getIrc(self.irc).channels['#test'] = sigyn.Chan('#test')
+        self.assertRegexp('memory', r'cache: \d+ entries, ~\d+ bytes')
+        while self.irc.takeMsg() is not None:
+            pass
+        self.assertNotError('memory --snapshot')
+        while self.irc.takeMsg() is not None:
+            pass
+        self.assertNotError('memory --snapshot')
+        tracemalloc = sigyn.tracemalloc
+        if cb.snapshot is not None:
+            cb.snapshot = None
+            tracemalloc.stop()
+
+class StateTableTestCase(SupyTestCase):
+
+    def testDeepSize(self):
+        text = 'x' * 100
+        self.assertEqual(sigyn.deepSize([]), sys.getsizeof([]))
+        # shared and cyclic references are counted once
+        value = [text, text]
+        value.append(value)
+        self.assertEqual(sigyn.deepSize(value), sys.getsizeof(value) + sys.getsizeof(text))
+        counter = sigyn.SlidingWindowCounter(60)
+        self.assertTrue(sigyn.deepSize(counter) >= sys.getsizeof(counter) + sys.getsizeof(counter.times))
+
+    def testExpiry(self):
+        clock = FakeClock(time.time())
+        sigyn.time = clock
+        try:
+            wheel = sigyn.TimingWheel(now=clock.now)
+            windows = sigyn.StateTable('windows', sigyn.SlidingWindowCounter, wheel)
+            window = windows.get('mask', 60)
+            window.enqueue(at=clock.now + 50)
+            self.assertTrue(windows.get('mask', 60) is window)
+            alerts = sigyn.StateTable('alerts', None, wheel)
+            alerts.mark('mask', 30)
+            self.assertTrue(windows.size() > 0)
+            start = clock.now
+            # the window is checked after its life, then again once its last event expired
+            for (delay, inWindows, inAlerts) in ((29, True, True), (32, True, False), (62, True, False), (125, False, False)):
+                clock.now = start + delay
+                wheel.advance(clock.now)
+                self.assertEqual(('mask' in windows, 'mask' in alerts), (inWindows, inAlerts), delay)
+            self.assertEqual((windows.created, windows.expired, alerts.expired), (1, 1, 1))
+            windows.get('other', 60).enqueue()
+            self.assertEqual(len(windows.pop('other')), 0)
+            self.assertFalse('other' in windows)
+        finally:
+            sigyn.time = time
+
+    def testDiscard(self):
+        clock = FakeClock(time.time())
+        sigyn.time = clock
+        try:
+            wheel = sigyn.TimingWheel(now=clock.now)
+            registry = sigyn.StateRegistry(wheel)
+            patterns = registry.table('pattern', sigyn.SlidingWindowCounter)
+            warned = registry.table('warned', sigyn.SlidingWindowCounter)
+            for key in (('mask', 1), ('mask', 2), ('other', 1)):
+                patterns.get(key, 60).enqueue()
+            warned.get(('mask', '#test'), 30).enqueue()
+            registry.table('sasl').mark('mask', 30)
+            registry.discard('mask')
+            self.assertEqual(registry.keys(), set([('other', 1)]))
+            self.assertEqual(list(patterns.owned), ['other'])
+            self.assertEqual(warned.owned, {})
+            # expired entries leave the index too
+            clock.now = clock.now + 200
+            wheel.advance(clock.now)
+            self.assertEqual((len(registry), patterns.owned), (0, {}))
+        finally:
+            sigyn.time = time
+
+class LargestStringTestCase(SupyTestCase):
+
+    def assertSameLargest(self, s1, s2):
+        self.assertEqual(sigyn.largestString(s1, s2), referenceLargestString(s1, s2), (s1, s2))
+
+    def testEdges(self):
+        for (s1, s2) in (('', ''), ('', 'abc'), ('abc', ''), ('a', 'a'), ('a', 'b'),
+                         ('abc', 'abc'), ('aaaa', 'aa'), ('abab', 'baba')):
+            self.assertSameLargest(s1, s2)
+
+    def testFirstLongestInFirstString(self):
+        # both 'ab' and 'cd' are common, the one ending first in s1 wins
+        self.assertEqual(sigyn.largestString('cd ab', 'ab cd'), 'cd')
+        self.assertEqual(sigyn.largestString('ab cd', 'ab cd'), 'ab cd')
+        self.assertSameLargest('xyz abc xyz', 'abc xyz')
+
+    def testMessages(self):
+        m = 'buy cheap watches at http://example.com/shop now !!!'
+        text = 'BUY cheap watches at http://example.com/shop now !!! really'
+        self.assertEqual(sigyn.largestString(m, text), ' cheap watches at http://example.com/shop now !!!')
+        self.assertSameLargest(m, text)
+        self.assertSameLargest('☃ snow ☃☃ man', 'man ☃☃ snow')
+
+    def testRandom(self):
+        rand = random.Random(42)
+        for alphabet in ('ab', 'abc', 'abcdefgh ', 'aAé☃ '):
+            for i in range(300):
+                s1 = ''.join(rand.choice(alphabet) for j in range(rand.randint(0, 40)))
+                s2 = ''.join(rand.choice(alphabet) for j in range(rand.randint(0, 40)))
+                self.assertSameLargest(s1, s2)
+                # same s2 as previous call, the cached automaton is reused
+                self.assertSameLargest(s2 + s1, s2)
+                self.assertSameLargest(s1[::-1], s2)
+
+class TextFeaturesTestCase(SupyTestCase):
+
+    def testRandom(self):
+        # same counts as the former per detector scans
+        rand = random.Random(5)
+        alphabet = 'aZ 09:/http\u00e9\u1e14\u00ce\u00ef\u20ac'
+        for n in range(500):
+            raw = ''.join(rand.choice(alphabet) for i in range(rand.randint(0, 40)))
+            text = raw.lower()
+            features = sigyn.TextFeatures(raw, text)
+            spaceless = raw.replace(' ', '')
+            self.assertEqual(features.length, len(text))
+            self.assertEqual(features.spaceless, len(spaceless))
+            self.assertEqual(features.upper, len(re.findall('[A-Z]', spaceless)))
+            self.assertEqual(features.digit, text.isdigit())
+            self.assertEqual(features.spamchars, len([char for char in text if char in sigyn._spamchars]))
+            self.assertEqual(features.nonascii, len([char for char in text if ord(char) > 127]))
+            self.assertEqual(features.url, text.find('http') != -1)
+
+    def testWeirdness(self):
+        rand = random.Random(6)
+        alphabets = ('abc XYZ:/.!', '\x01\x10\t\x7fab', '\u00c3\u00a9caf\u00e9 \u00c2\u00a3', '\u1e14\u00ce\u0301\u2588a')
+        for n in range(500):
+            alphabet = rand.choice(alphabets)
+            text = ''.join(rand.choice(alphabet) for i in range(rand.randint(0, 20)))
+            self.assertEqual(sigyn.weirdness(text), sigyn.sequence_weirdness(text), repr(text))
+        hits = sigyn._cachedWeirdness.cache_info().hits
+        sigyn.weirdness('\u00c3\u00a9t\u00c3\u00a9')
+        sigyn.weirdness('\u00c3\u00a9t\u00c3\u00a9')
+        self.assertEqual(sigyn._cachedWeirdness.cache_info().hits, hits + 1)
+
+def referenceHilights (users,text,sender):
+    # former isHilight count
+    us = {}
+    for user in [u.lower() for u in users if u != 'ChanServ' and u != sender]:
+        if len(user) > 3 and not user in us and user in text:
+            us[user] = True
+    return len(us)
+
+class ChannelNicksTestCase(SupyTestCase):
+
+    def testRandom(self):
+        rand = random.Random(8)
+        minimum = sigyn.ChannelNicks.automatonMinimum
+        try:
+            for automatonMinimum in (0, minimum):
+                sigyn.ChannelNicks.automatonMinimum = automatonMinimum
+                nicks = sigyn.ChannelNicks()
+                users = set()
+                pool = ['ChanServ'] + ['%s%s' % (rand.choice(('bob', 'Anna', 'joanna', 'x', 'Zed_')), n) for n in range(60)] + ['Bob0', 'anna']
+                for step in range(3000):
+                    action = rand.random()
+                    nick = rand.choice(pool)
+                    if action < 0.4:
+                        nicks.add(nick)
+                        users.add(nick)
+                    elif action < 0.6:
+                        nicks.discard(nick)
+                        users.discard(nick)
+                    elif action < 0.7:
+                        new = rand.choice(pool)
+                        if nick in users and not new in users:
+                            nicks.rename(nick, new)
+                            users.discard(nick)
+                            users.add(new)
+                    else:
+                        text = ' '.join(rand.choice(pool).lower() for i in range(rand.randint(0, 8)))
+                        sender = rand.choice(sorted(users) or pool)
+                        self.assertEqual(nicks.count(text, sender), referenceHilights(users, text, sender), text)
+                self.assertEqual(len(nicks), len(users))
+                nicks.sync(users | set(['extra']))
+                self.assertEqual(sorted(nicks.nicks), sorted(users | set(['extra'])))
+        finally:
+            sigyn.ChannelNicks.automatonMinimum = minimum
+
+class SlowClock(FakeClock):
+
+    def thread_time(self):
+        # every regexp run costs one second
+        self.now += 1
+        return self.now
+
+class PatternSetTestCase(SupyTestCase):
+
+    def testCatastrophicShape(self):
+        for regexp in ('(a|ab)*c', '(a|b)*c', 'foo\\d+bar', '(\\w+){2}', 'a{1,30}', '^(buy|sell) now',
+                       '(spam|eggs)+', '\\bfree\\s+money\\b', '[a-z]+@[a-z]+\\.com', '(\\d{1,3}\\.){3}\\d{1,3}'):
+            self.assertEqual(sigyn.catastrophicShape(re.compile(regexp)), None, regexp)
+        for regexp in ('(a|a)*b', '(ab|ab)*c', '(a|a?)+b', '(a+){20}b', '(.*a){20}', '(a+)+b',
+                       '(\\w+\\s?){10}x', '(x+x+)+y'):
+            self.assertNotEqual(sigyn.catastrophicShape(re.compile(regexp)), None, regexp)
+
+    def testAutomaton(self):
+        rand = random.Random(9)
+        automaton = sigyn.Automaton()
+        words = {}
+        pool = ['a', 'ab', 'abc', 'bc', 'bca', 'c', 'cab', 'aab', 'b\u00e9']
+        for step in range(2000):
+            action = rand.random()
+            word = rand.choice(pool)
+            key = rand.randint(-3, 3)
+            if action < 0.3:
+                automaton.add(word, key)
+                words.setdefault(word, set()).add(key)
+            elif action < 0.5:
+                automaton.discard(word, key)
+                words.get(word, set()).discard(key)
+            else:
+                text = ''.join(rand.choice('abc\u00e9 ') for i in range(rand.randint(0, 12)))
+                expected = set()
+                for (word, keys) in words.items():
+                    if word in text:
+                        expected.update(keys)
+                self.assertEqual(automaton.search(text), expected, text)
+                # copies are independent from further changes
+                copy = automaton.copy()
+                copy.add('zz', 99)
+                self.assertEqual(automaton.search('zz'), set())
+
+    def testRequiredLiterals(self):
+        # a text the regexp matches always contains one of the fragments
+        rand = random.Random(10)
+        regexps = ('foo', 'fo+bar', '(spam|eggs)+', 'a[bc]d', '^buy (now|today)', 'x.?y', '(?i)FrEe', 'ab|cd',
+                   '(ab)?cd', 'a{2,3}b', '(?:x|y)z\\b', 'b\\d+c', '[^a]bc', '(ab|a)c', 'a(b|)c', 'ab*c')
+        for regexp in regexps:
+            compiled = re.compile(regexp)
+            fragments = sigyn.requiredLiterals(compiled)
+            for n in range(400):
+                text = ''.join(rand.choice('abcdxyz FREfrepsgmnoutwy1') for i in range(rand.randint(0, 14)))
+                if rand.random() < 0.3:
+                    text = text + rand.choice(('foobar', 'spam', 'buy now', 'free', 'acd', 'aabb', 'b12c', 'xz ', 'ac'))
+                if compiled.search(text) and fragments is not None:
+                    self.assertTrue(any(fragment in text.lower() for fragment in fragments), (regexp, text, fragments))
+
+    def testSameAsSearch(self):
+        rand = random.Random(11)
+        patterns = sigyn.PatternSet()
+        sources = [('spam', False), ('free money', False), ('/sp[a4]m/', True), ('/(buy|sell) now/', True),
+                   ('/^hello/', True), ('/bye$/', True), ('/[0-9]{3}-[0-9]{4}/', True), ('/FREE/i', True),
+                   ('/\\bcasino\\b/', True), ('/x.*y/', True)]
+        all = {}
+        for (uid, (source, regexp)) in enumerate(sources, 1):
+            all[uid] = sigyn.Pattern(uid, source, regexp, 1, 1)
+            patterns.add(all[uid])
+        words = ['spam', 'sp4m', 'free', 'money', 'buy', 'sell', 'now', 'hello', 'bye', '555-1234', 'casino', 'casinos', 'x', 'y', 'FREE', 'Spam']
+        for n in range(1500):
+            if rand.random() < 0.05:
+                uid = rand.choice(list(all))
+                if uid in patterns.regexps or any(uid in keys for keys in patterns.literals.keys if keys):
+                    patterns.remove(all[uid])
+                else:
+                    patterns.add(all[uid])
+            text = ' '.join(rand.choice(words) for i in range(rand.randint(0, 6)))
+            active = [uid for uid in all if uid in patterns.regexps or any(uid in keys for keys in patterns.literals.keys if keys)]
+            self.assertEqual(patterns.match(text), sorted(uid for uid in active if all[uid].match(text)), text)
+
+    def testSlowSample(self):
+        patterns = sigyn.PatternSet()
+        pattern = sigyn.Pattern(1, '/sl+ow/', True, 1, 1)
+        patterns.add(pattern)
+        clock = sigyn.time = SlowClock(0)
+        try:
+            for n in range(sigyn._regexpStrikes - 1):
+                self.assertEqual(patterns.match('slow', 0.5), [1])
+                self.assertEqual(patterns.slow, {})
+            # strikes older than the window are forgotten
+            clock.now = clock.now + sigyn._regexpStrikeWindow
+            for n in range(sigyn._regexpStrikes - 1):
+                self.assertEqual(patterns.match('slow', 0.5), [1])
+                self.assertEqual(patterns.slow, {})
+            self.assertEqual(patterns.match('sllow', 0.5), [1])
+            self.assertEqual(patterns.slow, {1: 1})
+        finally:
+            sigyn.time = time
+        self.assertEqual(pattern.calls, 2 * sigyn._regexpStrikes - 1)
+
+class FingerprintTestCase(SupyTestCase):
+
+    def assertSameSimilarity(self, a, b):
+        self.assertEqual(sigyn.compareFingerprint(a, sigyn.fingerprint(a), b, sigyn.fingerprint(b)),
+                         sigyn.compareString(a, b), (a, b))
+
+    def testBitmap(self):
+        self.assertEqual(sigyn.fingerprint('abba'), (1 << ord('a')) | (1 << ord('b')))
+        self.assertEqual(sigyn.fingerprint('☃ab'), frozenset('☃ab'))
+        self.assertEqual(sigyn.fingerprint(''), 0)
+
+    def testContext(self):
+        for raw in ('Hello World', '☃ Snow', ''):
+            context = sigyn.MessageContext(raw, '*@127.0.0.1', sigyn.PatternSet())
+            self.assertEqual(context.fingerprint(), sigyn.fingerprint(raw.lower()))
+            self.assertIs(context.fingerprint(), context.fingerprint())
+
+    def testRandom(self):
+        rand = random.Random(42)
+        for alphabet in ('ab', 'abcdefgh ', 'aAé☃ ', 'xyz☃'):
+            for i in range(300):
+                a = ''.join(rand.choice(alphabet) for j in range(rand.randint(0, 30)))
+                b = ''.join(rand.choice('abcdefgh ') for j in range(rand.randint(0, 30)))
+                self.assertSameSimilarity(a, b)
+                self.assertSameSimilarity(b, a)
+                self.assertSameSimilarity(a, a)
+
+
+class MessageWindowTestCase(SupyTestCase):
+
+    def assertSameScan(self, window, text, trigger):
+        expected = None
+        for (m, fm) in window:
+            if sigyn.compareString(m, text) > trigger:
+                expected = m
+                break
+        self.assertEqual(window.similar(text, sigyn.fingerprint(text), trigger), expected, (text, trigger))
+
+    def testRandom(self):
+        rand = random.Random(42)
+        (numpy, vectorMinimum) = (sigyn.numpy, sigyn.MessageWindow.vectorMinimum)
+        try:
+            # numpy when installed with every window, then the python loop
+            for (sigyn.numpy, sigyn.MessageWindow.vectorMinimum) in ((numpy, 0), (None, 0)):
+                for alphabet in ('abcdefgh ', 'aé☃b '):
+                    window = sigyn.MessageWindow(3600)
+                    for i in range(150):
+                        text = ''.join(rand.choice(alphabet) for j in range(rand.randint(1, 30)))
+                        for trigger in (0.5, 0.8):
+                            self.assertSameScan(window, text, trigger)
+                        if i % 20 == 19:
+                            window.dequeue()
+                        window.enqueue((text, sigyn.fingerprint(text)))
+        finally:
+            (sigyn.numpy, sigyn.MessageWindow.vectorMinimum) = (numpy, vectorMinimum)
+
+    def testIndex(self):
+        rand = random.Random(42)
+        indexMinimum = sigyn.MessageWindow.indexMinimum
+        sigyn.MessageWindow.indexMinimum = 2
+        try:
+            window = sigyn.MessageWindow(3600)
+            texts = []
+            for i in range(400):
+                if len(texts) and rand.random() < 0.2:
+                    # a duplicate always shares its bands
+                    text = rand.choice(texts[-50:])
+                    self.assertNotEqual(window.similar(text, sigyn.fingerprint(text), 0.99), None)
+                else:
+                    text = ''.join(rand.choice('abcdefghijklmnopqrstuvwxyz ☃') for j in range(rand.randint(1, 30)))
+                    m = window.similar(text, sigyn.fingerprint(text), 0.7)
+                    if m is not None:
+                        self.assertTrue(sigyn.compareString(m, text) > 0.7)
+                while len(window) > 50:
+                    window.dequeue()
+                    texts.pop(0)
+                if i == 200:
+                    window.reset()
+                    texts = []
+                window.enqueue((text, sigyn.fingerprint(text)))
+                texts.append(text)
+        finally:
+            sigyn.MessageWindow.indexMinimum = indexMinimum
+
+
+class SlidingWindowCounterTestCase(SupyTestCase):
+
+    def testSameAsTimeoutQueue(self):
+        rand = random.Random(42)
+        now = time.time()
+        counter = sigyn.SlidingWindowCounter(60)
+        queue = utils.structures.TimeoutQueue(60)
+        # events of the last two minutes, in order, half of them expired
+        for at in sorted(now - rand.random() * 120 for i in range(200)):
+            counter.enqueue('key', at)
+            queue.enqueue('key', at)
+            self.assertEqual(len(counter), len(queue))
+        counter.setTimeout(30)
+        queue.setTimeout(30)
+        self.assertEqual(len(counter), len(queue))
+        counter.reset()
+        self.assertEqual(len(counter), 0)
+        counter.enqueue('key')
+        self.assertEqual(len(counter), 1)
+
+
+class TimingWheelTestCase(SupyTestCase):
+
+    def testRandom(self):
+        rand = random.Random(42)
+        now = 1000.0
+        # a small wheel, entries cascade from every level and some are beyond it
+        wheel = sigyn.TimingWheel(resolution=0.5,size=4,depth=3,now=now)
+        fired = []
+        expected = []
+        for i in range(300):
+            at = now + rand.random() * 50
+            expected.append(at)
+            wheel.schedule(lambda at=at: fired.append((at, now)),at)
+            if rand.random() < 0.5:
+                now = now + rand.random() * 0.7
+                wheel.advance(now)
+        self.assertEqual(len(wheel) + len(fired), len(expected))
+        while len(wheel):
+            now = now + rand.random() * 0.7
+            wheel.advance(now)
+        self.assertEqual(sorted(at for (at, t) in fired), sorted(expected))
+        for (at, t) in fired:
+            # never early, at most one tick late
+            self.assertTrue(at < t < at + 0.5 + 0.7, (at, t))
+        wheel.schedule(lambda: fired.append(None),now - 10)
+        wheel.advance(now + 0.5)
+        self.assertEqual(fired[-1], None)
+
+
+class RepetitionsTestCase(SupyTestCase):
+
+    def assertSameRepetitions(self, s):
+        self.assertEqual(list(sigyn.repetitions(s)), list(referenceRepetitions(s)), s)
+
+    def testMaximalRuns(self):
+        self.assertEqual(sigyn.maximalRuns('aaaa'), set([(0, 4, 1)]))
+        self.assertEqual(sigyn.maximalRuns('abaabaab'), set([(0, 8, 3), (2, 4, 1), (5, 7, 1)]))
+        self.assertEqual(sigyn.maximalRuns('abc'), set())
+
+    def testLongLines(self):
+        # regexp then runs once the budget is spent, lines may be mixed
+        chat = 'hello anyone knows how to fix this error when i run make install thanks '
+        paste = 'def run(self, x, y): return self.value(x) == None if y else print(x) [42] {0} '
+        for s in (chat * 3, paste * 4, chat + 'lol ' * 100, paste * 2 + '\n' + 'a' * 300,
+                  paste * 3 + 'BUY NOW ' * 20 + paste, 'x' * 500, '☃ é ' * 80):
+            self.assertSameRepetitions(s)
+        self.assertEqual(list(sigyn.repetitions('abcdefghijklmnopqrstuvwxyz' * 6)),
+                         [('abcdefghijklmnopqrstuvwxyz', 6.0)])
+
+    def testRandom(self):
+        rand = random.Random(42)
+        (threshold, budget) = (sigyn._repetitionThreshold, sigyn._repetitionBudget)
+        try:
+            for (sigyn._repetitionThreshold, sigyn._repetitionBudget) in ((0, 0), (8, 2), (threshold, budget)):
+                for alphabet in ('ab', 'abc', 'ab\n', 'abcdefgh ', 'aAé☃ '):
+                    for i in range(200):
+                        s = ''.join(rand.choice(alphabet) for j in range(rand.randint(0, 200)))
+                        if rand.random() < 0.3:
+                            unit = ''.join(rand.choice(alphabet) for j in range(rand.randint(1, 6)))
+                            j = rand.randint(0, len(s))
+                            s = s[:j] + unit * rand.randint(2, 20) + s[j:]
+                        self.assertSameRepetitions(s)
+        finally:
+            (sigyn._repetitionThreshold, sigyn._repetitionBudget) = (threshold, budget)
+
 
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79: